@@ -0,0 +1,229 @@
+<?xml version="1.0" encoding="UTF-8"?>
+<!--
+  A lightweight DocBook to HTML stylesheet, used by 'sibin preview' to render
+  books and chapters in-process. It covers the common DocBook elements only;
+  publican remains the reference for the published output.
+-->
+<xsl:stylesheet version="1.0"
+  xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+  xmlns:d="http://docbook.org/ns/docbook"
+  xmlns:xl="http://www.w3.org/1999/xlink"
+  exclude-result-prefixes="d xl">
+
+  <xsl:output method="html" encoding="UTF-8" indent="no"/>
+
+  <xsl:param name="title" select="''"/>
+
+  <xsl:key name="id" match="*[@id or @xml:id]" use="@id|@xml:id"/>
+
+  <xsl:template match="/">
+    <html>
+      <head>
+        <meta http-equiv="Content-Type" content="text/html; charset=UTF-8"/>
+        <title><xsl:value-of select="$title"/></title>
+        <style type="text/css">
+          body { font-family: sans-serif; max-width: 50em; margin: 2em auto; line-height: 1.4; }
+          pre { background: #f4f4f4; padding: 0.5em; overflow: auto; }
+          .admonition { border-left: 4px solid #888; padding: 0.2em 1em; margin: 1em 0; }
+          .warning, .important { border-color: #c00; }
+          .unresolved { color: #c00; }
+          table { border-collapse: collapse; }
+          td, th { border: 1px solid #ccc; padding: 0.2em 0.5em; }
+        </style>
+      </head>
+      <body>
+        <xsl:apply-templates/>
+      </body>
+    </html>
+  </xsl:template>
+
+  <!-- Anchors for elements with IDs -->
+  <xsl:template name="anchor">
+    <xsl:if test="@id or @xml:id">
+      <a id="{@id|@xml:id}"/>
+    </xsl:if>
+  </xsl:template>
+
+  <!-- Divisions -->
+  <xsl:template match="d:book|book|d:part|part|d:chapter|chapter|d:appendix|appendix|d:preface|preface|d:section|section|d:simplesect|simplesect|d:sect1|sect1|d:sect2|sect2|d:sect3|sect3">
+    <div class="{local-name()}">
+      <xsl:call-template name="anchor"/>
+      <xsl:variable name="depth" select="count(ancestor::*[local-name()='part' or local-name()='chapter' or local-name()='appendix' or local-name()='preface' or starts-with(local-name(),'sect') or local-name()='simplesect'])"/>
+      <xsl:variable name="level">
+        <xsl:choose>
+          <xsl:when test="$depth &gt; 4">6</xsl:when>
+          <xsl:otherwise><xsl:value-of select="$depth + 1"/></xsl:otherwise>
+        </xsl:choose>
+      </xsl:variable>
+      <xsl:element name="h{$level}">
+        <xsl:apply-templates select="(d:title|title|d:info/d:title|info/title)[1]/node()"/>
+      </xsl:element>
+      <xsl:apply-templates select="*[not(self::d:title or self::title or self::d:info or self::info)]"/>
+    </div>
+  </xsl:template>
+
+  <!-- Metadata and index terms are not rendered -->
+  <xsl:template match="d:info|info|d:indexterm|indexterm|d:remark|remark"/>
+
+  <!-- Block elements -->
+  <xsl:template match="d:para|para|d:simpara|simpara">
+    <p><xsl:call-template name="anchor"/><xsl:apply-templates/></p>
+  </xsl:template>
+
+  <xsl:template match="d:programlisting|programlisting|d:screen|screen|d:literallayout|literallayout">
+    <pre class="{local-name()}"><xsl:apply-templates/></pre>
+  </xsl:template>
+
+  <xsl:template match="d:blockquote|blockquote">
+    <blockquote><xsl:apply-templates/></blockquote>
+  </xsl:template>
+
+  <xsl:template match="d:note|note|d:tip|tip|d:important|important|d:warning|warning|d:caution|caution">
+    <div class="admonition {local-name()}">
+      <p><b>
+        <xsl:choose>
+          <xsl:when test="d:title|title"><xsl:apply-templates select="(d:title|title)[1]/node()"/></xsl:when>
+          <xsl:otherwise><xsl:value-of select="translate(substring(local-name(),1,1),'ntiwc','NTIWC')"/><xsl:value-of select="substring(local-name(),2)"/></xsl:otherwise>
+        </xsl:choose>
+      </b></p>
+      <xsl:apply-templates select="*[not(self::d:title or self::title)]"/>
+    </div>
+  </xsl:template>
+
+  <xsl:template match="d:figure|figure|d:example|example|d:table|table">
+    <div class="{local-name()}">
+      <xsl:call-template name="anchor"/>
+      <xsl:apply-templates select="*[not(self::d:title or self::title)]"/>
+      <p class="title"><b><xsl:apply-templates select="(d:title|title)[1]/node()"/></b></p>
+    </div>
+  </xsl:template>
+
+  <xsl:template match="d:mediaobject|mediaobject|d:inlinemediaobject|inlinemediaobject">
+    <xsl:apply-templates select="(d:imageobject|imageobject)[1]"/>
+  </xsl:template>
+
+  <xsl:template match="d:imagedata|imagedata">
+    <img src="{@fileref}">
+      <xsl:if test="@contentwidth">
+        <xsl:attribute name="style">width: <xsl:value-of select="@contentwidth"/></xsl:attribute>
+      </xsl:if>
+    </img>
+  </xsl:template>
+
+  <!-- Lists -->
+  <xsl:template match="d:itemizedlist|itemizedlist">
+    <ul><xsl:apply-templates/></ul>
+  </xsl:template>
+
+  <xsl:template match="d:orderedlist|orderedlist|d:procedure|procedure|d:substeps|substeps">
+    <ol><xsl:apply-templates/></ol>
+  </xsl:template>
+
+  <xsl:template match="d:listitem|listitem|d:step|step">
+    <li><xsl:apply-templates/></li>
+  </xsl:template>
+
+  <xsl:template match="d:simplelist|simplelist">
+    <ul class="simplelist"><xsl:apply-templates/></ul>
+  </xsl:template>
+
+  <xsl:template match="d:member|member">
+    <li><xsl:apply-templates/></li>
+  </xsl:template>
+
+  <xsl:template match="d:variablelist|variablelist">
+    <dl><xsl:apply-templates/></dl>
+  </xsl:template>
+
+  <xsl:template match="d:varlistentry|varlistentry">
+    <dt><xsl:apply-templates select="d:term|term"/></dt>
+    <dd><xsl:apply-templates select="d:listitem/node()|listitem/node()"/></dd>
+  </xsl:template>
+
+  <!-- Tables -->
+  <xsl:template match="d:informaltable|informaltable|d:tgroup|tgroup">
+    <xsl:apply-templates/>
+  </xsl:template>
+
+  <xsl:template match="d:table/d:tgroup|table/tgroup|d:informaltable/d:tgroup|informaltable/tgroup">
+    <table><xsl:apply-templates/></table>
+  </xsl:template>
+
+  <xsl:template match="d:thead|thead|d:tbody|tbody|d:tfoot|tfoot">
+    <xsl:element name="{local-name()}"><xsl:apply-templates/></xsl:element>
+  </xsl:template>
+
+  <xsl:template match="d:row|row">
+    <tr><xsl:apply-templates/></tr>
+  </xsl:template>
+
+  <xsl:template match="d:thead/d:row/d:entry|thead/row/entry">
+    <th><xsl:apply-templates/></th>
+  </xsl:template>
+
+  <xsl:template match="d:entry|entry">
+    <td><xsl:apply-templates/></td>
+  </xsl:template>
+
+  <!-- Links -->
+  <xsl:template match="d:link[@xl:href]|link[@xl:href]">
+    <a href="{@xl:href}"><xsl:apply-templates/></a>
+  </xsl:template>
+
+  <xsl:template match="d:ulink|ulink">
+    <a href="{@url}"><xsl:apply-templates/></a>
+  </xsl:template>
+
+  <xsl:template match="d:link[@linkend]|link[@linkend]">
+    <a href="#{@linkend}"><xsl:apply-templates/></a>
+  </xsl:template>
+
+  <xsl:template match="d:xref|xref">
+    <xsl:variable name="target" select="key('id', @linkend)"/>
+    <xsl:choose>
+      <xsl:when test="$target">
+        <a href="#{@linkend}"><xsl:apply-templates select="($target/d:title|$target/title|$target/d:info/d:title|$target/info/title)[1]/node()"/></a>
+      </xsl:when>
+      <xsl:otherwise>
+        <span class="unresolved">[<xsl:value-of select="@linkend"/>]</span>
+      </xsl:otherwise>
+    </xsl:choose>
+  </xsl:template>
+
+  <!-- Inline elements -->
+  <xsl:template match="d:emphasis|emphasis|d:firstterm|firstterm|d:citetitle|citetitle|d:replaceable|replaceable">
+    <em><xsl:apply-templates/></em>
+  </xsl:template>
+
+  <xsl:template match="d:emphasis[@role='bold' or @role='strong']|emphasis[@role='bold' or @role='strong']|d:guilabel|guilabel|d:guibutton|guibutton|d:guimenu|guimenu|d:guisubmenu|guisubmenu|d:guimenuitem|guimenuitem|d:keycap|keycap|d:application|application">
+    <b><xsl:apply-templates/></b>
+  </xsl:template>
+
+  <xsl:template match="d:command|command|d:literal|literal|d:filename|filename|d:classname|classname|d:methodname|methodname|d:computeroutput|computeroutput|d:userinput|userinput|d:code|code|d:option|option|d:parameter|parameter|d:varname|varname|d:envar|envar|d:systemitem|systemitem">
+    <code><xsl:apply-templates/></code>
+  </xsl:template>
+
+  <xsl:template match="d:menuchoice/*|menuchoice/*|d:keycombo/*|keycombo/*">
+    <xsl:if test="position() &gt; 1">
+      <xsl:choose>
+        <xsl:when test="parent::d:keycombo or parent::keycombo">+</xsl:when>
+        <xsl:otherwise> &#8594; </xsl:otherwise>
+      </xsl:choose>
+    </xsl:if>
+    <b><xsl:apply-templates/></b>
+  </xsl:template>
+
+  <xsl:template match="d:trademark|trademark">
+    <xsl:apply-templates/><xsl:text>&#174;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="d:quote|quote">
+    <xsl:text>&#8220;</xsl:text><xsl:apply-templates/><xsl:text>&#8221;</xsl:text>
+  </xsl:template>
+
+  <!-- Anything else is rendered as its content -->
+  <xsl:template match="*">
+    <xsl:apply-templates/>
+  </xsl:template>
+
+</xsl:stylesheet>
@@ -0,0 +1,115 @@
+import sibin.cache
+import gzip
+import hashlib
+import multiprocessing
+import os
+import os.path
+import shutil
+import tarfile
+import zipfile
+
+def archive_members(sources):
+  '''
+  Return the sorted list of (filename, arcname) pairs for all of the files under the
+  specified sources, where each source is a pair (srcdir, arcdir)
+  '''
+  members = []
+  for (srcdir, arcdir) in sources:
+    for (dirpath, dirnames, filenames) in os.walk(srcdir):
+      relpath = os.path.relpath(dirpath, srcdir)
+      for filename in filenames:
+        if relpath == '.':
+          arcname = arcdir + '/' + filename
+        else:
+          arcname = arcdir + '/' + relpath.replace(os.sep, '/') + '/' + filename
+        members.append((os.path.join(dirpath, filename), arcname))
+  members.sort(key=lambda member: member[1])
+  return members
+
+def part_signature(archiveFormat,sources):
+  '''
+  Return a digest of the archive format, the archive names, sizes and modification times of
+  all the files under sources. An archive part needs to be rewritten only if this changes.
+  '''
+  sha = hashlib.sha1()
+  sha.update(archiveFormat)
+  for (filename, arcname) in archive_members(sources):
+    st = os.stat(filename)
+    sha.update('\0' + arcname + '\0' + str(st.st_size) + '\0' + repr(st.st_mtime))
+  return sha.hexdigest()
+
+def write_part(task):
+  '''
+  Write the archive part for one book, where task is the tuple (partFile, archiveFormat, sources).
+  A zip part is a complete zip file with uncompressed members, which are compressed as they are
+  copied into the final archive (see assemble_zip()). A tar.gz part is a gzip member containing tar blocks (without the end-of-archive
+  marker), so that parts can simply be concatenated.
+  '''
+  (partFile, archiveFormat, sources) = task
+  with sibin.cache.atomic_output(partFile) as tmpfile:
+    if archiveFormat == 'zip':
+      with zipfile.ZipFile(tmpfile, 'w', zipfile.ZIP_STORED, True) as zf:
+        for (filename, arcname) in archive_members(sources):
+          zf.write(filename, arcname)
+    else:
+      with open(tmpfile, 'wb') as f:
+        gz = gzip.GzipFile(fileobj=f, mode='wb', mtime=0)
+        tar = tarfile.TarFile(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT)
+        for (filename, arcname) in archive_members(sources):
+          tar.add(filename, arcname)
+        # Not tar.close(), which would write the end-of-archive marker
+        gz.close()
+  return partFile
+
+def write_parts(tasks):
+  '''
+  Write the specified archive parts, compressing them in parallel
+  '''
+  if len(tasks) > 1:
+    pool = multiprocessing.Pool(min(len(tasks), multiprocessing.cpu_count()))
+    try:
+      pool.map(write_part, tasks)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for task in tasks:
+      write_part(task)
+
+def assemble_zip(partFiles,archiveFile):
+  '''
+  Combine zip parts into one zip archive, compressing their members as they are copied
+  (the zipfile module has no public way to copy a member that is already compressed)
+  '''
+  with zipfile.ZipFile(archiveFile, 'w', zipfile.ZIP_DEFLATED, True) as out:
+    for partFile in partFiles:
+      with zipfile.ZipFile(partFile) as part:
+        for info in part.infolist():
+          member = zipfile.ZipInfo(info.filename, info.date_time)
+          member.external_attr = info.external_attr
+          member.compress_type = zipfile.ZIP_DEFLATED
+          out.writestr(member, part.read(info))
+
+def assemble_targz(partFiles,archiveFile):
+  '''
+  Combine tar.gz parts into one tar.gz archive, by concatenating them
+  (a sequence of gzip members is itself a valid gzip file)
+  '''
+  with open(archiveFile, 'wb') as out:
+    for partFile in partFiles:
+      with open(partFile, 'rb') as fp:
+        shutil.copyfileobj(fp, out)
+    # Finish with the tar end-of-archive marker
+    gz = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+    gz.write('\0' * (2 * tarfile.BLOCKSIZE))
+    gz.close()
+
+def assemble(archiveFormat,partFiles,archiveFile):
+  dirname = os.path.dirname(archiveFile)
+  if dirname and not os.path.exists(dirname):
+    os.makedirs(dirname)
+  with sibin.cache.atomic_output(archiveFile) as tmpfile:
+    if archiveFormat == 'zip':
+      assemble_zip(partFiles, tmpfile)
+    else:
+      assemble_targz(partFiles, tmpfile)
@@ -0,0 +1,487 @@
+import sibin.core
+import contextlib
+import hashlib
+import json
+import marshal
+import os
+import os.path
+import sys
+
+def digest_files(filenames,salt='',sourceTree=None):
+  '''
+  Return a SHA1 digest of the names and contents of the specified files,
+  optionally mixed with an arbitrary 'salt' string (and optionally reading
+  the files from sourceTree, instead of from the working directory)
+  '''
+  sha = hashlib.sha1()
+  sha.update(salt)
+  for filename in sorted(filenames):
+    sha.update('\0' + filename + '\0')
+    if sourceTree is not None:
+      sha.update(sourceTree.read(filename))
+      continue
+    with open(filename, 'rb') as f:
+      sha.update(f.read())
+  return sha.hexdigest()
+
+def load_json(filename,default=None):
+  if os.path.exists(filename):
+    with open(filename, 'r') as f:
+      return json.load(f)
+  return default
+
+def save_json(filename,data):
+  dirname = os.path.dirname(filename)
+  if dirname and not os.path.exists(dirname):
+    os.makedirs(dirname)
+  atomic_write(filename, json.dumps(data, sort_keys=True, indent=1))
+
+@contextlib.contextmanager
+def atomic_output(filename,suffix=''):
+  '''
+  A context manager that yields the name of a temporary file (ending in suffix), which its body
+  writes in place of filename, and then renames the temporary file to filename. So an interrupted
+  run never leaves a truncated file, and concurrent processes never see each other's partially
+  written files. If the body raises an exception, the temporary file is removed and filename is left unchanged.
+  '''
+  tmpfile = filename + '.' + str(os.getpid()) + '.tmp' + suffix
+  try:
+    yield tmpfile
+  except:
+    if os.path.exists(tmpfile):
+      os.remove(tmpfile)
+    raise
+  os.rename(tmpfile, filename)
+
+def atomic_write(filename,data,mode='w'):
+  '''
+  Write data to filename through a temporary file (see atomic_output())
+  '''
+  with atomic_output(filename) as tmpfile:
+    with open(tmpfile, mode) as f:
+      f.write(data)
+
+def file_stats(filenames):
+  '''
+  Return a dictionary mapping each of the specified files to its [mtime, size]
+  (or to None, if the file does not exist)
+  '''
+  stats = {}
+  for filename in filenames:
+    if os.path.exists(filename):
+      st = os.stat(filename)
+      stats[filename] = [st.st_mtime, st.st_size]
+    else:
+      stats[filename] = None
+  return stats
+
+
+class FragmentCache:
+  '''
+  A persistent cache of transformed book fragments, where each fragment corresponds
+  to one top-level xi:include of a book file. The cache is kept under the directory
+  <cacheDir>/fragments/<profile>/<bookRoot>/
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('FragmentCache must be initialized with a SibinContext argument')
+    self.context = context
+    self.hits = 0
+    self.misses = 0
+
+  def bookdir(self,bookFile):
+    (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+    return os.path.join(self.context.cacheDir, 'fragments', self.context.currentProfile, bookRoot)
+
+  def load_index(self,bookFile):
+    '''
+    Return the fragment index of bookFile, which maps each xi:include href
+    to the cache entry (a dictionary) of the corresponding fragment
+    '''
+    return load_json(os.path.join(self.bookdir(bookFile), 'index.json'), {})
+
+  def save_index(self,bookFile,index):
+    save_json(os.path.join(self.bookdir(bookFile), 'index.json'), index)
+
+  def fragment_file(self,bookFile,href):
+    return os.path.join(self.bookdir(bookFile), hashlib.sha1(href).hexdigest() + '.xml')
+
+  def lookup(self,bookFile,index,href,digest):
+    '''
+    Return the cached fragment content for href, if its recorded digest matches 'digest'
+    and none of the olink targets it resolved have changed, otherwise return None
+    (entries without recorded diagnostics predate them, and are treated as out of date)
+    '''
+    entry = index.get(href)
+    fragmentFile = self.fragment_file(bookFile,href)
+    if entry and entry['digest'] == digest and 'diagnostics' in entry and os.path.exists(fragmentFile) \
+        and not olinks_changed(self.context.linkData, entry.get('olinks', {})):
+      with open(fragmentFile, 'r') as f:
+        content = f.read()
+      self.hits += 1
+      return content
+    self.misses += 1
+    return None
+
+  def store(self,bookFile,index,href,digest,content,olinks,images,diagnostics):
+    fragmentFile = self.fragment_file(bookFile,href)
+    dirname = os.path.dirname(fragmentFile)
+    if not os.path.exists(dirname):
+      os.makedirs(dirname)
+    atomic_write(fragmentFile, content)
+    index[href] = { 'digest' : digest, 'olinks' : olinks, 'images' : images, 'diagnostics' : diagnostics }
+
+
+class OlinkRecords:
+  '''
+  Records, for each generated book, the cross-book olink targets it resolved
+  and a digest of each answer. The records are kept under the directory
+  <cacheDir>/olinks/<profile>/
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('OlinkRecords must be initialized with a SibinContext argument')
+    self.context = context
+
+  def record_file(self,bookFile):
+    (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+    return os.path.join(self.context.cacheDir, 'olinks', self.context.currentProfile, bookRoot + '.json')
+
+  def save(self,bookFile,olinks):
+    save_json(self.record_file(bookFile), olinks)
+
+  def changed(self,bookFile):
+    '''
+    Return True, if any olink target resolved by the last generation of bookFile
+    would now resolve differently (or if there is no record for bookFile)
+    '''
+    olinks = load_json(self.record_file(bookFile))
+    if olinks is None:
+      return True
+    return olinks_changed(self.context.linkData, olinks)
+
+
+def olinks_changed(linkData,olinks):
+  '''
+  Return True, if any of the recorded olink digests, which map 'targetdoc targetptr'
+  keys to the digests returned by LinkData.target_digest(), no longer match
+  '''
+  for key in olinks:
+    (targetdoc, targetptr) = key.split(' ', 1)
+    if linkData.target_digest(targetdoc, targetptr) != olinks[key]:
+      return True
+  return False
+
+
+class DependencyIndex:
+  '''
+  A persistent reverse index from every source file, image, entity file and template file
+  to the set of books that consume it, kept in the file <cacheDir>/dependencies.json
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('DependencyIndex must be initialized with a SibinContext argument')
+    self.context = context
+    self.indexFile = os.path.join(context.cacheDir, 'dependencies.json')
+    self.books = None
+    self.file2books = None
+    self.book2files = None
+    # Books whose dependencies were updated in this run (None, for books removed in this run)
+    self.updatedBooks = {}
+
+  def load(self):
+    if self.file2books is None:
+      data = load_json(self.indexFile, {})
+      self.books = set(data.get('books', []))
+      self.file2books = {}
+      self.book2files = {}
+      for filename, books in data.get('files', {}).items():
+        self.file2books[filename] = set(books)
+        for bookFile in books:
+          self.book2files.setdefault(bookFile, set()).add(filename)
+
+  def save(self):
+    if not self.updatedBooks and os.path.exists(self.indexFile):
+      # Nothing to save (and the index might have been updated by another process, such as a worker)
+      return
+    if self.updatedBooks:
+      # Reload the index, in case another process (for example, another shard)
+      # saved it in the meantime, and reapply this run's updates on top
+      self.file2books = None
+      self.load()
+      for bookFile in self.updatedBooks:
+        self._set_book(bookFile, self.updatedBooks[bookFile])
+    self.load()
+    files = {}
+    for filename in self.file2books:
+      files[filename] = sorted(self.file2books[filename])
+    save_json(self.indexFile, { 'books' : sorted(self.books), 'files' : files })
+
+  def has_book(self,bookFile):
+    self.load()
+    return bookFile in self.books
+
+  def set_book(self,bookFile,dependencies):
+    '''
+    Replace the recorded dependencies of bookFile by the set of files, 'dependencies'
+    '''
+    self.load()
+    self.updatedBooks[bookFile] = set(dependencies)
+    self._set_book(bookFile, dependencies)
+
+  def _set_book(self,bookFile,dependencies):
+    for filename in self.book2files.get(bookFile, set()):
+      self.file2books[filename].discard(bookFile)
+      if not self.file2books[filename]:
+        del self.file2books[filename]
+    if dependencies is None:
+      # Remove the book
+      self.book2files.pop(bookFile, None)
+      self.books.discard(bookFile)
+      return
+    for filename in dependencies:
+      self.file2books.setdefault(filename, set()).add(bookFile)
+    self.book2files[bookFile] = set(dependencies)
+    self.books.add(bookFile)
+
+  def remove_book(self,bookFile):
+    '''
+    Remove bookFile and its dependencies from the index
+    '''
+    self.load()
+    self.updatedBooks[bookFile] = None
+    self._set_book(bookFile, None)
+
+  def books_for(self,filename):
+    '''
+    Return the set of books that depend on 'filename' (a path relative to the top level dir)
+    '''
+    self.load()
+    return set(self.file2books.get(os.path.normpath(filename), set()))
+
+
+class LinkIndexCache:
+  '''
+  A persistent cache of the link data of individual books, so that a targeted build
+  of one book can resolve its olinks without parsing the books it links to.
+  Each record holds the book ID, the [mtime, size] (or blob SHA) of every file the link data was
+  parsed from, and the book's link index (in the format of LinkData.export_index()).
+  The records are kept under the directory <cacheDir>/links/
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('LinkIndexCache must be initialized with a SibinContext argument')
+    self.context = context
+    self.hits = 0
+    self.misses = 0
+
+  def record_file(self,bookFile):
+    (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+    return os.path.join(self.context.cacheDir, 'links', bookRoot + '.json')
+
+  def lookup(self,bookFile):
+    '''
+    Return the cached link index of bookFile, if none of its source files have changed,
+    otherwise return None
+    '''
+    record = load_json(self.record_file(bookFile))
+    if record is None or record.get('book') != bookFile or self.context.sourceTree.stats(record['files'].keys()) != record['files']:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return record['index']
+
+  def store(self,bookFile,filenames,index):
+    save_json(self.record_file(bookFile), { 'book' : bookFile, 'files' : self.context.sourceTree.stats(filenames), 'index' : index })
+
+
+class BookCatalog:
+  '''
+  A persistent catalog of the metadata of each book (the fields of BookParser.parse()), so that
+  commands that need only the ID or title of a book do not have to parse and xinclude the whole book.
+  Each record holds the files the metadata was parsed from (the book file, its info block, and their
+  entity files), a digest of their content, and the metadata.
+  The records are kept under the directory <cacheDir>/books/
+  '''
+
+  FIELDS = ['id', 'title', 'subtitle', 'abstract', 'productname', 'productnumber', 'edition']
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('BookCatalog must be initialized with a SibinContext argument')
+    self.context = context
+    self.hits = 0
+    self.misses = 0
+
+  def record_file(self,bookFile):
+    (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+    return os.path.join(self.context.cacheDir, 'books', bookRoot + '.json')
+
+  def digest(self,filenames):
+    '''
+    Return the digest of the specified files, or None, if any of them no longer exists
+    '''
+    for filename in filenames:
+      if not self.context.sourceTree.exists(filename):
+        return None
+    return digest_files(filenames, '', self.context.sourceTree)
+
+  def load(self,bookFile):
+    '''
+    Return the record of bookFile, if none of the files its metadata was parsed from
+    have changed, otherwise return None
+    '''
+    record = load_json(self.record_file(bookFile))
+    if record is None or record.get('book') != bookFile or self.digest(record['files']) != record['digest']:
+      return None
+    return record
+
+  def lookup(self,bookFile):
+    '''
+    Return the cached metadata of bookFile as a Book object, or None, if it is out of date
+    '''
+    record = self.load(bookFile)
+    if record is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    book = sibin.core.Book(bookFile)
+    for field in self.FIELDS:
+      value = record['metadata'][field]
+      try:
+        # Plain ASCII text as a byte string, as returned by lxml
+        value = value.encode('ascii')
+      except UnicodeEncodeError:
+        pass
+      setattr(book, field, value)
+    return book
+
+  def store(self,bookFile,filenames,book):
+    '''
+    Record the metadata of book, parsed from bookFile and the specified files
+    '''
+    metadata = {}
+    for field in self.FIELDS:
+      metadata[field] = getattr(book, field)
+    save_json(self.record_file(bookFile), { 'book' : bookFile, 'files' : sorted(filenames), 'digest' : self.digest(filenames), 'metadata' : metadata })
+
+
+class ValidationResults:
+  '''
+  The results of the last validation of each book, together with a digest of the schema and of
+  all the files the book was parsed from, kept in the file <cacheDir>/validation.json
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('ValidationResults must be initialized with a SibinContext argument')
+    self.context = context
+    self.resultsFile = os.path.join(context.cacheDir, 'validation.json')
+    self.results = None
+    self.hits = 0
+    self.misses = 0
+
+  def load(self):
+    if self.results is None:
+      self.results = load_json(self.resultsFile, {})
+
+  def save(self):
+    save_json(self.resultsFile, self.results)
+
+  def lookup(self,bookFile,digest):
+    '''
+    Return the cached list of validation errors for bookFile, if the recorded digest matches 'digest',
+    otherwise return None
+    '''
+    self.load()
+    entry = self.results.get(bookFile)
+    if entry and entry['digest'] == digest:
+      self.hits += 1
+      return entry['errors']
+    self.misses += 1
+    return None
+
+  def store(self,bookFile,digest,errors):
+    self.load()
+    self.results[bookFile] = { 'digest' : digest, 'errors' : errors }
+
+
+class BuildHistory:
+  '''
+  The most recent generation times of each book, together with the size of the book's source
+  files at the time, used to predict the cost of generating the book. The records are kept
+  under the directory <cacheDir>/history/
+  '''
+
+  # The number of records kept for each book
+  MAX_RECORDS = 10
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('BuildHistory must be initialized with a SibinContext argument')
+    self.context = context
+
+  def record_file(self,bookFile):
+    (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+    return os.path.join(self.context.cacheDir, 'history', bookRoot + '.json')
+
+  def load(self,bookFile):
+    '''
+    Return the list of records for bookFile, each of which is a dictionary with the keys
+    'bytes' (the size of the book's source files) and 'seconds' (the generation time)
+    '''
+    record = load_json(self.record_file(bookFile))
+    if record is None or record.get('book') != bookFile:
+      return []
+    return record['records']
+
+  def record(self,bookFile,sourceBytes,seconds):
+    records = self.load(bookFile) + [{ 'bytes' : sourceBytes, 'seconds' : round(seconds, 4) }]
+    save_json(self.record_file(bookFile), { 'book' : bookFile, 'records' : records[-self.MAX_RECORDS:] })
+
+
+class ConfigCache:
+  '''
+  The settings parsed from sibin.cfg, kept in the file <cacheDir>/config.marshal together with
+  the [mtime, size] of sibin.cfg and of every entity file it includes, so that sibin.cfg is
+  parsed (and its entities resolved) again only after one of these files changes
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('ConfigCache must be initialized with a SibinContext argument')
+    self.context = context
+    self.cacheFile = os.path.join(context.cacheDir, 'config.marshal')
+
+  def initialize(self,filename):
+    '''
+    Initialize the context from filename, using the cached settings if they are still valid
+    '''
+    record = self.load()
+    if record is not None and record['python'] == sys.hexversion and file_stats(record['files'].keys()) == record['files']:
+      self.context.import_config(record['config'])
+      return
+    before = set(sibin.core.fileResolver.cache)
+    self.context.initializeFromFile(filename)
+    # The entity files resolved while parsing filename
+    filenames = set([filename] + [os.path.relpath(path) for path in set(sibin.core.fileResolver.cache) - before])
+    self.save({ 'python' : sys.hexversion, 'files' : file_stats(filenames), 'config' : self.context.export_config() })
+
+  def load(self):
+    if not os.path.exists(self.cacheFile):
+      return None
+    try:
+      with open(self.cacheFile, 'rb') as f:
+        return marshal.load(f)
+    except (EOFError, ValueError, TypeError):
+      # A cache written by another version of Python
+      return None
+
+  def save(self,record):
+    if not os.path.exists(self.context.cacheDir):
+      os.makedirs(self.context.cacheDir)
+    atomic_write(self.cacheFile, marshal.dumps(record), 'wb')
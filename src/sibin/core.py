@@ -4,10 +4,18 @@ Created on Nov 21, 2013
 @author: fbolton
 '''
 from lxml import etree
+import sibin.source
+import sibin.diagnostics
 import htmlentitydefs
 import re
 import os.path
 import sys
+import hashlib
+import collections
+import copy
+import importlib
+import StringIO
+import urlparse
 
 # Re-encode special character codes to their names (e.g. &#160; to &nbsp;)
 def reencode(string):
@@ -25,6 +33,180 @@ def xmltostring(xml):
   string = reencode(string)
   return string
 
+class CachingResolver(etree.Resolver):
+  '''
+  An lxml resolver that serves local files (entity files, DTDs, xincluded fragments)
+  from an in-memory cache, keyed by absolute path and modification time (and size)
+  '''
+
+  def __init__(self,maxCacheBytes=256*1024*1024):
+    etree.Resolver.__init__(self)
+    # Where the files are read from (the working directory, or a git commit)
+    self.source = sibin.source.WorkingTree()
+    self.cache = collections.OrderedDict()
+    self.cacheBytes = 0
+    self.maxCacheBytes = maxCacheBytes
+    self.hits = 0
+    self.misses = 0
+
+  def read(self,filename):
+    '''
+    Return the contents of filename, reading it from disk only if it is not
+    already cached or if it has been modified since it was cached
+    '''
+    path = os.path.abspath(filename)
+    mtime = self.source.signature(path)
+    entry = self.cache.pop(path, None)
+    if entry and entry[0] == mtime:
+      self.hits += 1
+    else:
+      if entry:
+        self.cacheBytes -= len(entry[1])
+      entry = (mtime, self.source.read_xml(path))
+      self.cacheBytes += len(entry[1])
+      self.misses += 1
+      # Evict the least recently used files, if the cache is too big
+      while self.cache and (self.cacheBytes > self.maxCacheBytes):
+        (evictedPath, evictedEntry) = self.cache.popitem(last=False)
+        self.cacheBytes -= len(evictedEntry[1])
+    self.cache[path] = entry
+    return entry[1]
+
+  def resolve(self,url,pubid,context):
+    if url.startswith('file:'):
+      # Imported here, because urllib is slow to import (and rarely needed)
+      import urllib
+      filename = urllib.url2pathname(urlparse.urlparse(url).path)
+    elif '://' in url:
+      # Let libxml2 deal with any remote URLs
+      return None
+    else:
+      filename = url
+    if not self.source.isfile(filename):
+      return None
+    return self.resolve_string(self.read(filename), context, base_url=url)
+
+# The resolver and parsers shared by all of the XML parsing in sibin
+fileResolver = CachingResolver()
+xmlParsers = {}
+
+def xml_parser(resolve_entities=True):
+  '''
+  Return the shared parser that resolves (or does not resolve) entities
+  '''
+  if resolve_entities not in xmlParsers:
+    parser = etree.XMLParser(resolve_entities=resolve_entities)
+    parser.resolvers.add(fileResolver)
+    xmlParsers[resolve_entities] = parser
+  return xmlParsers[resolve_entities]
+
+def parse_xml(filename,resolve_entities=True):
+  '''
+  Parse filename with the shared parser, returning an ElementTree
+  '''
+  content = fileResolver.read(filename)
+  return etree.parse(StringIO.StringIO(content), xml_parser(resolve_entities), base_url=filename)
+
+def parse_xml_string(content,resolve_entities=True,base_url=None):
+  '''
+  Parse the string, content, with the shared parser, returning the root element
+  '''
+  return etree.fromstring(content, xml_parser(resolve_entities), base_url=base_url)
+
+class EntityExpander:
+  '''
+  Expands the entity references in a parsed tree, using the entities declared in entityFile
+  (for example, the library entities file). Each distinct entity is parsed only once.
+  '''
+
+  # An entity reference (other than a predefined entity or a character reference) in an attribute value
+  ATTRIBUTE_ENTITY = re.compile(r'''=\s*("[^"<]*|'[^'<]*)&(?!(amp|lt|gt|quot|apos);)[A-Za-z_:]''')
+
+  def __init__(self,entityFile):
+    self.entityFile = entityFile
+    self.expansions = {}
+    # Maps the names of entities that expand to plain text to their expansion
+    self.textExpansions = {}
+
+  def expansion(self,name,nsmap={}):
+    '''
+    Return a wrapper element containing the expansion of the entity, 'name',
+    in the scope of the namespace declarations in nsmap
+    '''
+    key = (name, tuple(sorted(nsmap.items())))
+    if key not in self.expansions:
+      nsdecls = ''
+      for (prefix, uri) in sorted(nsmap.items()):
+        if prefix:
+          nsdecls += ' xmlns:' + prefix + '="' + uri + '"'
+        else:
+          nsdecls += ' xmlns="' + uri + '"'
+      content = '<!DOCTYPE wrapper [\n'
+      content += '<!ENTITY % BOOK_ENTITIES SYSTEM "' + self.entityFile + '">\n'
+      content += '%BOOK_ENTITIES;\n'
+      content += ']>\n'
+      content += '<wrapper' + nsdecls + '>&' + name + ';</wrapper>'
+      try:
+        self.expansions[key] = parse_xml_string(content)
+      except etree.XMLSyntaxError:
+        raise Exception('Entity \'' + name + '\' is not defined in ' + self.entityFile)
+    return self.expansions[key]
+
+  def in_attributes(self,filenames):
+    '''
+    Return True, if any of the files contains an entity reference in an attribute value.
+    lxml does not expose the entity references in attribute values, so expand() cannot
+    expand them: a document parsed from such files must be reparsed with entities resolved.
+    '''
+    for filename in filenames:
+      if self.ATTRIBUTE_ENTITY.search(fileResolver.read(filename)):
+        return True
+    return False
+
+  def expand(self,root):
+    '''
+    Replace every entity reference under root by its expansion (in place),
+    except the entity references in attribute values (see in_attributes())
+    '''
+    textExpansions = self.textExpansions
+    for entity in list(root.iter(etree.Entity)):
+      parent = entity.getparent()
+      name = entity.name
+      if name in textExpansions:
+        children = []
+        text = textExpansions[name] + (entity.tail or '')
+      elif len(self.expansion(name)):
+        # The expansion contains elements, which must be created in the right namespace
+        wrapper = self.expansion(name, parent.nsmap)
+        children = [copy.deepcopy(child) for child in wrapper]
+        children[-1].tail = (children[-1].tail or '') + (entity.tail or '')
+        text = wrapper.text or ''
+      else:
+        textExpansions[name] = self.expansion(name).text or ''
+        children = []
+        text = textExpansions[name] + (entity.tail or '')
+      previous = entity.getprevious()
+      if previous is not None:
+        previous.tail = (previous.tail or '') + text
+      else:
+        parent.text = (parent.text or '') + text
+      if children:
+        index = parent.index(entity)
+        for child in reversed(children):
+          parent.insert(index + 1, child)
+      parent.remove(entity)
+
+def is_excluded(condition,conditionSet):
+  '''
+  Return True, if the condition attribute value does not match any of the profile conditions in conditionSet
+  '''
+  if (not condition) or (not conditionSet):
+    return False
+  for value in condition.split(';'):
+    if value.strip() in conditionSet:
+      return False
+  return True
+
 def extract_title(el):
   if el.tag.endswith('info'):
     # *info topics are a special case - define a placeholder title
@@ -38,6 +220,22 @@ def extract_title(el):
   
 
 class SibinContext:
+  # The helpers and caches that are created on first use (see __getattr__), so that each
+  # sub-command imports and initializes only what it needs: attribute -> (module, class)
+  LAZY_ATTRIBUTES = {
+    'transformer' : ('sibin.xml', 'XMLTransformer'),
+    'fragmentCache' : ('sibin.cache', 'FragmentCache'),
+    'olinkRecords' : ('sibin.cache', 'OlinkRecords'),
+    'dependencyIndex' : ('sibin.cache', 'DependencyIndex'),
+    'linkIndexCache' : ('sibin.cache', 'LinkIndexCache'),
+    'bookCatalog' : ('sibin.cache', 'BookCatalog'),
+    'validationResults' : ('sibin.cache', 'ValidationResults'),
+    'buildHistory' : ('sibin.cache', 'BuildHistory'),
+    'diskCollector' : ('sibin.disk', 'DiskCollector'),
+    'templateCache' : ('sibin.template', 'TemplateCache'),
+    'imageOptimizer' : ('sibin.images', 'ImageOptimizer')
+  }
+
   def __init__(self):
     # list of all DB book files,
     # where dirs are specified relative to top level dir
@@ -68,8 +266,6 @@ class SibinContext:
     self.buildversion = ''
     # Selects the current effective profile
     self.currentProfile = 'default'
-    # XML transformer instance
-    self.transformer = None
     # Optional commit comment
     self.comment = ''
     # Contains the data for cross-referencing images and topics across the whole library
@@ -78,10 +274,35 @@ class SibinContext:
     self.bookEntitiesFile = 'Library.ent'
     # File extensions used to identify image files
     self.imageFileExtList = ['.gif', '.jpg', '.svg', '.png']
+    # Directory where sibin keeps its persistent caches, relative to top level dir
+    self.cacheDir = '.sibin'
+    # If True, sibin removes content excluded by the profile conditions itself
+    self.filterConditions = False
+    # The schema (RELAX NG, DTD, or W3C XML Schema) used to validate the books
+    self.schemaFile = ''
+    # Where the source files of the library are read from (the working directory, or a git commit)
+    self.sourceTree = sibin.source.WorkingTree()
+    # Directory where the generated books are written (under a directory named after the profile)
+    self.outputDir = ''
     return
   
+  def __getattr__(self,name):
+    '''
+    Create the helper or cache 'name' (one of LAZY_ATTRIBUTES, or the git utility) on first use
+    '''
+    if name == 'git':
+      import sibin.git
+      self.git = sibin.git.GitUtility('.')
+      return self.git
+    if name not in SibinContext.LAZY_ATTRIBUTES:
+      raise AttributeError(name)
+    (moduleName, className) = SibinContext.LAZY_ATTRIBUTES[name]
+    value = getattr(importlib.import_module(moduleName), className)(self)
+    setattr(self, name, value)
+    return value
+
   def initializeFromFile(self,filename):
-    doc = etree.parse(filename)
+    doc = parse_xml(filename)
     root = doc.getroot()
     product = root.find('product')
     if product is not None:
@@ -94,7 +315,8 @@ class SibinContext:
         self.sortorder[book.get('file')] = book.get('sortorder')
       if book.get('localize'):
         self.localizedbooks.append(book.get('file'))
-      publicanprops = {}
+      # Preserve the order of the properties, as they are written into publican.cfg
+      publicanprops = collections.OrderedDict()
       for publicanprop in book.iter('publicanprop'):
         propname  = publicanprop.get('name')
         propvalue = publicanprop.get('value')
@@ -104,6 +326,8 @@ class SibinContext:
         self.book2publicanprops[book.get('file')] = publicanprops
     for entities in root.xpath('/context/entities'):
       self.bookEntitiesFile = entities.get('file')
+    for schema in root.xpath('/context/schema'):
+      self.schemaFile = schema.get('file')
     for profile in root.xpath('/context/profiles/profile'):
       profilename = profile.get('name')
       self.profiles.append(profilename)
@@ -119,7 +343,41 @@ class SibinContext:
       if template is not None:
         self.templates[profilename] = template.get('dir')
     del doc
-  
+
+  def export_config(self):
+    '''
+    Return the settings read from sibin.cfg, as a dictionary of plain values
+    (which can be serialized with marshal)
+    '''
+    book2publicanprops = {}
+    for bookFile in self.book2publicanprops:
+      book2publicanprops[bookFile] = self.book2publicanprops[bookFile].items()
+    return {
+      'bookFiles' : self.bookFiles,
+      'sortorder' : self.sortorder,
+      'localizedbooks' : self.localizedbooks,
+      'book2publicanprops' : book2publicanprops,
+      'profiles' : self.profiles,
+      'conditions' : self.conditions,
+      'hostnames' : self.hostnames,
+      'templates' : self.templates,
+      'productname' : self.productname,
+      'productversion' : self.productversion,
+      'buildversion' : self.buildversion,
+      'bookEntitiesFile' : self.bookEntitiesFile,
+      'schemaFile' : self.schemaFile
+    }
+
+  def import_config(self,config):
+    '''
+    Restore the settings returned by export_config()
+    '''
+    for name in config:
+      setattr(self, name, config[name])
+    self.book2publicanprops = {}
+    for bookFile in config['book2publicanprops']:
+      self.book2publicanprops[bookFile] = collections.OrderedDict(config['book2publicanprops'][bookFile])
+
   def gethostname(self):
     return self.hostnames[self.currentProfile]
 
@@ -129,6 +387,9 @@ class SibinContext:
   def getconditions(self):
     return self.conditions[self.currentProfile]
 
+  def getconditionset(self):
+    return set([condition for condition in self.getconditions().split(';') if condition])
+
 
 class Book:
   def __init__(self,filename=''):
@@ -149,7 +410,7 @@ class BookParser:
     else:
       self.bookFile = self.book.filename
     print 'Parsing book: ' + self.bookFile
-    self.doc = etree.parse(self.bookFile)
+    self.doc = parse_xml(self.bookFile)
     self.doc.xinclude()
     self.root = self.doc.getroot()
     if not self.root.tag.endswith('book'):
@@ -212,80 +473,179 @@ class BookParser:
       self._parse_for_linkdata(ld, child, pageId)
 
 
+class LinkTarget(object):
+  '''
+  A compact record of one link target (an element with an xml:id) in one book.
+  Targets with the same xml:id in different books are chained through 'next'.
+  '''
+  __slots__ = ('bookIndex', 'tag', 'title', 'pageId', 'next')
+
+  def __init__(self,bookIndex,tag,title,pageId,next=None):
+    self.bookIndex = bookIndex
+    self.tag = tag
+    self.title = title
+    self.pageId = pageId
+    self.next = next
+
+
 class LinkData:
   def __init__(self,context):
     if not isinstance(context,SibinContext):
       raise Exception('LinkData must be initialized with a SibinContext argument')
     self.context = context
+    # Maps each xml:id to the LinkTarget (or chain of LinkTargets) that defines it
     self.XmlId2Target = {}
+    # The book table: LinkTarget.bookIndex is an index into this list
+    self.books = []
+    self.bookId2Index = {}
+    # Shared copies of the strings that recur in many targets (tag names and page IDs)
+    self.strings = {}
     return
-  
+
+  def _intern(self,value):
+    return self.strings.setdefault(value, value)
+
+  def _book_index(self,book):
+    bookIndex = self.bookId2Index.get(book.id)
+    if bookIndex is None:
+      bookIndex = len(self.books)
+      self.bookId2Index[book.id] = bookIndex
+      self.books.append(book)
+    else:
+      self.books[bookIndex] = book
+    return bookIndex
+
   def addLinkData(self, book, elementTag, xmlId='', title='', pageId=''):
     # pageId is the xml:id of the ancestor element that ultimately gets rendered as a HTML page
-    topicTuple = (book,elementTag,xmlId,title,pageId)
     if xmlId:
-      if xmlId not in self.XmlId2Target:
-        self.XmlId2Target[xmlId] = { book.id:topicTuple }
-      else:
-        self.XmlId2Target[xmlId][book.id] = topicTuple
+      bookIndex = self._book_index(book)
+      elementTag = self._intern(elementTag)
+      pageId = self._intern(pageId)
+      first = self.XmlId2Target.get(xmlId)
+      target = first
+      while target is not None:
+        if target.bookIndex == bookIndex:
+          target.tag = elementTag
+          target.title = title
+          target.pageId = pageId
+          return
+        target = target.next
+      self.XmlId2Target[xmlId] = LinkTarget(bookIndex, elementTag, title, pageId, first)
     return
-  
+
+  def targets(self,xmlId):
+    '''
+    Return the list of (book, target) pairs for the specified xml:id, sorted by book ID
+    '''
+    pairs = []
+    target = self.XmlId2Target.get(xmlId)
+    while target is not None:
+      pairs.append((self.books[target.bookIndex], target))
+      target = target.next
+    pairs.sort(key=lambda pair: pair[0].id)
+    return pairs
+
+  def find(self,targetdoc,targetptr):
+    '''
+    Return the target of the olink (targetdoc, targetptr), or None if there is no such target
+    '''
+    target = self.XmlId2Target.get(targetptr)
+    while target is not None:
+      if self.books[target.bookIndex].id == targetdoc:
+        return target
+      target = target.next
+    return None
+
+  def export_index(self):
+    '''
+    Return the link data as a JSON-serializable dictionary, consisting of a table of books
+    and a map from each xml:id to the list of its [bookIndex, tag, title, pageId] entries
+    '''
+    books = []
+    book2index = {}
+    targets = {}
+    for xmlId in sorted(self.XmlId2Target):
+      entries = []
+      for (book, target) in self.targets(xmlId):
+        if book.id not in book2index:
+          book2index[book.id] = len(books)
+          books.append({ 'file' : getattr(book, 'filename', ''), 'id' : book.id, 'title' : book.title })
+        entries.append([book2index[book.id], target.tag, target.title, target.pageId])
+      targets[xmlId] = entries
+    return { 'books' : books, 'targets' : targets }
+
+  def import_index(self,index):
+    '''
+    Add the link data from a dictionary in the format returned by export_index()
+    '''
+    books = []
+    for entry in index['books']:
+      book = Book(entry['file'])
+      book.id = entry['id']
+      book.title = entry['title']
+      books.append(book)
+    for xmlId in index['targets']:
+      for (bookIndex, elementTag, title, pageId) in index['targets'][xmlId]:
+        self.addLinkData(books[bookIndex], elementTag, xmlId, title, pageId)
+
+  def _warn_missing_book(self,targetdoc,targetptr,location):
+    # TODO Might be better to add an option that specifies whether or
+    # not to ignore this warning (current default is to ignore).
+    # A legitimate reason for ignoring is when the broken link is
+    # inside a condition that will NOT be included in the book.
+    sibin.diagnostics.collector.warn('olink-missing-book', location, targetdoc, targetptr)
+
   def getolinktext(self,targetdoc,targetptr):
-    if not self.XmlId2Target.has_key(targetptr):
+    if targetptr not in self.XmlId2Target:
       return ''
-    bookId2Tuple = self.XmlId2Target[targetptr]
-    if bookId2Tuple:
-      if targetdoc not in bookId2Tuple:
-        print 'WARNING: <olink targetdoc="' + targetdoc + '" targetptr="' + targetptr + '/>',
-        print 'references a non-existent book ID: ' + targetdoc
-        print '    The book ID might be obsolete or you might have forgotten to add all of the',
-        print 'relevant books to your sibin.cfg file.'
-        # TODO Might be better to add an option that specifies whether or
-        # not to ignore this warning (current default is to ignore).
-        # A legitimate reason for ignoring is when the broken link is
-        # inside a condition that will NOT be included in the book.
-        return ''
-      topicTuple = bookId2Tuple[targetdoc]
-      if topicTuple:
-        bookTitle = topicTuple[0].title
-        sectionTitle = topicTuple[3]
-        if targetdoc==targetptr:
-          return '"' + bookTitle + '"'
-        else:
-          thingName = 'section'
-          tagname = topicTuple[1]
-          if tagname in ['part', 'chapter', 'appendix', 'example', 'figure']:
-            thingName = tagname
-          return thingName + ' "' + sectionTitle + '" in "' + bookTitle + '"'
-    return ''
+    target = self.find(targetdoc,targetptr)
+    if target is None:
+      # Reported by olink2url(), which is called for every olink
+      return ''
+    bookTitle = self.books[target.bookIndex].title
+    sectionTitle = target.title
+    if targetdoc==targetptr:
+      return '"' + bookTitle + '"'
+    else:
+      thingName = 'section'
+      tagname = target.tag
+      if tagname in ['part', 'chapter', 'appendix', 'example', 'figure']:
+        thingName = tagname
+      return thingName + ' "' + sectionTitle + '" in "' + bookTitle + '"'
 
-  def olink2url(self,targetdoc,targetptr):
-    if not self.XmlId2Target.has_key(targetptr):
+  def olink2url(self,targetdoc,targetptr,location=''):
+    if targetptr not in self.XmlId2Target:
       return ''
-    bookId2Tuple = self.XmlId2Target[targetptr]
-    if bookId2Tuple:
-      if targetdoc not in bookId2Tuple:
-        print 'WARNING: <olink targetdoc="' + targetdoc + '" targetptr="' + targetptr + '/>',
-        print 'references a non-existent book ID: ' + targetdoc
-        print '    The book ID might be obsolete or you might have forgotten to add all of the',
-        print 'relevant books to your sibin.cfg file.'
-        # TODO Might be better to add an option that specifies whether or
-        # not to ignore this warning (current default is to ignore).
-        # A legitimate reason for ignoring is when the broken link is
-        # inside a condition that will NOT be included in the book.
-        return ''
-      topicTuple = bookId2Tuple[targetdoc]
-      # Brew and Pantheon are now unified to use 'publican' style URLs
-      return self._olink2url_publican(targetdoc, targetptr, topicTuple)
-    return ''
+    target = self.find(targetdoc,targetptr)
+    if target is None:
+      self._warn_missing_book(targetdoc,targetptr,location)
+      return ''
+    # Brew and Pantheon are now unified to use 'publican' style URLs
+    return self._olink2url_publican(targetdoc, targetptr, target)
+
+  def target_digest(self,targetdoc,targetptr):
+    '''
+    Return a digest of everything that olink2url() and getolinktext() depend on
+    for the specified olink target, without printing any warnings
+    '''
+    # The host is only needed (and only has to be configured) for the olinks that resolve
+    answer = [self.context.hostnames.get(self.context.currentProfile, ''), self.context.productname, self.context.productversion]
+    target = self.find(targetdoc,targetptr)
+    if targetptr not in self.XmlId2Target:
+      answer.append('no such targetptr')
+    elif target is None:
+      answer.append('no such targetdoc')
+    else:
+      answer += [self.books[target.bookIndex].title, target.tag, target.title, target.pageId]
+    return hashlib.sha1('\0'.join(answer).encode('utf-8')).hexdigest()
 
-  def _olink2url_publican(self,targetdoc,targetptr,topicTuple):
-    if topicTuple:
+  def _olink2url_publican(self,targetdoc,targetptr,target):
+    if target:
       baseUrl = self.context.gethostname()
-      bookTitle = topicTuple[0].title.replace(' ','_')
+      bookTitle = self.books[target.bookIndex].title.replace(' ','_')
       prodName  = self.context.productname.replace(' ','_')
       version   = self.context.productversion
-      pageId    = topicTuple[4]
+      pageId    = target.pageId
       if pageId:
         if pageId==targetptr:
           pageRef = pageId + '.html'
@@ -299,11 +659,11 @@ class LinkData:
       return ''
 
   # OBSELETE - Since Docs 2.0, URLs reverted to legacy Publican format
-  def _olink2url_pantheon(self,targetdoc,targetptr,topicTuple):
+  def _olink2url_pantheon(self,targetdoc,targetptr,target):
     # Convert olink to Pantheon's single HTML URL format
-    if topicTuple:
+    if target:
       baseUrl = self.context.gethostname()
-      bookTitle = topicTuple[0].title.lower().replace(' ','-')
+      bookTitle = self.books[target.bookIndex].title.lower().replace(' ','-')
       prodName  = self.context.productname.lower().replace(' ','-')
       version   = self.context.productversion
       resultUrl = baseUrl + '/en/' + prodName + '/' + version + '/single/' + bookTitle
@@ -314,11 +674,11 @@ class LinkData:
       return ''
 
   def __str__(self):
-    print 'XmlId2Target = {'
-    for xmlId in self.XmlId2Target.keys():
-      print '  xmlId = ' + xmlId + ' {'
-      entries = self.XmlId2Target[xmlId]
-      for bookId in entries.keys():
-        print '    ' , entries[bookId]
-      print '  }'
-    print '}'
+    lines = ['XmlId2Target = {']
+    for xmlId in sorted(self.XmlId2Target):
+      lines.append('  xmlId = ' + xmlId + ' {')
+      for (book, target) in self.targets(xmlId):
+        lines.append('    ' + repr((book.id, target.tag, target.title, target.pageId)))
+      lines.append('  }')
+    lines.append('}')
+    return '\n'.join(lines)
@@ -0,0 +1,146 @@
+import contextlib
+import json
+
+# The message template and (optional) hint of each diagnostic code.
+# The template is formatted with the arguments passed to warn(), when the diagnostics are reported.
+CODES = {
+  'olink-missing-book' : (
+    '<olink targetdoc="{0}" targetptr="{1}"/> references a non-existent book ID: {0}',
+    'The book ID might be obsolete or you might have forgotten to add all of the relevant books to your sibin.cfg file.'
+  ),
+  'generated-book-missing' : (
+    'Generated book directory does not exist: {0}',
+    'Generate the book (sibin gen) before building it.'
+  ),
+  'generated-book-regenerated' : (
+    'Generated book directory does not exist, regenerating the book: {0}',
+    None
+  ),
+  'build-restored' : (
+    'Restoring after aborted build. Will only build the books not built last time around.',
+    None
+  ),
+  'kerberos-ticket-missing' : (
+    'No Kerberos ticket detected. Please run kinit',
+    None
+  ),
+  'disk-budget-exceeded' : (
+    'Could not reduce disk usage below the budget of {0}: {1} remain in use',
+    'The remaining space is used by caches that are never evicted. Specify a larger budget.'
+  )
+}
+
+# The maximum number of distinct warnings listed for each code in the summary
+SUMMARY_LIMIT = 20
+
+
+class DiagnosticsCollector:
+  '''
+  Collects the warnings of one sibin run. Each distinct warning (code, location, and message arguments)
+  is recorded once, with the number of times it occurred, and the warnings are reported at the end of
+  the run, as a summary on the console and, optionally, as a JSON report
+  '''
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    # Maps (code, location, args) to the number of occurrences
+    self.warnings = {}
+    # The dictionaries currently recording warnings (see recording())
+    self.recorders = []
+
+  def warn(self,code,location,*args):
+    '''
+    Record one occurrence of the warning code at location (typically a file name). The message
+    is not formatted until the warnings are reported, so that recording a warning is cheap
+    '''
+    key = (code, location, args)
+    self.warnings[key] = self.warnings.get(key, 0) + 1
+    for recorder in self.recorders:
+      recorder[key] = recorder.get(key, 0) + 1
+
+  @contextlib.contextmanager
+  def recording(self):
+    '''
+    A context manager that yields a dictionary, in which the warnings recorded in its body are also counted,
+    so that they can be cached together with the result they were found in (see export() and replay())
+    '''
+    recorder = {}
+    self.recorders.append(recorder)
+    try:
+      yield recorder
+    finally:
+      self.recorders.remove(recorder)
+
+  def export(self,recorder):
+    '''
+    Return the warnings counted in recorder as a JSON-serializable list of [code, location, args, count] entries
+    '''
+    return [[code, location, list(args), count] for ((code, location, args), count) in sorted(recorder.items())]
+
+  def replay(self,entries):
+    '''
+    Record again the warnings in a list returned by export() (for example, for a result taken from a cache)
+    '''
+    for (code, location, args, count) in entries:
+      key = (code, location, tuple(args))
+      self.warnings[key] = self.warnings.get(key, 0) + count
+      for recorder in self.recorders:
+        recorder[key] = recorder.get(key, 0) + count
+
+  def snapshot(self):
+    '''
+    Return the collected warnings in a form that can be sent to another process
+    '''
+    return self.warnings.items()
+
+  def merge(self,snapshot):
+    '''
+    Add the warnings from the snapshot of another (child) process
+    '''
+    for (key, count) in snapshot:
+      self.warnings[key] = self.warnings.get(key, 0) + count
+
+  def entries(self):
+    '''
+    Return the list of (code, location, message, count) entries, sorted by code and location
+    '''
+    entries = []
+    for ((code, location, args), count) in sorted(self.warnings.items()):
+      entries.append((code, location, CODES[code][0].format(*args), count))
+    return entries
+
+  def print_summary(self,reportFile=None):
+    if not self.warnings:
+      return
+    entries = self.entries()
+    print 'Warnings: ' + str(len(entries)) + ' distinct, ' + str(sum([entry[3] for entry in entries])) + ' occurrences'
+    codes = sorted(set([entry[0] for entry in entries]))
+    for code in codes:
+      codeEntries = [entry for entry in entries if entry[0] == code]
+      print '  ' + code + ' (' + str(len(codeEntries)) + ' distinct)'
+      for (code, location, message, count) in codeEntries[:SUMMARY_LIMIT]:
+        if location:
+          message = location + ': ' + message
+        print '    ' + message + ' (x' + str(count) + ')'
+      if len(codeEntries) > SUMMARY_LIMIT:
+        if reportFile:
+          print '    ... and ' + str(len(codeEntries) - SUMMARY_LIMIT) + ' more (see ' + reportFile + ')'
+        else:
+          print '    ... and ' + str(len(codeEntries) - SUMMARY_LIMIT) + ' more (use --diagnostics to write them all to a file)'
+      if CODES[code][1]:
+        print '    ' + CODES[code][1]
+
+  def to_json(self):
+    warnings = []
+    for (code, location, message, count) in self.entries():
+      warnings.append({ 'code' : code, 'location' : location, 'message' : message, 'count' : count })
+    return json.dumps({ 'warnings' : warnings }, sort_keys=True, indent=1)
+
+  def write(self,filename):
+    import sibin.cache
+    sibin.cache.atomic_write(filename, self.to_json())
+
+# The diagnostics of the current run
+collector = DiagnosticsCollector()
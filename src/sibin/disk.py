@@ -0,0 +1,237 @@
+import sibin.core
+import sibin.diagnostics
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+
+# The output directories of the 'preview' command (and of 'gen --at'), which can be regenerated.
+# The 'zip' directory is not one of them: it holds the archives the user asked for.
+OUTPUT_DIRS = ['preview', 'at']
+
+# The suffixes of the per-book entries in the fragment, olink, and archive caches
+CACHE_SUFFIXES = ['.json', '.zip', '.tar.gz']
+
+def cache_entry_book_root(entry):
+  '''
+  Return the book root of a per-book cache entry (for example, BookA for BookA.tar.gz.json),
+  stripping only the cache suffixes, so that book names containing dots are kept whole
+  '''
+  stripped = True
+  while stripped:
+    stripped = False
+    for suffix in CACHE_SUFFIXES:
+      if entry.endswith(suffix):
+        entry = entry[:-len(suffix)]
+        stripped = True
+  return entry
+
+def parse_size(spec):
+  '''
+  Parse a disk size, given either as a number of bytes or with one of the suffixes K, M, G, or T
+  (for example, '500M' or '2G'), returning the number of bytes
+  '''
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', spec, re.IGNORECASE)
+  if not match:
+    raise Exception('Invalid disk size (expected, for example, 500M or 2G): ' + spec)
+  multiplier = { '' : 1, 'K' : 1024, 'M' : 1024**2, 'G' : 1024**3, 'T' : 1024**4 }[match.group(2).upper()]
+  return int(float(match.group(1)) * multiplier)
+
+def format_size(size):
+  for unit in ['bytes', 'KB', 'MB', 'GB']:
+    if size < 1024 or unit == 'GB':
+      break
+    size = size / 1024.0
+  if unit == 'bytes':
+    return str(size) + ' bytes'
+  return '%.1f %s' % (size, unit)
+
+def tree_usage(path):
+  '''
+  Return the pair (size, lastUsed) for the file or directory tree at path, where size is
+  the total size of its files in bytes and lastUsed is the most recent modification time
+  '''
+  if not os.path.exists(path):
+    return (0, 0)
+  st = os.lstat(path)
+  if not os.path.isdir(path):
+    return (st.st_size, st.st_mtime)
+  size = 0
+  lastUsed = st.st_mtime
+  for (dirpath, dirnames, filenames) in os.walk(path):
+    for filename in filenames:
+      st = os.lstat(os.path.join(dirpath, filename))
+      size += st.st_size
+      lastUsed = max(lastUsed, st.st_mtime)
+  return (size, lastUsed)
+
+
+class DiskCollector:
+  '''
+  Removes orphaned and least recently used generated trees and caches. Trees are
+  discarded by renaming them into the <cacheDir>/trash directory, which is
+  then emptied by a background process.
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('DiskCollector must be initialized with a SibinContext argument')
+    self.context = context
+    self.trashDir = os.path.join(context.cacheDir, 'trash')
+    self.trashed = []
+
+  def discard(self,path):
+    '''
+    Remove the file or directory tree at path, quickly, by moving it into the trash directory.
+    The actual deletion happens later, in the background (see purge()).
+    '''
+    if not os.path.exists(path):
+      return
+    if not os.path.exists(self.trashDir):
+      os.makedirs(self.trashDir)
+    trashPath = os.path.join(self.trashDir, os.path.basename(os.path.normpath(path)) + '.' + str(os.getpid()) + '.' + str(len(self.trashed)))
+    try:
+      os.rename(path, trashPath)
+    except OSError:
+      # For example, if path is on a different file system from the trash directory
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      else:
+        os.unlink(path)
+      return
+    self.trashed.append(trashPath)
+
+  def purge(self):
+    '''
+    Start a background process that deletes everything in the trash directory
+    (including anything left over from an earlier, interrupted deletion)
+    '''
+    if not os.path.exists(self.trashDir):
+      return
+    trashPaths = [os.path.join(self.trashDir, entry) for entry in sorted(os.listdir(self.trashDir))]
+    if not trashPaths:
+      return
+    script = 'import shutil, sys\nfor path in sys.argv[1:]:\n  shutil.rmtree(path, True)\n'
+    subprocess.Popen([sys.executable, '-c', script] + trashPaths, close_fds=True)
+    self.trashed = []
+
+  def book_roots(self):
+    bookRoots = set()
+    for bookFile in self.context.bookFiles:
+      (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+      bookRoots.add(bookRoot)
+    return bookRoots
+
+  def orphans(self):
+    '''
+    Return the list of generated book directories and cache entries that belong to
+    books (or profiles) that are no longer listed in sibin.cfg
+    '''
+    bookRoots = self.book_roots()
+    orphanList = []
+    for profile in self.context.profiles:
+      if os.path.isdir(profile):
+        for entry in sorted(os.listdir(profile)):
+          path = os.path.join(profile, entry)
+          # Only directories that look like generated books are candidates
+          if entry not in bookRoots and os.path.exists(os.path.join(path, 'publican.cfg')):
+            orphanList.append(path)
+    for cacheName in ['fragments', 'olinks', 'archive']:
+      cacheDir = os.path.join(self.context.cacheDir, cacheName)
+      if not os.path.isdir(cacheDir):
+        continue
+      for profile in sorted(os.listdir(cacheDir)):
+        profileDir = os.path.join(cacheDir, profile)
+        if profile not in self.context.profiles:
+          orphanList.append(profileDir)
+          continue
+        for entry in sorted(os.listdir(profileDir)):
+          if cache_entry_book_root(entry) not in bookRoots:
+            orphanList.append(os.path.join(profileDir, entry))
+    for cacheName in ['links', 'books', 'history']:
+      cacheDir = os.path.join(self.context.cacheDir, cacheName)
+      if not os.path.isdir(cacheDir):
+        continue
+      for entry in sorted(os.listdir(cacheDir)):
+        if os.path.splitext(entry)[0] not in bookRoots:
+          orphanList.append(os.path.join(cacheDir, entry))
+    return orphanList
+
+  def usage(self):
+    '''
+    Return the total size of the generated trees, build outputs, and caches
+    '''
+    total = 0
+    for path in self.context.profiles + [self.context.cacheDir] + OUTPUT_DIRS:
+      total += tree_usage(path)[0]
+    total -= tree_usage(self.trashDir)[0]
+    return total
+
+  def eviction_candidates(self):
+    '''
+    Return the candidates for eviction, as a list of (lastUsed, size, path) tuples, in
+    two tiers: first the build outputs (which are the cheapest to recreate), then the
+    generated books, their fragment caches, the optimized image cache, and the caches of 'gen --at'.
+    Each tier is sorted from least to most recently used.
+    '''
+    buildOutputs = []
+    generated = []
+    bookRoots = self.book_roots()
+    for outputDir in OUTPUT_DIRS:
+      (size, lastUsed) = tree_usage(outputDir)
+      if size:
+        buildOutputs.append((lastUsed, size, outputDir))
+    for profile in self.context.profiles:
+      for bookRoot in sorted(bookRoots):
+        genbookdir = os.path.join(profile, bookRoot)
+        if not os.path.isdir(genbookdir):
+          continue
+        tmpdir = os.path.join(genbookdir, 'tmp')
+        (tmpSize, tmpLastUsed) = tree_usage(tmpdir)
+        if tmpSize:
+          buildOutputs.append((tmpLastUsed, tmpSize, tmpdir))
+        (size, lastUsed) = tree_usage(genbookdir)
+        generated.append((lastUsed, size - tmpSize, genbookdir))
+        fragmentdir = os.path.join(self.context.cacheDir, 'fragments', profile, bookRoot)
+        (size, lastUsed) = tree_usage(fragmentdir)
+        if size:
+          generated.append((lastUsed, size, fragmentdir))
+    for cacheName in ['images', 'at']:
+      (size, lastUsed) = tree_usage(os.path.join(self.context.cacheDir, cacheName))
+      if size:
+        generated.append((lastUsed, size, os.path.join(self.context.cacheDir, cacheName)))
+    return sorted(buildOutputs) + sorted(generated)
+
+  def collect(self,budget=None,dryRun=False):
+    '''
+    Discard all orphans and then, if a budget (in bytes) is specified, discard the least
+    recently used candidates until the total disk usage is within the budget.
+    Returns the list of discarded paths.
+    '''
+    discarded = []
+    for path in self.orphans():
+      print 'Removing orphan: ' + path
+      discarded.append(path)
+      if not dryRun:
+        self.discard(path)
+    if budget is not None:
+      total = self.usage()
+      if dryRun:
+        for path in discarded:
+          total -= tree_usage(path)[0]
+      print 'Disk usage: ' + format_size(total) + ' (budget ' + format_size(budget) + ')'
+      for (lastUsed, size, path) in self.eviction_candidates():
+        if total <= budget:
+          break
+        print 'Evicting: ' + path + ' (' + format_size(size) + ')'
+        discarded.append(path)
+        total -= size
+        if not dryRun:
+          self.discard(path)
+      if total > budget:
+        sibin.diagnostics.collector.warn('disk-budget-exceeded', '', format_size(budget), format_size(total))
+    if not dryRun:
+      self.purge()
+    return discarded
@@ -4,6 +4,7 @@ Created on Dec 17, 2013
 @author: fbolton
 '''
 
+import sibin.metrics
 import glob
 import subprocess
 import os.path
@@ -22,12 +23,23 @@ class GitUtility:
       self.root = root
     else:
       self.root = os.path.normpath(os.path.join(os.getcwd(),root))
+    # The persistent 'git cat-file --batch' process, and the ID of the process that started it
+    self.catFileProcess = None
+    self.catFilePid = None
+
+  def _check_call(self,args):
+    sibin.metrics.collector.count('sibin_subprocess_total', tool='git')
+    subprocess.check_call(args)
+
+  def _check_output(self,args):
+    sibin.metrics.collector.count('sibin_subprocess_total', tool='git')
+    return subprocess.check_output(args)
 
   def init(self):
     '''
     Creates a new (empty) git repository
     '''
-    subprocess.check_call(['git', 'init'])
+    self._check_call(['git', 'init'])
     
   def append_message(self,message):
     if self.commitMessage:
@@ -41,7 +53,7 @@ class GitUtility:
     '''
     if isinstance(filesOrDirs, str):
       filesOrDirs = [filesOrDirs]
-    subprocess.check_call(['git', 'add'] + filesOrDirs)
+    self._check_call(['git', 'add'] + filesOrDirs)
   
   def add_globs(self,globList=[]):
     '''
@@ -59,9 +71,9 @@ class GitUtility:
     if not comment:
       comment = self.commitMessage
       self.commitMessage = ''
-    subprocess.check_call(['git', 'commit', '-m', comment])
+    self._check_call(['git', 'commit', '-m', comment])
     # Consult the git log to get the SHA of that last commit
-    commit = subprocess.check_output(['git', 'log', '-n', '1', '--pretty=format:%H'])
+    commit = self._check_output(['git', 'log', '-n', '1', '--pretty=format:%H'])
     return commit
   
   def diff_tree(self,commit1,commit2,deletedFileSet,modifiedFileSet,addedFileSet):
@@ -71,7 +83,7 @@ class GitUtility:
       modifiedFileSet - set of files modified since the earlier commit
       addedFileSet    - set of files added since the earlier commit
     '''
-    diffstring = subprocess.check_output(['git', 'diff-tree', '-r', commit1, commit2])
+    diffstring = self._check_output(['git', 'diff-tree', '-r', commit1, commit2])
     if not diffstring:  return
     for diffline in diffstring.split('\n'):
       if not diffline: continue
@@ -85,21 +97,60 @@ class GitUtility:
         elif status == 'A':
           addedFileSet.add(filename)
   
+  def prefix(self):
+    '''
+    Return the path of the current working directory relative to the top of the git repo,
+    with a trailing slash (or the empty string, if we are at the top of the repo)
+    '''
+    return self._check_output(['git', 'rev-parse', '--show-prefix']).strip()
+
   def show(self,commit,filename):
     '''
     Return the contents of 'filename' as it was in the 'commit' revision.
     Where 'commit' is the SHA hash of the requested revision and
     'filename' is the relative filename of the requested file in the git repo.
     '''
-    blobContents = subprocess.check_output(['git', 'show', commit + ':' + filename])
+    blobContents = self._check_output(['git', 'show', commit + ':' + filename])
     return blobContents
   
-  def mod_time(self,filename):
+  def rev_parse(self,revision):
+    '''
+    Return the SHA hash of the specified revision
+    '''
+    try:
+      return self._check_output(['git', 'rev-parse', '--verify', '--quiet', revision]).strip()
+    except subprocess.CalledProcessError:
+      return None
+
+  def cat_file(self,objectName):
+    '''
+    Return the contents of the specified object (for example, '<sha>' or '<commit>:<path>'),
+    or None, if there is no such object. All of the objects are read through one
+    persistent 'git cat-file --batch' process.
+    '''
+    if self.catFilePid != os.getpid():
+      # Start a new process (also in a forked child, which must not share the parent's pipes)
+      sibin.metrics.collector.count('sibin_subprocess_total', tool='git')
+      self.catFileProcess = subprocess.Popen(['git', 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      self.catFilePid = os.getpid()
+    process = self.catFileProcess
+    process.stdin.write(objectName + '\n')
+    process.stdin.flush()
+    header = process.stdout.readline().split()
+    if len(header) != 3:
+      # '<objectName> missing'
+      return None
+    content = process.stdout.read(int(header[2]))
+    # Skip the newline that follows the contents
+    process.stdout.read(1)
+    return content
+
+  def mod_time(self,filename,revision='HEAD'):
     '''
-    Get the last modification time of 'filename', according to the commit log.
+    Get the last modification time of 'filename', according to the commit log (up to 'revision').
     Time is returned as UNIX time (number of seconds since 1970, I think).
     '''
-    unixtime = subprocess.check_output(['git', 'log', '-1', '--format=%ct', filename])
+    unixtime = self._check_output(['git', 'log', '-1', '--format=%ct', revision, '--', filename])
     if not unixtime:
       # If unixtime is empty, it probably means that 'filename' is in a submodule,
       # so we switch to the subdirectory and retry the git log command.
@@ -107,7 +158,7 @@ class GitUtility:
         (subdir, subfilename) = filename.split(os.sep, 1)
         cwd = os.getcwd()
         os.chdir(subdir)
-        unixtime = subprocess.check_output(['git', 'log', '-1', '--format=%ct', subfilename])
+        unixtime = self._check_output(['git', 'log', '-1', '--format=%ct', subfilename])
         os.chdir(cwd)
         # print 'In submodule ' + subdir + ': for filename = ' + subfilename + ', unixtime = ' + unixtime
       if not unixtime:
@@ -115,10 +166,10 @@ class GitUtility:
         unixtime = 0
     return int(unixtime)
 
-  def last_commit_time(self):
+  def last_commit_time(self,revision='HEAD'):
     '''
-    Get the time of the last commit, returned as UNIX time.
+    Get the time of the last commit (or of 'revision'), returned as UNIX time.
     '''
-    unixtime = subprocess.check_output(['git', 'log', '-1', '--format=%ct'])
+    unixtime = self._check_output(['git', 'log', '-1', '--format=%ct', revision])
     return int(unixtime)
   
\ No newline at end of file
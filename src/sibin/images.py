@@ -0,0 +1,140 @@
+import sibin.core
+import sibin.cache
+import sibin.metrics
+import hashlib
+import multiprocessing
+import os
+import os.path
+import shutil
+import subprocess
+
+# The raster image formats that are optimized (vector formats, such as SVG, are copied unchanged)
+RASTER_FORMATS = ['.png', '.jpg', '.jpeg', '.gif']
+
+def is_raster(imageFile):
+  return os.path.splitext(imageFile)[1].lower() in RASTER_FORMATS
+
+def find_program(program):
+  for dirname in os.environ.get('PATH', '').split(os.pathsep):
+    if os.access(os.path.join(dirname, program), os.X_OK):
+      return True
+  return False
+
+def optimize_image(task):
+  '''
+  Write the optimized version of an image, where task is the tuple (imageFile, width, cacheFile):
+  downscale the image to width pixels (unless width is None), strip its metadata, and recompress
+  it at maximum compression. Returns the list of tools that were run.
+  '''
+  (imageFile, width, cacheFile) = task
+  ext = os.path.splitext(imageFile)[1].lower()
+  tools = []
+  # Keep the extension, so that ImageMagick writes the right format
+  with sibin.cache.atomic_output(cacheFile, ext) as tmpfile:
+    optimize_to_file(imageFile, width, tmpfile, ext, tools)
+  return tools
+
+def optimize_to_file(imageFile,width,tmpfile,ext,tools):
+  '''
+  Write the optimized version of imageFile to tmpfile (see optimize_image()), appending the tools run to 'tools'
+  '''
+  if width is None and ext in ['.jpg', '.jpeg']:
+    # Re-encoding a JPEG with ImageMagick would lose quality, so use jpegtran (if available)
+    if find_program('jpegtran'):
+      subprocess.check_call(['jpegtran', '-copy', 'none', '-optimize', '-outfile', tmpfile, imageFile])
+      tools.append('jpegtran')
+    else:
+      shutil.copyfile(imageFile, tmpfile)
+  else:
+    args = ['convert', imageFile, '-strip']
+    if width is not None:
+      args += ['-resize', str(width) + 'x']
+    if ext == '.png':
+      args += ['-define', 'png:compression-level=9']
+    subprocess.check_call(args + [tmpfile])
+    tools.append('convert')
+  # Recompressing an image does not always make it smaller
+  if width is None and os.path.getsize(tmpfile) >= os.path.getsize(imageFile):
+    shutil.copyfile(imageFile, tmpfile)
+
+
+class ImageOptimizer:
+  '''
+  Downscales raster images to the width at which they are rendered and recompresses them,
+  in a pool of worker processes. The results are cached under the directory <cacheDir>/images/,
+  indexed by the digest of the source image and the target width, so that each image is
+  processed only once, no matter how many books (or runs) use it.
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('ImageOptimizer must be initialized with a SibinContext argument')
+    self.context = context
+    self.cacheDir = os.path.join(context.cacheDir, 'images')
+    self.indexFile = os.path.join(self.cacheDir, 'index.json')
+    # Maps each source image to [mtime, size, digest], so that unchanged images are not digested again
+    self.digests = None
+    self.hits = 0
+    self.misses = 0
+
+  def digest(self,imageFile):
+    if self.digests is None:
+      self.digests = sibin.cache.load_json(self.indexFile, {})
+    stats = sibin.cache.file_stats([imageFile])[imageFile]
+    entry = self.digests.get(imageFile)
+    if entry is None or entry[:2] != stats:
+      # Digest just the content, so that copies of an image in different books share the cache
+      with open(imageFile, 'rb') as f:
+        entry = stats + [hashlib.sha1(f.read()).hexdigest()]
+      self.digests[imageFile] = entry
+    return entry[2]
+
+  def cache_file(self,imageFile,width):
+    (root, ext) = os.path.splitext(imageFile)
+    return os.path.join(self.cacheDir, self.digest(imageFile) + '-' + str(width or 'full') + ext.lower())
+
+  def prepare(self,images):
+    '''
+    Optimize the specified images, a set of (imageFile, width) pairs, in parallel,
+    skipping any images that are already in the cache
+    '''
+    tasks = []
+    cacheFiles = set()
+    for (imageFile, width) in sorted(images, key=lambda image: (image[0], image[1] or 0)):
+      cacheFile = self.cache_file(imageFile, width)
+      if cacheFile in cacheFiles:
+        # An identical copy of an image that is already being optimized
+        continue
+      cacheFiles.add(cacheFile)
+      if os.path.exists(cacheFile):
+        self.hits += 1
+      else:
+        self.misses += 1
+        tasks.append((imageFile, width, cacheFile))
+    if tasks:
+      if not os.path.exists(self.cacheDir):
+        os.makedirs(self.cacheDir)
+      print 'Optimizing images: ' + str(len(tasks))
+      if len(tasks) > 1:
+        pool = multiprocessing.Pool(min(len(tasks), multiprocessing.cpu_count()))
+        try:
+          results = pool.map(optimize_image, tasks)
+        finally:
+          pool.close()
+          pool.join()
+      else:
+        results = [optimize_image(task) for task in tasks]
+      for tools in results:
+        for tool in tools:
+          sibin.metrics.collector.count('sibin_subprocess_total', tool=tool)
+    sibin.cache.save_json(self.indexFile, self.digests or {})
+
+  def optimized_file(self,imageFile,width):
+    '''
+    Return the optimized version of imageFile for the specified width, optimizing it now,
+    if it has not been prepared already
+    '''
+    cacheFile = self.cache_file(imageFile, width)
+    if not os.path.exists(cacheFile):
+      self.prepare(set([(imageFile, width)]))
+    return cacheFile
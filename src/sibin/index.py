@@ -0,0 +1,59 @@
+import sibin.cache
+
+def parse_shard(spec):
+  '''
+  Parse a shard specification of the form 'i/N' (where 1 <= i <= N),
+  returning the pair (i, N)
+  '''
+  try:
+    (i, n) = [int(part) for part in spec.split('/')]
+  except ValueError:
+    raise Exception('Invalid shard specification (expected i/N): ' + spec)
+  if n < 1 or i < 1 or i > n:
+    raise Exception('Invalid shard specification (expected 1 <= i <= N): ' + spec)
+  return (i, n)
+
+def shard_books(bookFiles,shard,shardCount,weights):
+  '''
+  Deterministically partition bookFiles into shardCount shards of roughly equal weight
+  (where weights maps each book file to its weight), returning the books in the specified
+  shard (numbered from 1), in their original order
+  '''
+  loads = [0] * shardCount
+  assignment = {}
+  # Assign the heaviest books first, each to the currently lightest shard
+  for bookFile in sorted(bookFiles, key=lambda bookFile: (-weights[bookFile], bookFile)):
+    lightest = loads.index(min(loads))
+    assignment[bookFile] = lightest + 1
+    loads[lightest] += weights[bookFile]
+  return [bookFile for bookFile in bookFiles if assignment[bookFile] == shard]
+
+def merge_indexes(indexes):
+  '''
+  Merge several link indexes (in the format returned by LinkData.export_index())
+  into a single link index
+  '''
+  books = []
+  bookId2index = {}
+  targets = {}
+  for index in indexes:
+    remap = []
+    for book in index['books']:
+      if book['id'] not in bookId2index:
+        bookId2index[book['id']] = len(books)
+        books.append(book)
+      remap.append(bookId2index[book['id']])
+    for xmlId in index['targets']:
+      entries = targets.setdefault(xmlId, [])
+      for (bookIndex, elementTag, title, pageId) in index['targets'][xmlId]:
+        entries.append([remap[bookIndex], elementTag, title, pageId])
+  return { 'books' : books, 'targets' : targets }
+
+def load_index(filename):
+  index = sibin.cache.load_json(filename)
+  if index is None:
+    raise Exception('No such link index file: ' + filename)
+  return index
+
+def save_index(filename,index):
+  sibin.cache.save_json(filename, index)
@@ -0,0 +1,132 @@
+import sibin.core
+import json
+import os
+import os.path
+from lxml import etree
+
+XINCLUDE = '{http://www.w3.org/2001/XInclude}include'
+XINCLUDE_FALLBACK = '{http://www.w3.org/2001/XInclude}fallback'
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+# The kinds of olink problem, in report order
+PROBLEMS = ['missing-book', 'missing-target', 'excluded-target', 'malformed']
+
+class OlinkScanner:
+  '''
+  Collects the olinks of a book, and the xml:ids of the elements in its condition-excluded
+  content, in one streaming pass over the files of its include closure
+  '''
+
+  def __init__(self,bookFile,conditionSet):
+    self.bookFile = bookFile
+    self.conditionSet = conditionSet
+    self.bookId = None
+    # The list of (xmlfile, line, targetdoc, targetptr) tuples
+    self.olinks = []
+    # The number of olinks inside condition-excluded content (which are never published)
+    self.excludedOlinks = 0
+    self.excludedIds = set()
+
+  def scan(self):
+    self._scan(self.bookFile, False)
+    return self
+
+  def _scan(self,xmlfile,isExcluded):
+    includes = []
+    fallbackDepth = 0
+    # Whether each open element is excluded (with the state inherited at the bottom)
+    excludedStack = [isExcluded]
+    for (event, el) in etree.iterparse(xmlfile, events=('start', 'end'), resolve_entities=False):
+      if not isinstance(el.tag, basestring):
+        continue
+      if event == 'end':
+        if el.tag == XINCLUDE_FALLBACK:
+          fallbackDepth -= 1
+        excludedStack.pop()
+        el.clear()
+        while el.getprevious() is not None:
+          del el.getparent()[0]
+        continue
+      excluded = excludedStack[-1] or sibin.core.is_excluded(el.get('condition'), self.conditionSet)
+      excludedStack.append(excluded)
+      if el.tag == XINCLUDE_FALLBACK:
+        fallbackDepth += 1
+      if fallbackDepth:
+        # Ignore fallback content (implies that main include must be provided)
+        continue
+      if self.bookId is None:
+        self.bookId = el.get('id') or el.get(XML_ID)
+      if el.tag == XINCLUDE:
+        href = el.get('href') or el.get('{http://www.w3.org/2001/XInclude}href')
+        if el.get('parse', 'xml') == 'xml':
+          includes.append((os.path.normpath(os.path.join(os.path.dirname(xmlfile), href)), excluded))
+        continue
+      xmlId = el.get('id') or el.get(XML_ID)
+      if xmlId and excluded:
+        self.excludedIds.add(xmlId)
+      if el.tag[el.tag.find('}')+1:] == 'olink':
+        if excluded:
+          self.excludedOlinks += 1
+        else:
+          self.olinks.append((xmlfile, el.sourceline, el.get('targetdoc'), el.get('targetptr')))
+    for (includeFile, excluded) in includes:
+      if not os.path.exists(includeFile):
+        raise Exception('File referenced in xi:include does not exist:  ' + includeFile)
+      self._scan(includeFile, excluded)
+
+
+def check_olinks(linkData,scanners):
+  '''
+  Check the olinks collected by scanners (a list of OlinkScanner objects, one for every book in the
+  library) against the link data, returning the list of problems found, where each problem is a
+  dictionary with the keys 'problem', 'book', 'file', 'line', 'targetdoc', and 'targetptr'
+  '''
+  excludedIds = {}
+  for scanner in scanners:
+    excludedIds[scanner.bookId] = scanner.excludedIds
+  problems = []
+  for scanner in scanners:
+    for (xmlfile, line, targetdoc, targetptr) in scanner.olinks:
+      # An olink without a targetdoc (or to its own book) links within the book
+      bookId = targetdoc or scanner.bookId
+      if not targetptr:
+        problem = 'malformed'
+      elif bookId not in linkData.bookId2Index:
+        problem = 'missing-book'
+      elif linkData.find(bookId, targetptr) is None:
+        problem = 'missing-target'
+      elif targetptr in excludedIds.get(bookId, ()):
+        problem = 'excluded-target'
+      else:
+        continue
+      problems.append({
+        'problem' : problem,
+        'book' : scanner.bookFile,
+        'file' : xmlfile,
+        'line' : line,
+        'targetdoc' : targetdoc or '',
+        'targetptr' : targetptr or ''
+      })
+  problems.sort(key=lambda p: (PROBLEMS.index(p['problem']), p['file'], p['line']))
+  return problems
+
+def summary(scanners,problems):
+  counts = { 'olinks' : sum([len(scanner.olinks) for scanner in scanners]),
+             'excludedOlinks' : sum([scanner.excludedOlinks for scanner in scanners]),
+             'books' : len(scanners) }
+  for problem in PROBLEMS:
+    counts[problem] = len([p for p in problems if p['problem'] == problem])
+  return counts
+
+def to_json(scanners,problems):
+  return json.dumps({ 'summary' : summary(scanners, problems), 'problems' : problems }, sort_keys=True, indent=1)
+
+def to_text(scanners,problems):
+  lines = []
+  for p in problems:
+    lines.append(p['file'] + ':' + str(p['line']) + ': ' + p['problem'] + ': <olink targetdoc="' + p['targetdoc'] + '" targetptr="' + p['targetptr'] + '"/>')
+  counts = summary(scanners, problems)
+  lines.append('Checked ' + str(counts['olinks']) + ' olinks in ' + str(counts['books']) + ' books'
+               + ' (skipped ' + str(counts['excludedOlinks']) + ' in condition-excluded content)')
+  lines.append(', '.join([problem + ': ' + str(counts[problem]) for problem in PROBLEMS]))
+  return '\n'.join(lines)
@@ -0,0 +1,168 @@
+import contextlib
+import json
+import resource
+import sys
+import time
+
+def maxrss(who=resource.RUSAGE_SELF):
+  '''
+  Return the peak resident set size in bytes, as recorded by getrusage()
+  '''
+  peak = resource.getrusage(who).ru_maxrss
+  # ru_maxrss is in bytes on Mac OS X, but in kilobytes on Linux
+  if sys.platform == 'darwin':
+    return peak
+  return peak * 1024
+
+def proc_status(field):
+  '''
+  Return the value of field (for example, VmRSS) from /proc/self/status, in bytes,
+  or None, if it is not available on this platform
+  '''
+  try:
+    with open('/proc/self/status', 'r') as f:
+      for line in f:
+        if line.startswith(field + ':'):
+          return int(line.split()[1]) * 1024
+  except IOError:
+    pass
+  return None
+
+def current_rss():
+  '''
+  Return the current resident set size of this process in bytes (or its peak, if the
+  current size is not available on this platform)
+  '''
+  rss = proc_status('VmRSS')
+  if rss is None:
+    return maxrss()
+  return rss
+
+def reset_peak_rss():
+  '''
+  Reset the peak resident set size of this process to its current size, where
+  this is supported (Linux), so that peak_rss_since_reset() measures a single task
+  '''
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except IOError:
+    pass
+
+def peak_rss_since_reset():
+  peak = proc_status('VmHWM')
+  if peak is None:
+    return maxrss()
+  return peak
+
+
+class MetricsCollector:
+  '''
+  Collects the metrics of one sibin run (durations, counters, and peak memory) and writes
+  them to a file, in Prometheus text format or, if the file name ends in .json, in JSON
+  '''
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.startTime = time.time()
+    # Maps (phase, book) to the total duration in seconds
+    self.durations = {}
+    # Maps (name, labels) to a count, where labels is a sorted tuple of (label, value) pairs
+    self.counters = {}
+    # Maps (name, labels) to the maximum value recorded
+    self.gauges = {}
+    self.info = {}
+
+  def count(self,name,value=1,**labels):
+    key = (name, tuple(sorted(labels.items())))
+    self.counters[key] = self.counters.get(key, 0) + value
+
+  def maximum(self,name,value,**labels):
+    '''
+    Record value for the gauge (name, labels), keeping the maximum of all values recorded
+    '''
+    key = (name, tuple(sorted(labels.items())))
+    self.gauges[key] = max(self.gauges.get(key, value), value)
+
+  @contextlib.contextmanager
+  def timer(self,phase,book=''):
+    '''
+    A context manager that adds the time spent in its body to the duration of (phase, book)
+    '''
+    start = time.time()
+    try:
+      yield
+    finally:
+      key = (phase, book)
+      self.durations[key] = self.durations.get(key, 0.0) + (time.time() - start)
+
+  def snapshot(self):
+    '''
+    Return the collected durations and counters in a form that can be sent to another process
+    '''
+    return { 'durations' : self.durations.items(), 'counters' : self.counters.items(), 'gauges' : self.gauges.items() }
+
+  def merge(self,snapshot):
+    '''
+    Add the durations and counters from the snapshot of another (child) process
+    '''
+    for (key, value) in snapshot['durations']:
+      self.durations[key] = self.durations.get(key, 0.0) + value
+    for (key, value) in snapshot['counters']:
+      self.counters[key] = self.counters.get(key, 0) + value
+    for (key, value) in snapshot['gauges']:
+      self.gauges[key] = max(self.gauges.get(key, value), value)
+
+  def peak_rss(self):
+    '''
+    Return the peak resident set size in bytes, of this process or of any of its child processes
+    '''
+    return max(maxrss(resource.RUSAGE_SELF), maxrss(resource.RUSAGE_CHILDREN))
+
+  def samples(self):
+    '''
+    Return the list of (name, labels, value) samples
+    '''
+    samples = []
+    for (name, value) in sorted(self.info.items()):
+      samples.append(('sibin_run_info', ((name, value),), 1))
+    samples.append(('sibin_run_duration_seconds', (), time.time() - self.startTime))
+    totals = {}
+    for ((phase, book), value) in sorted(self.durations.items()):
+      totals[phase] = totals.get(phase, 0.0) + value
+      if book:
+        samples.append(('sibin_book_phase_duration_seconds', (('book', book), ('phase', phase)), value))
+    for (phase, value) in sorted(totals.items()):
+      samples.append(('sibin_phase_duration_seconds', (('phase', phase),), value))
+    for ((name, labels), value) in sorted(self.counters.items()) + sorted(self.gauges.items()):
+      samples.append((name, labels, value))
+    samples.append(('sibin_peak_rss_bytes', (), self.peak_rss()))
+    return samples
+
+  def to_prometheus(self):
+    lines = []
+    for (name, labels, value) in self.samples():
+      if labels:
+        name += '{' + ','.join([label + '="' + str(labelValue).replace('\\', '\\\\').replace('"', '\\"') + '"' for (label, labelValue) in labels]) + '}'
+      lines.append(name + ' ' + repr(value))
+    return '\n'.join(lines) + '\n'
+
+  def to_json(self):
+    metrics = []
+    for (name, labels, value) in self.samples():
+      metrics.append({ 'name' : name, 'labels' : dict(labels), 'value' : value })
+    return json.dumps({ 'metrics' : metrics }, sort_keys=True, indent=1)
+
+  def write(self,filename):
+    if filename.endswith('.json'):
+      content = self.to_json()
+    else:
+      content = self.to_prometheus()
+    import sibin.cache
+    # Written atomically, so that the exporter never reads a partial file
+    sibin.cache.atomic_write(filename, content)
+
+# The metrics of the current run
+collector = MetricsCollector()
@@ -0,0 +1,73 @@
+import sibin.core
+import os
+import os.path
+from lxml import etree
+
+# The default preview stylesheet, shipped in the resources directory of the sibin distribution
+DEFAULT_STYLESHEET = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'resources', 'preview', 'preview.xsl'))
+
+# Compiled stylesheets, indexed by (filename, mtime)
+compiledStylesheets = {}
+
+def get_stylesheet(filename):
+  '''
+  Return the compiled XSLT stylesheet for filename, compiling it only once per process
+  (or again, if the file has been modified)
+  '''
+  key = (os.path.abspath(filename), os.path.getmtime(filename))
+  if key not in compiledStylesheets:
+    compiledStylesheets[key] = etree.XSLT(etree.parse(filename))
+  return compiledStylesheets[key]
+
+
+class PreviewRenderer:
+  '''
+  Renders transformed DocBook content (as returned by XMLTransformer.dcbk2publican) to HTML
+  '''
+
+  def __init__(self,context,stylesheet=None):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('PreviewRenderer must be initialized with a SibinContext argument')
+    self.context = context
+    self.stylesheet = stylesheet or DEFAULT_STYLESHEET
+
+  def resolve_external_xrefs(self,element,bookId,pageUrl):
+    '''
+    Replace each xref or link that points outside of element (for example, into another chapter
+    of the book) by a link to pageUrl, with link text taken from the link data
+    '''
+    linkData = self.context.linkData
+    localIds = set()
+    for el in element.iter(tag=etree.Element):
+      xmlId = el.get('id') or el.get('{http://www.w3.org/XML/1998/namespace}id')
+      if xmlId:
+        localIds.add(xmlId)
+    for el in list(element.iter(tag=etree.Element)):
+      linkend = el.get('linkend')
+      if (not linkend) or (linkend in localIds) or (el.getparent() is None):
+        continue
+      tagname = el.tag[el.tag.find('}')+1:]
+      if tagname not in ['xref', 'link']:
+        continue
+      link = el.makeelement(el.tag.replace('xref', 'link'))
+      link.set('{http://www.w3.org/1999/xlink}href', pageUrl + '#' + linkend)
+      if tagname == 'link' and (el.text or len(el)):
+        link.text = el.text
+        for child in el:
+          link.append(child)
+      else:
+        target = linkData.find(bookId, linkend)
+        if target is not None:
+          link.text = target.title
+        else:
+          link.text = '[' + linkend + ']'
+      link.tail = el.tail
+      el.getparent().replace(el, link)
+
+  def render(self,element,title=''):
+    '''
+    Return the HTML rendering of element, as a string
+    '''
+    transform = get_stylesheet(self.stylesheet)
+    result = transform(etree.ElementTree(element), title=etree.XSLT.strparam(title))
+    return str(result)
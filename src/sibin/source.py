@@ -0,0 +1,255 @@
+import collections
+import os
+import os.path
+import re
+import shutil
+import StringIO
+
+XINCLUDE = '{http://www.w3.org/2001/XInclude}include'
+XINCLUDE_FALLBACK = '{http://www.w3.org/2001/XInclude}fallback'
+
+# Quickly identifies the files that might contain a text xi:include
+TEXT_INCLUDE_PATTERN = re.compile(r'''parse\s*=\s*["']text["']''')
+
+
+class WorkingTree:
+  '''
+  Reads the source files of the library (book files, xincluded files, entity files, images,
+  and templates) from the working directory
+  '''
+
+  # The revision that the source files belong to (as far as git is concerned)
+  revision = 'HEAD'
+
+  def read(self,filename):
+    with open(filename, 'rb') as f:
+      return f.read()
+
+  def read_xml(self,filename):
+    '''
+    Return the content of an XML file (or entity file), as it is to be parsed
+    '''
+    return self.read(filename)
+
+  def open(self,filename):
+    return open(filename, 'rb')
+
+  def exists(self,filename):
+    return os.path.exists(filename)
+
+  def isfile(self,filename):
+    return os.path.isfile(filename)
+
+  def isdir(self,dirname):
+    return os.path.isdir(dirname)
+
+  def listdir(self,dirname):
+    return os.listdir(dirname)
+
+  def walk(self,dirname):
+    return os.walk(dirname)
+
+  def getsize(self,filename):
+    return os.path.getsize(filename)
+
+  def copy(self,filename,destfile):
+    '''
+    Copy filename to destfile, together with its permission bits
+    '''
+    shutil.copy(filename, destfile)
+
+  def is_local(self,filename):
+    '''
+    Return True, if filename can be passed to an external tool as it is
+    '''
+    return True
+
+  def signature(self,filename):
+    '''
+    Return a signature of filename that changes whenever its content changes
+    '''
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+  def stats(self,filenames):
+    '''
+    Return a dictionary mapping each of the specified files to its signature (as a list),
+    or to None, if the file does not exist
+    '''
+    stats = {}
+    for filename in filenames:
+      if self.exists(filename):
+        stats[filename] = list(self.signature(filename))
+      else:
+        stats[filename] = None
+    return stats
+
+
+class GitTree(WorkingTree):
+  '''
+  Reads the source files of the library from a git commit, straight from the object store,
+  through one persistent 'git cat-file --batch' process (so without checking out the commit).
+  Files outside the git repository (such as system DTDs) are still read from the file system.
+  '''
+
+  def __init__(self,git,commit,maxCacheBytes=64*1024*1024):
+    self.git = git
+    self.commit = commit
+    self.revision = git.rev_parse(commit + '^{commit}')
+    if not self.revision:
+      raise Exception('No such commit: ' + commit)
+    # The top-level directory of the git repository
+    self.top = os.path.normpath(os.path.join(os.getcwd(), os.path.relpath('.', git.prefix() or '.')))
+    # The parsed tree objects, indexed by directory (relative to the top of the repository)
+    self.trees = {}
+    # The results of repo_path(), indexed by file name
+    self.repoPaths = {}
+    # The most recently read blobs, indexed by SHA (the same file is typically read several times)
+    self.blobs = collections.OrderedDict()
+    self.blobBytes = 0
+    self.maxCacheBytes = maxCacheBytes
+
+  def repo_path(self,filename):
+    '''
+    Return the path of filename relative to the top of the repository,
+    or None, if filename is outside the repository
+    '''
+    if filename not in self.repoPaths:
+      path = os.path.relpath(os.path.abspath(filename), self.top)
+      if path == '.':
+        path = ''
+      elif path == '..' or path.startswith('..' + os.sep):
+        path = None
+      self.repoPaths[filename] = path
+    return self.repoPaths[filename]
+
+  def tree(self,path):
+    '''
+    Return the entries of the directory 'path' (relative to the top of the repository) in the commit,
+    as a dictionary mapping each name to a (mode, sha) pair, or None, if there is no such directory
+    '''
+    if path not in self.trees:
+      if path == '':
+        content = self.git.cat_file(self.revision + '^{tree}')
+      else:
+        (parent, name) = os.path.split(path)
+        entry = (self.tree(parent) or {}).get(name)
+        content = None
+        if entry is not None and entry[0] == '40000':
+          content = self.git.cat_file(entry[1])
+      entries = None
+      if content is not None:
+        entries = {}
+        i = 0
+        # Each tree entry is '<mode> <name>\0' followed by the 20-byte binary SHA
+        while i < len(content):
+          end = content.index('\0', i)
+          (mode, name) = content[i:end].split(' ', 1)
+          entries[name] = (mode, content[end+1:end+21].encode('hex'))
+          i = end + 21
+      self.trees[path] = entries
+    return self.trees[path]
+
+  def entry(self,filename):
+    path = self.repo_path(filename)
+    (parent, name) = os.path.split(path)
+    return (self.tree(parent) or {}).get(name)
+
+  def read(self,filename):
+    if self.repo_path(filename) is None:
+      return WorkingTree.read(self, filename)
+    entry = self.entry(filename)
+    if entry is None or entry[0] == '40000':
+      raise IOError('No such file in commit ' + self.commit + ': ' + filename)
+    content = self.blobs.pop(entry[1], None)
+    if content is None:
+      content = self.git.cat_file(entry[1])
+      if content is None:
+        # For example, a submodule (whose commits are not in this repository's object store)
+        raise IOError('Cannot read file from commit ' + self.commit + ': ' + filename)
+      self.blobBytes += len(content)
+      while self.blobs and (self.blobBytes > self.maxCacheBytes):
+        (evictedSha, evictedContent) = self.blobs.popitem(last=False)
+        self.blobBytes -= len(evictedContent)
+    self.blobs[entry[1]] = content
+    return content
+
+  def read_xml(self,filename):
+    '''
+    Return the content of an XML file, with any text xi:includes replaced by the included text
+    (because libxml2 would read the included text from the file system)
+    '''
+    content = self.read(filename)
+    if not TEXT_INCLUDE_PATTERN.search(content):
+      return content
+    from lxml import etree
+    doc = etree.parse(StringIO.StringIO(content), etree.XMLParser(resolve_entities=False), base_url=filename)
+    for xinclude in list(doc.getroot().iter(XINCLUDE)):
+      if xinclude.get('parse') != 'text' or any([el.tag == XINCLUDE_FALLBACK for el in xinclude.iterancestors()]):
+        continue
+      href = xinclude.get('href') or xinclude.get('{http://www.w3.org/2001/XInclude}href')
+      text = self.read(os.path.normpath(os.path.join(os.path.dirname(filename), href))).decode(xinclude.get('encoding', 'utf-8'))
+      text += xinclude.tail or ''
+      previous = xinclude.getprevious()
+      if previous is not None:
+        previous.tail = (previous.tail or '') + text
+      else:
+        xinclude.getparent().text = (xinclude.getparent().text or '') + text
+      xinclude.getparent().remove(xinclude)
+    return etree.tostring(doc, encoding='UTF-8', xml_declaration=True)
+
+  def open(self,filename):
+    return StringIO.StringIO(self.read(filename))
+
+  def exists(self,filename):
+    if self.repo_path(filename) is None:
+      return WorkingTree.exists(self, filename)
+    return self.repo_path(filename) == '' or self.entry(filename) is not None
+
+  def isfile(self,filename):
+    if self.repo_path(filename) is None:
+      return WorkingTree.isfile(self, filename)
+    entry = self.entry(filename)
+    return entry is not None and entry[0] != '40000'
+
+  def isdir(self,dirname):
+    if self.repo_path(dirname) is None:
+      return WorkingTree.isdir(self, dirname)
+    return self.tree(self.repo_path(dirname)) is not None
+
+  def listdir(self,dirname):
+    if self.repo_path(dirname) is None:
+      return WorkingTree.listdir(self, dirname)
+    entries = self.tree(self.repo_path(dirname))
+    if entries is None:
+      raise OSError('No such directory in commit ' + self.commit + ': ' + dirname)
+    return entries.keys()
+
+  def walk(self,dirname):
+    names = self.listdir(dirname)
+    dirnames = sorted([name for name in names if self.isdir(os.path.join(dirname, name))])
+    filenames = sorted([name for name in names if name not in dirnames])
+    yield (dirname, dirnames, filenames)
+    for name in dirnames:
+      for result in self.walk(os.path.join(dirname, name)):
+        yield result
+
+  def getsize(self,filename):
+    return len(self.read(filename))
+
+  def copy(self,filename,destfile):
+    if self.repo_path(filename) is None:
+      return WorkingTree.copy(self, filename, destfile)
+    with open(destfile, 'wb') as f:
+      f.write(self.read(filename))
+    if self.entry(filename)[0] == '100755':
+      os.chmod(destfile, 0755)
+
+  def is_local(self,filename):
+    return self.repo_path(filename) is None
+
+  def signature(self,filename):
+    if self.repo_path(filename) is None:
+      return WorkingTree.signature(self, filename)
+    # The blob SHA identifies the content
+    return (self.entry(filename)[1],)
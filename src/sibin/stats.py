@@ -0,0 +1,185 @@
+import sibin.disk
+import json
+import os
+import os.path
+from lxml import etree
+
+XINCLUDE = '{http://www.w3.org/2001/XInclude}include'
+XINCLUDE_FALLBACK = '{http://www.w3.org/2001/XInclude}fallback'
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+# The statistics reported for each book, in table order
+FIELDS = ['elements', 'ids', 'olinks', 'images', 'imageBytes', 'largestListing', 'includedBytes', 'sourceBytes', 'predictedSeconds']
+
+def local_name(tag):
+  return tag[tag.find('}')+1:]
+
+
+class BookStats:
+  '''
+  Statistics of one book, collected by streaming over the files of its include closure with
+  iterparse, discarding each element as soon as it has been counted, so that the full tree of
+  the book is never built
+  '''
+
+  def __init__(self,bookFile):
+    self.bookFile = bookFile
+    self.elements = 0
+    self.ids = 0
+    self.olinks = 0
+    self.imageFiles = set()
+    self.imageBytes = 0
+    # The length (in characters) of the largest programlisting
+    self.largestListing = 0
+    # The total size of the book file and of every file it xincludes, counted once per
+    # xi:include (so a file included twice counts twice)
+    self.includedBytes = 0
+    self.sourceFiles = set()
+    self.predictedSeconds = None
+
+  def collect(self):
+    self.scan(self.bookFile)
+    for imageFile in self.imageFiles:
+      if os.path.exists(imageFile):
+        self.imageBytes += os.path.getsize(imageFile)
+    return self
+
+  def scan(self,xmlfile):
+    self.sourceFiles.add(xmlfile)
+    self.includedBytes += os.path.getsize(xmlfile)
+    includes = []
+    fallbackDepth = 0
+    listingDepth = 0
+    for (event, el) in etree.iterparse(xmlfile, events=('start', 'end'), resolve_entities=False):
+      if not isinstance(el.tag, basestring):
+        continue
+      tagname = local_name(el.tag)
+      if event == 'start':
+        if el.tag == XINCLUDE_FALLBACK:
+          fallbackDepth += 1
+        if fallbackDepth:
+          # Ignore fallback content (implies that main include must be provided)
+          continue
+        if el.tag == XINCLUDE:
+          href = el.get('href') or el.get('{http://www.w3.org/2001/XInclude}href')
+          includes.append((os.path.normpath(os.path.join(os.path.dirname(xmlfile), href)), el.get('parse', 'xml')))
+          continue
+        # Count the elements as they would appear in the book, with its xincludes expanded
+        self.elements += 1
+        # DocBook 5 uses xml:id, DocBook 4 uses id
+        if el.get(XML_ID) is not None or el.get('id') is not None:
+          self.ids += 1
+        if tagname == 'olink':
+          self.olinks += 1
+        elif tagname == 'imagedata':
+          fileref = el.get('fileref') or el.get('{http://docbook.org/ns/docbook}fileref')
+          if fileref and not fileref.startswith('http:'):
+            self.imageFiles.add(os.path.normpath(os.path.join(os.path.dirname(xmlfile), fileref)))
+        elif tagname == 'programlisting':
+          listingDepth += 1
+        continue
+      if el.tag == XINCLUDE_FALLBACK:
+        fallbackDepth -= 1
+      elif tagname == 'programlisting' and not fallbackDepth:
+        listingDepth -= 1
+        self.largestListing = max(self.largestListing, len(''.join(el.itertext())))
+      # The text of a programlisting includes the text of its children, so keep them until the end
+      if not listingDepth:
+        el.clear()
+        while el.getprevious() is not None:
+          del el.getparent()[0]
+    for (includeFile, parse) in includes:
+      if not os.path.exists(includeFile):
+        raise Exception('File referenced in xi:include does not exist:  ' + includeFile)
+      if parse == 'text':
+        self.sourceFiles.add(includeFile)
+        self.includedBytes += os.path.getsize(includeFile)
+      else:
+        self.scan(includeFile)
+
+  def sourceBytes(self):
+    '''
+    Return the total size of the book's (distinct) source files
+    '''
+    return sum([os.path.getsize(xmlfile) for xmlfile in self.sourceFiles])
+
+  def to_dict(self):
+    return {
+      'book' : self.bookFile,
+      'elements' : self.elements,
+      'ids' : self.ids,
+      'olinks' : self.olinks,
+      'images' : len(self.imageFiles),
+      'imageBytes' : self.imageBytes,
+      'largestListing' : self.largestListing,
+      'includedBytes' : self.includedBytes,
+      'sourceBytes' : self.sourceBytes(),
+      'predictedSeconds' : self.predictedSeconds
+    }
+
+
+def predict_costs(buildHistory,bookStatsList):
+  '''
+  Set the predicted generation time of each book, from the generation times recorded in
+  buildHistory: the book's own recorded seconds per source byte, if it has any history,
+  otherwise the average over the whole library. Nothing is predicted without any history.
+  '''
+  histories = {}
+  totalSeconds = 0.0
+  totalBytes = 0
+  for bookStats in bookStatsList:
+    histories[bookStats.bookFile] = buildHistory.load(bookStats.bookFile)
+    for record in histories[bookStats.bookFile]:
+      totalSeconds += record['seconds']
+      totalBytes += record['bytes']
+  if not totalBytes:
+    return
+  libraryRate = totalSeconds / totalBytes
+  for bookStats in bookStatsList:
+    records = histories[bookStats.bookFile]
+    bookBytes = sum([record['bytes'] for record in records])
+    if bookBytes:
+      rate = sum([record['seconds'] for record in records]) / bookBytes
+    else:
+      rate = libraryRate
+    bookStats.predictedSeconds = round(rate * bookStats.sourceBytes(), 3)
+
+def totals(rows):
+  total = { 'book' : 'Total' }
+  for field in FIELDS:
+    values = [row[field] for row in rows if row[field] is not None]
+    if field == 'largestListing':
+      total[field] = max(values or [0])
+    elif field == 'predictedSeconds' and not values:
+      total[field] = None
+    else:
+      total[field] = sum(values)
+  return total
+
+def to_json(rows):
+  return json.dumps({ 'books' : rows, 'total' : totals(rows) }, sort_keys=True, indent=1)
+
+def to_table(rows):
+  headings = ['Book', 'Elements', 'IDs', 'Olinks', 'Images', 'Image size', 'Largest listing', 'Included size', 'Predicted (s)']
+  table = [headings]
+  for row in rows + [totals(rows)]:
+    predicted = '-'
+    if row['predictedSeconds'] is not None:
+      predicted = '%.2f' % row['predictedSeconds']
+    table.append([
+      row['book'],
+      str(row['elements']),
+      str(row['ids']),
+      str(row['olinks']),
+      str(row['images']),
+      sibin.disk.format_size(row['imageBytes']),
+      str(row['largestListing']),
+      sibin.disk.format_size(row['includedBytes']),
+      predicted
+    ])
+  widths = [max([len(line[i]) for line in table]) for i in range(len(headings))]
+  lines = []
+  for line in table:
+    cells = [line[0].ljust(widths[0])] + [line[i].rjust(widths[i]) for i in range(1, len(line))]
+    lines.append('  '.join(cells))
+  return '\n'.join(lines)
@@ -0,0 +1,1514 @@
+'''
+Created on July 3, 2014
+
+@author: fbolton
+'''
+from lxml import etree
+import sibin.core
+import sibin.cache
+import sibin.metrics
+import sibin.diagnostics
+import os
+import sys
+import shutil
+import subprocess
+import hashlib
+import re
+import multiprocessing
+import glob
+import time
+
+# The caches that count their hits and misses, indexed by cache name: the name of the context
+# attribute that holds each cache (None for the shared file cache, sibin.core.fileResolver)
+COUNTED_CACHES = {
+  'fragments' : 'fragmentCache',
+  'files' : None,
+  'link_index' : 'linkIndexCache',
+  'book_catalog' : 'bookCatalog',
+  'validation' : 'validationResults',
+  'images' : 'imageOptimizer'
+}
+
+class BasicTasks:
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('BasicTasks must be initialized with a SibinContext argument')
+    self.context = context
+    # Per-run caches of the xincludes and image references found in each file
+    # (where each image reference is an (imageFile, contentwidth, scale) tuple)
+    self.xincludeCache = {}
+    self.imageCache = {}
+    # Per-run cache of book metadata (Book objects), indexed by book file
+    self.books = {}
+    self.linkDataPopulated = False
+    # Name of the file that records the books built so far
+    self.restoreFile = 'sibin.restore'
+    # Expands entities in localized books
+    self.entityExpander = None
+    # The books selected for processing (None selects all books)
+    self.selectedBooks = None
+    # If set, link data is loaded from this link index file instead of parsing all books
+    self.linkIndexFile = None
+    # If True, link data is loaded only for the selected books and the books they link to
+    self.lazyLinkData = False
+    # If set, books are generated in worker processes, each of which is recycled after generating
+    # booksPerWorker books or once its resident memory exceeds maxRss bytes
+    self.maxRss = None
+    self.booksPerWorker = None
+    # If True, the images copied into the generated books are downscaled and recompressed
+    self.optimizeImages = False
+  
+  def xml_header(self,tagname,entityfile):
+    import sibin.template
+    return sibin.template.xml_header(tagname, entityfile)
+
+  def doc_to_xml_string(self,element,entityfile):
+    import sibin.template
+    return sibin.template.doc_to_xml_string(element, entityfile)
+  
+  def expand_entities(self,element,contentFiles):
+    '''
+    Expand the entities in element, which was parsed from contentFiles, using the library entities file.
+    Returns the expanded element, which is a new element if the document had to be reparsed.
+    '''
+    if self.entityExpander is None:
+      self.entityExpander = sibin.core.EntityExpander(self.context.bookEntitiesFile)
+    if self.entityExpander.in_attributes(contentFiles):
+      # Entity references in attribute values can only be resolved by reparsing the document
+      return sibin.core.parse_xml_string(self.doc_to_xml_string(element, self.context.bookEntitiesFile))
+    self.entityExpander.expand(element)
+    return element
+
+  def save_doc_to_xml_file(self,element,xmlfile,entityfile):
+    f = open(xmlfile, 'w')
+    f.write(self.doc_to_xml_string(element, entityfile))
+    f.close()
+
+  def save_string_to_xml_file(self,tagname,content,xmlfile,entityfile):
+    f = open(xmlfile, 'w')
+    f.write(self.xml_header(tagname, entityfile) + content + '\n')
+    f.close()
+    
+  def restore_file_read(self):
+    bookSet = set()
+    filename = self.restoreFile
+    if os.path.exists(filename):
+      with open(filename, 'r') as f:
+        for line in f:
+          bookSet.add(line.strip() )
+    return bookSet
+  
+  def restore_file_append(self, line):
+    filename = self.restoreFile
+    with open(filename, 'a') as f:
+      f.write(line + '\n')
+  
+  def restore_file_delete(self):
+    if os.path.exists(self.restoreFile):
+      os.unlink(self.restoreFile)
+    
+  def check_kerberos_ticket(self):
+    kresponse = subprocess.call(['klist'])
+    if kresponse != 0:
+      # Non-zero exit code
+      sibin.diagnostics.collector.warn('kerberos-ticket-missing', '')
+      sys.exit()
+      
+  def set_current_profile(self, new_profile=''):
+    if new_profile:
+      if new_profile in self.context.profiles:
+        self.context.currentProfile = new_profile
+      else:
+        print 'Error: No such profile as ' + new_profile
+        sys.exit()
+    elif 'default' in self.context.profiles:
+      self.context.currentProfile = 'default'
+    else:
+      self.context.currentProfile = self.context.profiles[0]
+    print 'Current profile set to: ' + self.context.currentProfile
+      
+  def get_checksum(self,filename):
+    with sibin.metrics.collector.timer('checksum', filename):
+      doc = sibin.core.parse_xml(filename,resolve_entities=False)
+      doc.xinclude()
+      stringifiedbook = etree.tostring(doc.getroot())
+      sha = hashlib.sha1()
+      sha.update(stringifiedbook)
+      checksum = sha.hexdigest()
+      del stringifiedbook
+      del doc
+    return checksum
+  
+  def parse_xincludes(self, xmlfile, ignoreDirs=[]):
+    '''
+    Return the set of all files recursively xincluded by xmlfile,
+    optionally excluding the contents of any directories specified by ignoreDirs
+    '''
+    cacheKey = (xmlfile, tuple(ignoreDirs))
+    if cacheKey in self.xincludeCache:
+      return set(self.xincludeCache[cacheKey])
+    xincludeSet = set()
+    doc = sibin.core.parse_xml(xmlfile)
+    root = doc.getroot()
+    for xinclude in root.findall('.//{http://www.w3.org/2001/XInclude}include'):
+      # Ignore fallback includes (implies that main include must be provided)
+      if xinclude.getparent().tag == '{http://www.w3.org/2001/XInclude}fallback':
+        continue
+      href = xinclude.get('href') or xinclude.get('{http://www.w3.org/2001/XInclude}href')
+      xincludeFile = os.path.normpath(os.path.join(os.path.dirname(xmlfile),href))
+      if not self.context.sourceTree.exists(xincludeFile):
+        raise Exception('File referenced in xi:include does not exist:  ' + xincludeFile)
+      ignore = False
+      for ignoredir in ignoreDirs:
+        if xincludeFile.startswith(ignoredir):
+          ignore = True
+          break
+      if not ignore:
+        xincludeSet.add(xincludeFile)
+        xincludeSet |= self.parse_xincludes(xincludeFile, ignoreDirs)
+    # Garbage collect parsed file, to avoid memory leaks!
+    del doc
+    self.xincludeCache[cacheKey] = xincludeSet
+    return set(xincludeSet)
+
+  def getImageFileSet(self,element,xmlfile):
+    return set([imageFile for (imageFile, contentwidth, scale) in self.getImageReferences(element,xmlfile)])
+
+  def getImageReferences(self,element,xmlfile):
+    imageReferences = []
+    for imagedata in element.xpath(".//*[local-name()='imagedata']"):
+      fileref = imagedata.get('fileref') or imagedata.get('{http://docbook.org/ns/docbook}fileref')
+      if fileref.startswith('http:'):
+        # No need to process the image, if it's just a URL reference
+        continue
+      if not fileref:
+        raise Exception('appendImageLinkData() - non-existent imagedata/@fileref attribute in file:' + xmlfile)
+      imageFile = os.path.normpath(os.path.join(os.path.dirname(xmlfile),fileref))
+      contentwidth = imagedata.get('contentwidth') or imagedata.get('{http://docbook.org/ns/docbook}contentwidth')
+      scale = imagedata.get('scale') or imagedata.get('{http://docbook.org/ns/docbook}scale')
+      imageReferences.append((imageFile, contentwidth, scale))
+    return imageReferences
+
+  def get_file_entities(self,xmlfile):
+    '''
+    Return the set of external entity files declared in the DOCTYPE of xmlfile
+    '''
+    f = self.context.sourceTree.open(xmlfile)
+    prolog = f.read(4096)
+    f.close()
+    entityFileSet = set()
+    for entityfile in re.findall(r'<!ENTITY\s+%\s+\S+\s+SYSTEM\s+["\']([^"\']+)["\']', prolog):
+      entityFileSet.add(os.path.normpath(os.path.join(os.path.dirname(xmlfile),entityfile)))
+    return entityFileSet
+
+  def get_book_dependencies(self,bookFile,xincludeFileSet,imageFileSet):
+    '''
+    Return the set of all files that the generated output of bookFile depends on
+    '''
+    dependencies = xincludeFileSet | imageFileSet
+    for xmlfile in xincludeFileSet:
+      dependencies |= self.get_file_entities(xmlfile)
+    dependencies.add(os.path.normpath(self.context.bookEntitiesFile))
+    dependencies.add('sibin.cfg')
+    filesdir = os.path.normpath(os.path.join(os.path.dirname(bookFile),'files'))
+    if self.context.sourceTree.exists(filesdir):
+      for filesFile in self.context.sourceTree.listdir(filesdir):
+        dependencies.add(os.path.join(filesdir,filesFile))
+    for profile in self.context.profiles:
+      templatedir = self.context.templates.get(profile)
+      if templatedir:
+        for (dirpath, dirnames, filenames) in self.context.sourceTree.walk(templatedir):
+          for filename in filenames:
+            dependencies.add(os.path.normpath(os.path.join(dirpath,filename)))
+    return dependencies
+
+  def update_dependency_index(self):
+    '''
+    Scan every book in the library and record its dependencies in the dependency index
+    '''
+    for bookFile in self.context.bookFiles:
+      xincludeFileSet = set([bookFile]) | self.parse_xincludes(bookFile)
+      imageFileSet = set()
+      for xmlfile in xincludeFileSet:
+        imageFileSet |= self.get_file_images(xmlfile)
+      self.context.dependencyIndex.set_book(bookFile, self.get_book_dependencies(bookFile, xincludeFileSet, imageFileSet))
+    self.context.dependencyIndex.save()
+
+  def books_changed_since(self,commit):
+    '''
+    Return the set of books affected by the changes committed between 'commit' and HEAD
+    '''
+    if not self.context.git.rev_parse(commit + '^{commit}'):
+      print 'Error: No such commit as ' + commit
+      sys.exit(1)
+    index = self.context.dependencyIndex
+    for bookFile in self.context.bookFiles:
+      if not index.has_book(bookFile):
+        print 'Building the dependency index'
+        self.update_dependency_index()
+        break
+    deletedFileSet = set()
+    modifiedFileSet = set()
+    addedFileSet = set()
+    self.context.git.diff_tree(commit, self.context.sourceTree.revision, deletedFileSet, modifiedFileSet, addedFileSet)
+    prefix = self.context.git.prefix()
+    changedBooks = set()
+    for filename in (deletedFileSet | modifiedFileSet | addedFileSet):
+      if filename.startswith(prefix):
+        changedBooks |= index.books_for(filename[len(prefix):])
+    changedBooks &= set(self.get_selected_books())
+    print 'Books affected by changes since ' + commit + ': ' + str(len(changedBooks))
+    return changedBooks
+
+  def get_file_images(self,xmlfile):
+    '''
+    Return the set of image files referenced directly by xmlfile (not counting xincludes)
+    '''
+    if xmlfile not in self.imageCache:
+      doc = sibin.core.parse_xml(xmlfile,resolve_entities=False)
+      self.imageCache[xmlfile] = self.getImageReferences(doc.getroot(),xmlfile)
+      del doc
+    return set([imageFile for (imageFile, contentwidth, scale) in self.imageCache[xmlfile]])
+
+  def get_image_target_widths(self,xincludeFileSet):
+    '''
+    Return a dictionary mapping each raster image referenced by the files in xincludeFileSet
+    to the width (in pixels) to downscale it to, or to None, if it should not be downscaled.
+    An image is downscaled only if every reference to it renders it narrower than its actual
+    width (the target being the widest such rendering).
+    '''
+    import sibin.images
+    widths = {}
+    for xmlfile in sorted(xincludeFileSet):
+      self.get_file_images(xmlfile)
+      for (imageFile, contentwidth, scale) in self.imageCache[xmlfile]:
+        if not (sibin.images.is_raster(imageFile) and self.context.sourceTree.exists(imageFile)):
+          continue
+        imagewidth = int(self.context.transformer.getImageWidth(imageFile))
+        if contentwidth:
+          match = re.match(r'^\s*(\d+)\s*(px)?\s*$', contentwidth)
+          # Widths in other units (such as % or cm) depend on the output format
+          width = int(match.group(1)) if match else imagewidth
+        elif scale:
+          width = imagewidth * int(scale) // 100
+        else:
+          width = imagewidth
+        widths[imageFile] = max(widths.get(imageFile, 0), width)
+    targetWidths = {}
+    for imageFile in widths:
+      if widths[imageFile] < int(self.context.transformer.getImageWidth(imageFile)):
+        targetWidths[imageFile] = max(widths[imageFile], 1)
+      else:
+        targetWidths[imageFile] = None
+    return targetWidths
+
+  def prepare_images(self,bookFiles):
+    '''
+    Optimize all of the raster images referenced by the specified books, in parallel
+    '''
+    images = set()
+    for bookFile in bookFiles:
+      (xincludeFileSet, imageFileSet) = self.analyze_book(bookFile)
+      images |= set(self.get_image_target_widths(xincludeFileSet).items())
+    self.context.imageOptimizer.prepare(images)
+  
+  def gen_book_dir(self,bookFile):
+    # Use the current profile name as the base directory name
+    genbasedir = self.context.currentProfile
+    (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+    return os.path.join(self.context.outputDir, genbasedir, bookRoot)
+
+  def gen_dirs(self,bookFile):
+    # Make the directories for this publican book
+    genbookdir = self.gen_book_dir(bookFile)
+    genlangdir = os.path.join(genbookdir, 'en-US')
+    if not os.path.exists(genlangdir):
+      os.makedirs(genlangdir)
+    return (genbookdir, genlangdir)
+
+  def gen_l10n_dirs(self,bookFile):
+    # Make the localization directories for this publican book
+    bookDir = os.path.dirname(bookFile)
+    genbookdir = os.path.join(bookDir, 'publican')
+    genlangdir = os.path.join(genbookdir, 'en-US')
+    if not os.path.exists(genlangdir):
+      os.makedirs(genlangdir)
+    return (genbookdir, genlangdir)
+
+  def library_order(self,bookSet):
+    '''
+    Return the books in bookSet as a list, in the order they are listed in sibin.cfg
+    '''
+    return [bookFile for bookFile in self.context.bookFiles if bookFile in bookSet]
+
+  def get_selected_books(self):
+    if self.selectedBooks is None:
+      return self.context.bookFiles
+    return self.selectedBooks
+
+  def select_shard(self,shardSpec):
+    '''
+    Restrict processing to the books in the specified shard, 'i/N'
+    '''
+    import sibin.index
+    (shard, shardCount) = sibin.index.parse_shard(shardSpec)
+    weights = dict([(bookFile, self.book_weight(bookFile)) for bookFile in self.context.bookFiles])
+    self.selectedBooks = sibin.index.shard_books(self.context.bookFiles, shard, shardCount, weights)
+    # Shards might run concurrently on the same host, so each needs its own restore file
+    self.restoreFile += '.shard' + str(shard) + 'of' + str(shardCount)
+    print 'Shard ' + shardSpec + ' contains ' + str(len(self.selectedBooks)) + ' of ' + str(len(self.context.bookFiles)) + ' books'
+
+  def book_weight(self,bookFile):
+    '''
+    Return the approximate size of bookFile, measured as the total size of its source files
+    (the book file, the files it xincludes, and their images), as read from the source tree.
+    This depends only on the checkout (or commit), not on any files generated on this host.
+    '''
+    sourceFiles = set([bookFile]) | self.parse_xincludes(bookFile)
+    for xmlfile in list(sourceFiles):
+      sourceFiles |= self.get_file_images(xmlfile)
+    return sum([self.context.sourceTree.getsize(filename) for filename in sourceFiles if self.context.sourceTree.exists(filename)])
+
+  def select_book(self,book):
+    '''
+    Restrict processing to one book, specified either by its book file or by its directory
+    '''
+    bookPath = os.path.normpath(book)
+    for bookFile in self.context.bookFiles:
+      if bookPath in (os.path.normpath(bookFile), os.path.dirname(os.path.normpath(bookFile))):
+        self.selectedBooks = [bookFile]
+        self.lazyLinkData = True
+        return
+    print 'Error: No such book as ' + book
+    sys.exit()
+
+  def apply_selection_args(self,args):
+    if args.book:
+      self.select_book(args.book)
+    if args.shard:
+      self.select_shard(args.shard)
+    if args.index:
+      self.linkIndexFile = args.index
+
+  def apply_image_args(self,args):
+    if args.optimize_images and getattr(args, 'at', None):
+      # The image tools read the images from the file system
+      print 'Error: The --optimize-images option cannot be combined with --at'
+      sys.exit(1)
+    self.optimizeImages = args.optimize_images
+
+  def apply_worker_args(self,args):
+    import sibin.disk
+    if args.max_rss:
+      self.maxRss = sibin.disk.parse_size(args.max_rss)
+    if args.books_per_worker:
+      self.booksPerWorker = int(args.books_per_worker)
+
+  def index_export(self,args):
+    import sibin.index
+    if args.shard:
+      self.select_shard(args.shard)
+    linkData = sibin.core.LinkData(self.context)
+    for bookFile in self.get_selected_books():
+      bookParser = sibin.core.BookParser(sibin.core.Book(bookFile))
+      bookParser.parse()
+      bookParser.appendLinkData(linkData)
+      self.catalog_book(bookParser)
+      del bookParser
+    sibin.index.save_index(args.output, linkData.export_index())
+    print 'Exported link index: ' + args.output
+
+  def index_merge(self,args):
+    import sibin.index
+    indexes = [sibin.index.load_index(filename) for filename in args.files]
+    sibin.index.save_index(args.output, sibin.index.merge_indexes(indexes))
+    print 'Merged link index: ' + args.output
+
+  def get_profiles(self, profiles=''):
+    '''
+    Return the list of profiles selected by the --profile option, which can specify
+    a single profile, a comma-separated list of profiles, or 'all'
+    '''
+    if not profiles:
+      if 'default' in self.context.profiles:
+        return ['default']
+      return [self.context.profiles[0]]
+    if profiles == 'all':
+      return list(self.context.profiles)
+    profileList = profiles.replace(' ','').split(',')
+    for profile in profileList:
+      if profile not in self.context.profiles:
+        print 'Error: No such profile as ' + profile
+        sys.exit()
+    return profileList
+
+  def for_each_profile(self,profiles,func):
+    '''
+    Call func() once for each of the specified profiles, with the current profile set accordingly,
+    and return a dictionary mapping each profile to the value returned by func().
+    If there is more than one profile, each call runs in its own child process,
+    which inherits all of the profile-independent state (parsed books, link data, and so on)
+    from this process.
+    '''
+    results = {}
+    if len(profiles) == 1:
+      self.set_current_profile(profiles[0])
+      results[profiles[0]] = func()
+      return results
+    children = []
+    for profile in profiles:
+      (parentConn, childConn) = multiprocessing.Pipe(False)
+      process = multiprocessing.Process(target=self._run_for_profile, args=(profile, func, childConn))
+      process.start()
+      childConn.close()
+      children.append((profile, process, parentConn))
+    isSuccess = True
+    for (profile, process, parentConn) in children:
+      try:
+        (results[profile], metricsSnapshot, diagnosticsSnapshot) = parentConn.recv()
+        sibin.metrics.collector.merge(metricsSnapshot)
+        sibin.diagnostics.collector.merge(diagnosticsSnapshot)
+      except EOFError:
+        print 'Error: processing failed for profile ' + profile
+        isSuccess = False
+      process.join()
+    if not isSuccess:
+      sys.exit(1)
+    return results
+
+  def _run_for_profile(self,profile,func,conn):
+    # Collect only this child's own metrics and warnings, which are merged into the parent's
+    sibin.metrics.collector.reset()
+    sibin.diagnostics.collector.reset()
+    cacheBaseline = self.cache_counters()
+    self.set_current_profile(profile)
+    result = func()
+    self.record_cache_metrics(cacheBaseline)
+    conn.send((result, sibin.metrics.collector.snapshot(), sibin.diagnostics.collector.snapshot()))
+    conn.close()
+
+  def cache(self,cacheName):
+    '''
+    Return the cache, cacheName (one of the keys of COUNTED_CACHES), creating it if necessary
+    '''
+    if COUNTED_CACHES[cacheName] is None:
+      return sibin.core.fileResolver
+    return getattr(self.context, COUNTED_CACHES[cacheName])
+
+  def caches(self):
+    '''
+    Return the caches that count their hits and misses and have already been created, indexed by
+    cache name. The context creates its caches on first use, so a cache that has not been used is
+    not created here either.
+    '''
+    caches = {}
+    for (cacheName, attribute) in COUNTED_CACHES.items():
+      if attribute is None or attribute in vars(self.context):
+        caches[cacheName] = self.cache(cacheName)
+    return caches
+
+  def cache_counters(self):
+    '''
+    Return the current (hits, misses) counts of each of the caches, indexed by cache name
+    (a cache that has not been created has no hits or misses)
+    '''
+    counters = dict([(cacheName, (0, 0)) for cacheName in COUNTED_CACHES])
+    for (cacheName, cache) in self.caches().items():
+      counters[cacheName] = (cache.hits, cache.misses)
+    return counters
+
+  def record_cache_metrics(self,cacheBaseline={}):
+    '''
+    Add the cache hits and misses since cacheBaseline (as returned by cache_counters()) to the metrics
+    '''
+    for (cacheName, (hits, misses)) in self.cache_counters().items():
+      (baseHits, baseMisses) = cacheBaseline.get(cacheName, (0, 0))
+      sibin.metrics.collector.count('sibin_cache_hits_total', hits - baseHits, cache=cacheName)
+      sibin.metrics.collector.count('sibin_cache_misses_total', misses - baseMisses, cache=cacheName)
+
+  def write_metrics(self,filename):
+    self.record_cache_metrics()
+    sibin.metrics.collector.write(filename)
+
+  def populate_link_data(self):
+    '''
+    Parse every book in the library and populate the topic link data,
+    unless this was already done in the current run
+    '''
+    import sibin.index
+    if self.linkDataPopulated:
+      return
+    if self.linkIndexFile:
+      # Use a previously exported (and possibly merged) link index instead
+      print 'Loading link index: ' + self.linkIndexFile
+      self.context.linkData.import_index(sibin.index.load_index(self.linkIndexFile))
+      self.linkDataPopulated = True
+      return
+    if self.lazyLinkData:
+      self.populate_selected_link_data()
+      self.linkDataPopulated = True
+      return
+    for bookFile in self.context.bookFiles:
+      with sibin.metrics.collector.timer('parse', bookFile):
+        bookParser = sibin.core.BookParser(sibin.core.Book(bookFile))
+        bookParser.parse()
+        bookParser.appendLinkData(self.context.linkData)
+        self.catalog_book(bookParser)
+        self.books[bookFile] = bookParser.book
+        del bookParser
+    self.linkDataPopulated = True
+
+  def populate_selected_link_data(self):
+    '''
+    Parse the selected books and populate the topic link data with their targets,
+    plus the targets of just those books that the selected books link to
+    (taken from the link index cache, wherever possible)
+    '''
+    targetdocs = set()
+    for bookFile in self.get_selected_books():
+      bookParser = sibin.core.BookParser(sibin.core.Book(bookFile))
+      bookParser.parse()
+      bookParser.appendLinkData(self.context.linkData)
+      self.catalog_book(bookParser)
+      self.books[bookFile] = bookParser.book
+      for targetdoc in bookParser.root.xpath("//*[local-name()='olink']/@targetdoc"):
+        targetdocs.add(targetdoc)
+      del bookParser
+    for bookFile in self.context.bookFiles:
+      if bookFile in self.get_selected_books():
+        continue
+      if self.get_root_id(bookFile) in targetdocs:
+        self.load_book_link_data(bookFile)
+
+  def get_root_id(self,xmlfile):
+    '''
+    Return the xml:id of the root element of xmlfile (for a book file, the book ID),
+    reading no further than the root element
+    '''
+    root = self.get_root_element(xmlfile)
+    return root.get('id') or root.get('{http://www.w3.org/XML/1998/namespace}id')
+
+  def get_root_element(self,xmlfile):
+    '''
+    Return the root element of xmlfile (with its attributes, but without its content),
+    reading no further than the root element
+    '''
+    for (event, root) in etree.iterparse(self.context.sourceTree.open(xmlfile), events=('start',), resolve_entities=False):
+      return root
+
+  def load_book_link_data(self,bookFile):
+    '''
+    Add the link data of bookFile from the link index cache, parsing the book only
+    if any of its files have changed since it was cached
+    '''
+    index = self.context.linkIndexCache.lookup(bookFile)
+    if index is None:
+      linkData = sibin.core.LinkData(self.context)
+      bookParser = sibin.core.BookParser(sibin.core.Book(bookFile))
+      bookParser.parse()
+      bookParser.appendLinkData(linkData)
+      self.catalog_book(bookParser)
+      del bookParser
+      index = linkData.export_index()
+      sourceFiles = set([bookFile]) | self.parse_xincludes(bookFile)
+      for xmlfile in list(sourceFiles):
+        sourceFiles |= self.get_file_entities(xmlfile)
+      self.context.linkIndexCache.store(bookFile, sourceFiles, index)
+    else:
+      print 'Using cached link data: ' + bookFile
+    self.context.linkData.import_index(index)
+    return index
+
+  def get_book(self,bookFile):
+    '''
+    Return the Book object (book metadata) for bookFile, taken from the book catalog where possible,
+    parsing the book only if necessary
+    '''
+    if bookFile not in self.books:
+      book = self.context.bookCatalog.lookup(bookFile)
+      if book is None:
+        bookParser = sibin.core.BookParser(sibin.core.Book(bookFile))
+        bookParser.parse()
+        self.catalog_book(bookParser)
+        book = bookParser.book
+        del bookParser
+      self.books[bookFile] = book
+    return self.books[bookFile]
+
+  def catalog_book(self,bookParser):
+    '''
+    Record the metadata of the book just parsed by bookParser in the book catalog (unless it is up to date)
+    '''
+    bookFile = bookParser.bookFile
+    if self.context.bookCatalog.load(bookFile) is None:
+      self.context.bookCatalog.store(bookFile, self.get_book_info_files(bookFile), bookParser.book)
+
+  def get_book_info_files(self,bookFile):
+    '''
+    Return the set of files that the metadata of bookFile is parsed from: the book file itself,
+    any file xincluded by the book element that holds its info block (or title), the files that
+    these include, and their entity files
+    '''
+    infoFiles = set([bookFile])
+    root = sibin.core.parse_xml(bookFile, resolve_entities=False).getroot()
+    for xinclude in root.iterchildren('{http://www.w3.org/2001/XInclude}include'):
+      href = xinclude.get('href') or xinclude.get('{http://www.w3.org/2001/XInclude}href')
+      if (not href) or (xinclude.get('parse', 'xml') != 'xml'):
+        continue
+      xincludeFile = os.path.normpath(os.path.join(os.path.dirname(bookFile),href))
+      if not self.context.sourceTree.exists(xincludeFile):
+        continue
+      tagname = self.get_root_element(xincludeFile).tag
+      if tagname.split('}')[-1] in ['info', 'bookinfo', 'title', 'subtitle']:
+        infoFiles.add(xincludeFile)
+        infoFiles |= self.parse_xincludes(xincludeFile)
+    for xmlfile in list(infoFiles):
+      infoFiles |= self.get_file_entities(xmlfile)
+    return infoFiles
+
+  def analyze_book(self,bookFile):
+    '''
+    Return the pair (xincludeFileSet, imageFileSet) for bookFile, where xincludeFileSet is the
+    set of recursively xincluded files, including the book file, and imageFileSet is
+    the set of image files referenced by the book
+    '''
+    xincludeFileSet = set()
+    xincludeFileSet.add(bookFile)
+    xincludeFileSet |= self.parse_xincludes(bookFile)
+    imageFileSet = set()
+    for xmlfile in xincludeFileSet:
+      imageFileSet |= self.get_file_images(xmlfile)
+    self.context.dependencyIndex.set_book(bookFile, self.get_book_dependencies(bookFile, xincludeFileSet, imageFileSet))
+    return (xincludeFileSet, imageFileSet)
+
+  def books_modified_since(self,specifiedmodtime):
+    '''
+    Return the set of books containing at least one file whose
+    date of last modification >= specifiedmodtime
+    '''
+    changedBooks = set()
+    for bookFile in self.get_selected_books():
+      (xincludeFileSet, imageFileSet) = self.analyze_book(bookFile)
+      for contentfile in (xincludeFileSet | imageFileSet):
+        filemodtime = self.context.git.mod_time(contentfile, self.context.sourceTree.revision)
+        if filemodtime >= specifiedmodtime:
+          changedBooks.add(bookFile)
+          break
+    self.context.dependencyIndex.save()
+    return changedBooks
+
+  def get_changed_books(self,args):
+    '''
+    Return the set of books selected by the --since, --modtime, or --sincelastcommit options,
+    or None, if all books are selected
+    '''
+    if args.since:
+      return self.books_changed_since(args.since)
+    elif args.modtime:
+      return self.books_modified_since(int(args.modtime))
+    elif (args.sincelastcommit):
+      return self.books_modified_since(self.context.git.last_commit_time(self.context.sourceTree.revision))
+    # By default, consider all modifications since the Unix epoch
+    return None
+
+  def prefetch_image_widths(self):
+    '''
+    Probe the widths of all the images referenced in the library, so that the results
+    can be shared by the child processes of a multi-profile run
+    '''
+    for bookFile in self.get_selected_books():
+      (xincludeFileSet, imageFileSet) = self.analyze_book(bookFile)
+      for imageFile in sorted(imageFileSet):
+        if self.context.sourceTree.exists(imageFile):
+          self.context.transformer.getImageWidth(imageFile)
+
+  def generate_publican(self,args):
+    profiles = self.get_profiles(args.profile)
+    self.apply_selection_args(args)
+    self.apply_worker_args(args)
+    self.apply_image_args(args)
+    self.context.filterConditions = args.filterconditions
+    changedBooks = self.get_changed_books(args)
+    # Profile-independent work is done once, before forking for the individual profiles
+    self.populate_link_data()
+    if len(profiles) > 1:
+      self.prefetch_image_widths()
+    self.for_each_profile(profiles, lambda: self._generate_publican(changedBooks))
+      
+  def localize(self,args):
+    self.set_current_profile(args.profile)
+    self._generate_publican(None,localize=True)
+    
+  def _generate_publican(self,changedBooks=None,localize=False):
+    '''
+    Generate the publican books selected by changedBooks (or all books, if changedBooks is None),
+    as well as any books whose olink targets have changed. Returns the set of generated books.
+    '''
+    self.populate_link_data()
+    # Load the template once, before generating any books (or forking any workers)
+    self.context.templateCache.get(self.context.gettemplate())
+    # Get the list of books we want to generate
+    if (localize):
+      booksToGenerate = self.context.localizedbooks
+    else:
+      booksToGenerate = self.get_selected_books()
+    # Start generating publican output
+    booksToRegenerate = []
+    for bookFile in booksToGenerate:
+      generateThisBook = (changedBooks is None) or (bookFile in changedBooks)
+      # Also regenerate the book, if any of the olinks it resolved in other books
+      # would now produce a different link URL or link text
+      if not generateThisBook and self.context.olinkRecords.changed(bookFile):
+        print 'Olink targets changed for: ' + bookFile
+        generateThisBook = True
+      # Also regenerate the book, if its generated directory has been removed (for example, by 'sibin gc')
+      if not generateThisBook and not localize and not os.path.exists(self.gen_book_dir(bookFile)):
+        sibin.diagnostics.collector.warn('generated-book-regenerated', bookFile, self.gen_book_dir(bookFile))
+        generateThisBook = True
+      if generateThisBook:
+        booksToRegenerate.append(bookFile)
+      else:
+        sibin.metrics.collector.count('sibin_books_total', state='skipped')
+    if self.optimizeImages and booksToRegenerate:
+      self.prepare_images(booksToRegenerate)
+    if self.maxRss or self.booksPerWorker:
+      self._generate_in_workers(booksToRegenerate, localize)
+    else:
+      for bookFile in booksToRegenerate:
+        self._generate_measured_book(bookFile, localize)
+    booksGenerated = set(booksToRegenerate)
+    self.context.dependencyIndex.save()
+    cache = self.context.fragmentCache
+    if cache.hits or cache.misses:
+      print 'Fragments reused: ' + str(cache.hits) + ', transformed: ' + str(cache.misses)
+    return booksGenerated
+
+  def _generate_measured_book(self,bookFile,localize=False):
+    '''
+    Generate bookFile, recording its duration and peak memory in the metrics,
+    and return the peak memory (in bytes)
+    '''
+    sibin.metrics.reset_peak_rss()
+    startTime = time.time()
+    with sibin.metrics.collector.timer('generate', bookFile):
+      self._generate_book(bookFile, localize)
+    if not localize:
+      # Record the generation time, for predicting the cost of the book (see 'sibin stats')
+      sourceFiles = self.parse_xincludes(bookFile) | set([bookFile])
+      sourceBytes = sum([self.context.sourceTree.getsize(xmlfile) for xmlfile in sourceFiles])
+      self.context.buildHistory.record(bookFile, sourceBytes, time.time() - startTime)
+    peakRss = sibin.metrics.peak_rss_since_reset()
+    sibin.metrics.collector.count('sibin_books_total', state='regenerated')
+    sibin.metrics.collector.maximum('sibin_book_peak_rss_bytes', peakRss, book=bookFile)
+    return peakRss
+
+  def _generate_in_workers(self,booksToRegenerate,localize=False):
+    '''
+    Generate the specified books in a sequence of worker processes. Each worker inherits the link
+    data from this process and exits after generating booksPerWorker books, or as soon as its
+    resident memory exceeds maxRss, so that the memory fragmented by parsing and transforming
+    books is returned to the system, instead of accumulating over the whole run.
+    '''
+    remaining = list(booksToRegenerate)
+    while remaining:
+      (parentConn, childConn) = multiprocessing.Pipe(False)
+      process = multiprocessing.Process(target=self._generation_worker, args=(remaining, localize, childConn))
+      # Flush first, so that the worker does not inherit (and print again) any buffered output
+      sys.stdout.flush()
+      process.start()
+      childConn.close()
+      try:
+        while True:
+          message = parentConn.recv()
+          if message[0] == 'book':
+            remaining.remove(message[1])
+          else:
+            (metricsSnapshot, diagnosticsSnapshot, cacheDeltas, imageWidths) = message[1:]
+            sibin.metrics.collector.merge(metricsSnapshot)
+            sibin.diagnostics.collector.merge(diagnosticsSnapshot)
+            for (cacheName, (hits, misses)) in cacheDeltas.items():
+              if hits or misses:
+                cache = self.cache(cacheName)
+                cache.hits += hits
+                cache.misses += misses
+            # Pass on the image widths probed by this worker to the next worker
+            self.context.transformer.imageWidths.update(imageWidths)
+            break
+      except EOFError:
+        # For example, if the worker was killed for running out of memory
+        print 'Error: worker process failed while generating ' + remaining[0]
+        process.join()
+        sys.exit(1)
+      process.join()
+      if remaining:
+        print 'Recycling worker process'
+
+  def _generation_worker(self,bookFiles,localize,conn):
+    import sibin.disk
+    # Collect only this worker's own metrics and warnings, which are merged into the parent's
+    sibin.metrics.collector.reset()
+    sibin.diagnostics.collector.reset()
+    cacheBaseline = self.cache_counters()
+    knownImages = set(self.context.transformer.imageWidths)
+    booksGenerated = 0
+    for bookFile in bookFiles:
+      peakRss = self._generate_measured_book(bookFile, localize)
+      booksGenerated += 1
+      print 'Peak memory for ' + bookFile + ': ' + sibin.disk.format_size(peakRss)
+      sys.stdout.flush()
+      conn.send(('book', bookFile))
+      if self.booksPerWorker and booksGenerated >= self.booksPerWorker:
+        break
+      if self.maxRss and sibin.metrics.current_rss() > self.maxRss:
+        break
+    self.context.dependencyIndex.save()
+    cacheDeltas = {}
+    for (cacheName, (hits, misses)) in self.cache_counters().items():
+      (baseHits, baseMisses) = cacheBaseline[cacheName]
+      cacheDeltas[cacheName] = (hits - baseHits, misses - baseMisses)
+    imageWidths = {}
+    for (imageFile, width) in self.context.transformer.imageWidths.items():
+      if imageFile not in knownImages:
+        imageWidths[imageFile] = width
+    conn.send(('exit', sibin.metrics.collector.snapshot(), sibin.diagnostics.collector.snapshot(), cacheDeltas, imageWidths))
+    conn.close()
+
+  def _generate_book(self,bookFile,localize=False):
+    print 'Generating: ' + bookFile
+    bookParser = sibin.core.BookParser(self.get_book(bookFile))
+    # Need to compile a list of all the image files referenced by
+    # each book and copy all of those images files into the en-US/images sub-directory.
+    # Also need to check each fileref attribute, to make sure it has the form
+    # fileref="images/<imagefile>.<ext>" , modifying it if necessary.
+    (xincludeFileSet, imageFileSet) = self.analyze_book(bookFile)
+    # Get the directories for this publican book
+    if (localize):
+      (genbookdir, genlangdir) = self.gen_l10n_dirs(bookFile)
+    else:
+      (genbookdir, genlangdir) = self.gen_dirs(bookFile)
+    # Create an image file map, used to locate image files
+    # (iterating in sorted order, so that the choice between images with
+    # identical base file names does not vary from run to run)
+    imageFileMap = {}
+    for imageFile in sorted(imageFileSet):
+      imageFileMap[os.path.basename(imageFile)] = imageFile
+    self.context.imageFileMap = imageFileMap
+    # print 'imageFileSet for book [' + bookFile + '] is: ' + str(imageFileSet)
+    # Transform the main publican book file
+    publicanBookRoot = bookParser.book.title.replace(' ','_')
+    genbookfile = os.path.join(genlangdir, publicanBookRoot + '.xml')
+    transformedContent = None
+    if not localize:
+      (transformedContent, usedImages) = self._transform_book_fragments(bookFile, bookParser.book.id)
+    if transformedContent is not None:
+      # Write the main publican book file, reassembled from fragments
+      self.save_string_to_xml_file('book', transformedContent, genbookfile, publicanBookRoot + '.ent')
+    else:
+      doc = sibin.core.parse_xml(bookFile,resolve_entities=False)
+      doc.xinclude()
+      root = doc.getroot()
+      if (localize):
+        # Resolve entities using the library entities file
+        # (the book's own entity declarations do not apply to the xincluded files)
+        root = self.expand_entities(root, set([bookFile]) | self.parse_xincludes(bookFile))
+      transformedBook = self.context.transformer.dcbk2publican(root, bookFile, bookParser.book.id)
+      usedImages = self.context.transformer.usedImages
+      self.context.olinkRecords.save(bookFile, self.context.transformer.resolvedOlinks)
+      # Write the main publican book file
+      self.save_doc_to_xml_file(transformedBook, genbookfile, publicanBookRoot + '.ent')
+    # Copy image files to en-US/images sub-directory
+    # (if sibin filters conditions, only the images referenced by the remaining content)
+    genimagesdir = os.path.join(genlangdir, 'images')
+    if not os.path.exists(genimagesdir):
+      os.makedirs(genimagesdir)
+    if self.context.filterConditions:
+      imageFileSet = imageFileSet & usedImages
+    targetWidths = {}
+    if self.optimizeImages:
+      targetWidths = self.get_image_target_widths(xincludeFileSet)
+    for imageFile in sorted(imageFileSet):
+      genimagefile = os.path.join(genimagesdir, os.path.basename(imageFile) )
+      if imageFile in targetWidths:
+        shutil.copyfile(self.context.imageOptimizer.optimized_file(imageFile, targetWidths[imageFile]), genimagefile)
+      else:
+        self.context.sourceTree.copy(imageFile, genimagefile)
+      sibin.metrics.collector.count('sibin_image_bytes_copied_total', os.path.getsize(genimagefile))
+      # ToDo: Really ought to disambiguate file names in case
+      # where two base file names are identical
+    # Copy boilerplate images from the 'template/images' directory
+    templatedir = self.context.gettemplate()
+    template = self.context.templateCache.get(templatedir)
+    templateimagesdir = os.path.join(templatedir,'images')
+    for imageFile in template.images:
+      self.context.sourceTree.copy(os.path.join(templateimagesdir,imageFile), os.path.join(genimagesdir,imageFile))
+    # Remove any images left over from earlier runs (for example, images referenced only by content
+    # that is now excluded), so that the generated book does not depend on what was generated before
+    copiedImages = set([os.path.basename(imageFile) for imageFile in imageFileSet]) | set(template.images)
+    for imageFile in os.listdir(genimagesdir):
+      if imageFile not in copiedImages and os.path.isfile(os.path.join(genimagesdir, imageFile)):
+        os.remove(os.path.join(genimagesdir, imageFile))
+    # Copy the entities file
+    genentitiesfile = os.path.join(genlangdir, publicanBookRoot + '.ent')
+    self.context.sourceTree.copy(self.context.bookEntitiesFile, genentitiesfile)
+    # Write the publican.cfg file from the template, with additional settings
+    genpublicancfg = os.path.join(genbookdir, 'publican.cfg')
+    with open(genpublicancfg, 'w') as filehandle:
+      filehandle.write(template.files['publican.cfg'])
+      conditions = self.context.getconditions()
+      if conditions:
+        filehandle.write('condition: ' + conditions + '\n')
+      if bookFile in self.context.sortorder:
+        filehandle.write('sort_order: ' + self.context.sortorder[bookFile] + '\n')
+      if bookFile in self.context.book2publicanprops:
+        publicanprops = self.context.book2publicanprops[bookFile]
+        for name in publicanprops:
+          filehandle.write(name + ': ' + publicanprops[name] + '\n')
+    # Write the template files
+    for filename in ['Author_Group.xml', 'Preface.xml']:
+      with open(os.path.join(genlangdir, filename), 'w') as f:
+        f.write(template.files[filename])
+    # Write the revision history and book info files, filled in with the book's details
+    with open(os.path.join(genlangdir, 'Revision_History.xml'), 'w') as f:
+      f.write(template.render_revhistory(publicanBookRoot))
+    with open(os.path.join(genlangdir, 'Book_Info.xml'), 'w') as f:
+      f.write(template.render_book_info(bookParser.book, publicanBookRoot))
+    # Copy files from files/ subdirectory
+    filesdir = os.path.normpath(os.path.join(os.path.dirname(bookFile),'files'))
+    genfilesdir = os.path.join(genlangdir, 'files')
+    if self.context.sourceTree.exists(filesdir):
+      if not os.path.exists(genfilesdir):
+        os.makedirs(genfilesdir)
+      for filesFile in sorted(self.context.sourceTree.listdir(filesdir)):
+        self.context.sourceTree.copy(os.path.join(filesdir,filesFile), os.path.join(genfilesdir,filesFile))
+
+  def resolve_fragment(self,bookFile,xinclude):
+    '''
+    Return the element included by xinclude, a top-level xi:include element of bookFile
+    '''
+    # Resolve the xi:include inside a stand-in for the book element, so that
+    # it gets exactly the same treatment as when the whole book is xincluded
+    wrapper = sibin.core.parse_xml_string('<wrapper>' + etree.tostring(xinclude, with_tail=False) + '</wrapper>', resolve_entities=False, base_url=bookFile)
+    etree.ElementTree(wrapper).xinclude()
+    return wrapper.find('*')
+
+  def _transform_book_fragments(self,bookFile,bookId):
+    '''
+    Transform bookFile one top-level xi:include at a time, so that the cached
+    transformation of a fragment can be reused whenever none of the files in its include
+    closure (or the images they reference) have changed. Returns the serialized
+    transformed book element and the set of images it references,
+    or (None, None) if the book cannot be split into fragments.
+    '''
+    doc = sibin.core.parse_xml(bookFile,resolve_entities=False)
+    root = doc.getroot()
+    xincludeTag = '{http://www.w3.org/2001/XInclude}include'
+    fragments = []
+    for xinclude in root.iterchildren(xincludeTag):
+      href = xinclude.get('href') or xinclude.get('{http://www.w3.org/2001/XInclude}href')
+      if (not href) or (xinclude.get('parse', 'xml') != 'xml') or (xinclude.get('xpointer') is not None):
+        return (None, None)
+      fragments.append((xinclude, href))
+    # Any xi:include elements nested deeper in the book file itself must be
+    # resolved in the context of the whole book
+    if len(root.findall('.//' + xincludeTag)) != len(fragments):
+      return (None, None)
+    cache = self.context.fragmentCache
+    index = cache.load_index(bookFile)
+    newIndex = {}
+    salt = '\0'.join([bookId, self.context.hostnames.get(self.context.currentProfile, ''), self.context.productname, self.context.productversion])
+    if self.context.filterConditions:
+      salt += '\0' + ';'.join(sorted(self.context.getconditionset()))
+    fragmentContent = []
+    resolvedOlinks = {}
+    usedImages = set()
+    for (xinclude, href) in fragments:
+      fragmentFile = os.path.normpath(os.path.join(os.path.dirname(bookFile),href))
+      closure = set([fragmentFile]) | self.parse_xincludes(fragmentFile)
+      dependencies = set(closure)
+      for xmlfile in closure:
+        dependencies |= self.get_file_images(xmlfile)
+      digest = sibin.cache.digest_files(dependencies, salt, self.context.sourceTree)
+      content = cache.lookup(bookFile, index, href, digest)
+      if content is None:
+        fragment = self.resolve_fragment(bookFile, xinclude)
+        transformer = self.context.transformer
+        # Record the fragment's warnings in its cache entry, to be reported again whenever the fragment is reused
+        with sibin.diagnostics.collector.recording() as diagnostics:
+          transformedFragment = transformer.dcbk2publican(fragment, fragmentFile, bookId)
+        if transformer.isExcluded(transformedFragment):
+          # The whole fragment is excluded by the profile conditions
+          content = ''
+          transformer.resolvedOlinks = {}
+          transformer.usedImages = set()
+        else:
+          content = etree.tostring(transformedFragment, with_tail=False)
+        cache.store(bookFile, newIndex, href, digest, content, transformer.resolvedOlinks, sorted(transformer.usedImages), sibin.diagnostics.collector.export(diagnostics))
+        del fragment
+      else:
+        newIndex[href] = index[href]
+        sibin.diagnostics.collector.replay(newIndex[href]['diagnostics'])
+      resolvedOlinks.update(newIndex[href]['olinks'])
+      usedImages.update(newIndex[href].get('images', []))
+      fragmentContent.append(content)
+    # Transform the rest of the book, leaving a placeholder for each fragment
+    transformedBook = self.context.transformer.dcbk2publican(root, bookFile, bookId)
+    resolvedOlinks.update(self.context.transformer.resolvedOlinks)
+    usedImages.update(self.context.transformer.usedImages)
+    placeholders = []
+    for (i, xinclude) in enumerate(transformedBook.iterchildren(xincludeTag)):
+      placeholders.append((xinclude, etree.ProcessingInstruction('sibin-fragment', str(i))))
+    for (xinclude, placeholder) in placeholders:
+      placeholder.tail = xinclude.tail
+      transformedBook.replace(xinclude, placeholder)
+    content = etree.tostring(transformedBook)
+    for (i, fragment) in enumerate(fragmentContent):
+      content = content.replace('<?sibin-fragment ' + str(i) + '?>', fragment, 1)
+    cache.save_index(bookFile, newIndex)
+    self.context.olinkRecords.save(bookFile, resolvedOlinks)
+    del doc
+    return (content, usedImages)
+      
+  def build_publican(self,args):
+    profiles = self.get_profiles(args.profile)
+    self.apply_selection_args(args)
+    self.apply_worker_args(args)
+    self.apply_image_args(args)
+    self.context.filterConditions = args.filterconditions
+    changedBooks = None
+    if not args.nogen:
+      changedBooks = self.get_changed_books(args)
+      # Profile-independent work is done once, before forking for the individual profiles
+      self.populate_link_data()
+      if len(profiles) > 1:
+        self.prefetch_image_widths()
+    self.for_each_profile(profiles, lambda: self._build_profile(args, changedBooks, len(profiles) > 1))
+
+  def _build_profile(self,args,changedBooks,isMultiProfile=False):
+    if isMultiProfile:
+      # Profiles are built concurrently, so each needs its own restore file
+      self.restoreFile += '.' + self.context.currentProfile
+    # First phase, generate the publican books
+    if not args.nogen:
+      booksToBuild = self._generate_publican(changedBooks)
+    elif args.since:
+      booksToBuild = self.books_changed_since(args.since)
+    else:
+      # If 'nogen', assume that all of the books have already been generated
+      booksToBuild = set(self.get_selected_books())
+    # Parse --format command-line argument
+    formats = ['html', 'html-single']
+    if args.formats:
+      formatsMinusSpaces = args.formats.replace(' ','')
+      if ',' in formatsMinusSpaces:
+        formats = formatsMinusSpaces.split(',')
+      else:
+        formats = [ formatsMinusSpaces ]
+    print 'Building the following formats: ' + str(formats)
+    # Second phase, build the books
+    self._build_publican(booksToBuild,formats)
+
+  def _build_publican(self,booksToBuild,formats):
+    # Check whether the previous build was aborted
+    previouslyBuiltBooks = self.restore_file_read()
+    if previouslyBuiltBooks:
+      sibin.diagnostics.collector.warn('build-restored', '')
+    # Start building publican books
+    genbasedir = self.context.currentProfile
+    langs = 'en-US'
+    isBuildSuccess = True
+    booksToBuild = booksToBuild - previouslyBuiltBooks
+    # Build the books in library order (not in set order), so that runs are reproducible
+    for bookFile in self.library_order(booksToBuild):
+      # Get the directory name for this publican book
+      (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+      genbookdir = os.path.join(genbasedir, bookRoot)
+      if not os.path.exists(genbookdir):
+        sibin.diagnostics.collector.warn('generated-book-missing', bookFile, genbookdir)
+        isBuildSuccess = False
+        continue
+      # Invoke 'publican' to build the book
+      cwd = os.getcwd()
+      os.chdir(genbookdir)
+      sibin.metrics.collector.count('sibin_subprocess_total', tool='publican')
+      with sibin.metrics.collector.timer('build', bookFile):
+        subprocess.check_call(['publican','build','--langs',langs,'--formats',','.join(formats)])
+      os.chdir(cwd)
+      self.restore_file_append(bookFile)
+      sibin.metrics.collector.count('sibin_books_total', state='built')
+    # Clean up restore file
+    if isBuildSuccess:
+      self.restore_file_delete()
+
+  def publish(self,args):
+    self.check_kerberos_ticket()
+    self.set_current_profile(args.profile)
+    if not args.nogen:
+      # First phase, generate publican books
+      if args.modtime:
+        booksToPublish = self._generate_publican(self.books_modified_since(int(args.modtime)))
+      else:
+        # By default, consider all modifications since the Unix epoch
+        booksToPublish = self._generate_publican()
+    # Second phase, publish books
+    if args.all and not args.changed and not args.book and not args.modtime:
+      for bookFile in self.context.bookFiles:
+        self._publish_book(bookFile)
+    elif args.changed and not args.book and not args.all and not args.modtime:
+      isGitIndexChanged = False
+      for bookFile in self.context.bookFiles:
+        checksum = self.get_checksum(bookFile)
+        checksumFile = bookFile + '.sha'
+        # Try to retrieve a saved checksum value
+        savedChecksum = ''
+        if os.path.exists(checksumFile):
+          with open(checksumFile, 'r') as f:
+            savedChecksum = f.readline().strip()
+        if savedChecksum != checksum:
+          self._publish_book(bookFile,checksum)
+          isGitIndexChanged = True
+      # Commit the new checksums
+      if isGitIndexChanged:
+        self.context.git.commit()
+    elif args.book and not args.all and not args.changed and not args.modtime:
+      if os.path.exists(args.book):
+        bookFile = args.book
+        checksum = self.get_checksum(bookFile)
+        checksumFile = bookFile + '.sha'
+        # Try to retrieve a saved checksum value
+        savedChecksum = ''
+        if os.path.exists(checksumFile):
+          with open(checksumFile, 'r') as f:
+            savedChecksum = f.readline().strip()
+        if savedChecksum:
+          self._publish_book(bookFile,checksum)
+          # Commit the new checksum
+          if savedChecksum != checksum:
+            self.context.git.commit()
+        else:
+          self._publish_book(bookFile)          
+      else:
+        print 'Error: no such book - ' + args.book
+    elif args.modtime and not args.all and not args.changed and not args.book:
+      for bookFile in self.library_order(booksToPublish):
+        self._publish_book(bookFile)
+    else:
+      print 'Error: must specify exactly ONE of the options --all, --changed, or --book'
+      
+
+  def _publish_book(self,bookFile,newChecksum=''):
+    print 'Publishing book: ' + bookFile
+    book = self.get_book(bookFile)
+    # Get the directories for this publican book
+    (genbookdir, genlangdir) = self.gen_dirs(bookFile)
+    # rhpkg publican-build --lang en-US --message "commit message"
+    cwd = os.getcwd()
+    os.chdir(genbookdir)
+    sibin.metrics.collector.count('sibin_subprocess_total', tool='rhpkg')
+    with sibin.metrics.collector.timer('publish', bookFile):
+      response = subprocess.call(['rhpkg', 'publican-build', '--nowait', '--lang', 'en-US', '--message','Build ' + self.context.buildversion])
+    os.chdir(cwd)
+    sibin.metrics.collector.count('sibin_books_total', state='published')
+    if response != 0:
+      print 'Error: failed to build book: ' + bookFile
+      # Don't be too fussy about returning early -- network problems sometimes cause benign errors
+      # return
+    # Append 'brew tag-pkg' command for this book
+    buildID = self.context.productname.replace(' ','_') + '-' + book.title.replace(' ','_') + '-' + self.context.productversion + '-web-en-US-' + self.context.productversion + '-' + self.context.buildversion + '.el6eng'
+    line = 'brew tag-pkg docs-rhel-6 ' + buildID
+    filename = 'brew-tag' + '.' + self.context.buildversion
+    with open(filename, 'a') as f:
+      f.write(line + '\n')
+    # Append build ID to email content for this book
+    line = buildID
+    filename = 'email' + '.' + self.context.buildversion
+    with open(filename, 'a') as f:
+      f.write(line + '\n')
+    # If upload is successful, save the new checksum and add to git
+    if newChecksum:
+      checksumFile = bookFile + '.sha'
+      with open(checksumFile, 'w') as f:
+        f.write(newChecksum)
+      self.context.git.add(checksumFile)
+      self.context.git.append_message('sibin: build ' + self.context.buildversion + ': saved checksum for ' + bookFile)
+    
+  def checksum(self,args):
+    if args.save and args.at:
+      print 'Error: The --save option cannot be combined with --at'
+      sys.exit(1)
+    if args.save:
+      self._checksum_save()
+    elif args.listchanged:
+      self._checksum_listchanged()
+    else:
+      self._checksum()
+  
+  def _checksum_save(self):
+    isGitIndexChanged = False
+    for bookFile in self.context.bookFiles:
+      checksum = self.get_checksum(bookFile)
+      print bookFile + '\t' + checksum
+      checksumFile = bookFile + '.sha'
+      with open(checksumFile, 'w') as f:
+        f.write(checksum)
+      self.context.git.add(checksumFile)
+      isGitIndexChanged = True
+    if isGitIndexChanged:
+      self.context.git.commit('sibin: saved XML document checksums')
+
+  def _checksum_listchanged(self):
+    for bookFile in self.context.bookFiles:
+      checksum = self.get_checksum(bookFile)
+      checksumFile = bookFile + '.sha'
+      # Try to retrieve a saved checksum value
+      savedChecksum = ''
+      if self.context.sourceTree.exists(checksumFile):
+        f = self.context.sourceTree.open(checksumFile)
+        savedChecksum = f.readline().strip()
+        f.close()
+      if savedChecksum != checksum:
+        print bookFile + '\t' + checksum
+      
+  def _checksum(self):
+    for bookFile in self.context.bookFiles:
+      checksum = self.get_checksum(bookFile)
+      print bookFile + '\t' + checksum
+  
+  def zip(self,args):
+    import sibin.archive
+    self.set_current_profile(args.profile)
+    archiveFormat = args.format
+    archiveFile = args.output or os.path.join('zip', self.context.productname.replace(' ','_') + '-' + self.context.productversion + '.' + archiveFormat)
+    print 'Creating a ' + archiveFormat + ' archive: ' + archiveFile
+    partsdir = os.path.join(self.context.cacheDir, 'archive', self.context.currentProfile)
+    if not os.path.exists(partsdir):
+      os.makedirs(partsdir)
+    partFiles = []
+    tasks = []
+    signatures = {}
+    for bookFile in self.context.bookFiles:
+      genbookdir = self.gen_book_dir(bookFile)
+      # Define the directories to copy from
+      fromhtmldir = os.path.join(genbookdir,'tmp','en-US','html')
+      fromhtmlsingledir = os.path.join(genbookdir,'tmp','en-US','html-single')
+      # Define the directories to copy to
+      tobookdir = '/'.join([self.context.productname.replace(' ','_'), self.context.productversion, self.get_publican_book_root(bookFile)])
+      sources = []
+      if os.path.exists(fromhtmldir):
+        sources.append((fromhtmldir, tobookdir + '/html'))
+      if os.path.exists(fromhtmlsingledir):
+        sources.append((fromhtmlsingledir, tobookdir + '/html-single'))
+      if not sources:
+        continue
+      # Reuse the archive part from the previous run, if the book's build output is unchanged
+      (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+      partFile = os.path.join(partsdir, bookRoot + '.' + archiveFormat)
+      signatureFile = partFile + '.json'
+      signatures[signatureFile] = sibin.archive.part_signature(archiveFormat, sources)
+      if not os.path.exists(partFile) or sibin.cache.load_json(signatureFile) != signatures[signatureFile]:
+        tasks.append((partFile, archiveFormat, sources))
+      partFiles.append(partFile)
+    sibin.archive.write_parts(tasks)
+    for (partFile, archiveFormat, sources) in tasks:
+      sibin.cache.save_json(partFile + '.json', signatures[partFile + '.json'])
+    sibin.archive.assemble(archiveFormat, partFiles, archiveFile)
+    print 'Archive parts reused: ' + str(len(partFiles) - len(tasks)) + ', written: ' + str(len(tasks))
+
+  def get_publican_book_root(self,bookFile):
+    '''
+    Return the title of bookFile, as used in publican file names (with spaces replaced by underscores),
+    taken from the generated book where possible, to avoid parsing the book
+    '''
+    genlangdir = os.path.join(self.gen_book_dir(bookFile), 'en-US')
+    entityFiles = glob.glob(os.path.join(genlangdir, '*.ent'))
+    if len(entityFiles) == 1:
+      return os.path.splitext(os.path.basename(entityFiles[0]))[0]
+    return self.get_book(bookFile).title.replace(' ','_')
+
+  def preview(self,args):
+    import sibin.preview
+    startTime = time.time()
+    self.set_current_profile(args.profile)
+    self.select_book(args.book)
+    bookFile = self.get_selected_books()[0]
+    (bookRoot, ext) = os.path.splitext(os.path.basename(bookFile))
+    # Load the book's own link data (for the titles of cross-references) from the link index cache
+    bookIndex = self.load_book_link_data(bookFile)
+    bookId = self.get_root_id(bookFile)
+    bookTitle = [book['title'] for book in bookIndex['books'] if book['id'] == bookId][0]
+    previewdir = os.path.join('preview', bookRoot)
+    if args.chapter:
+      (element, contentFiles) = self.find_chapter(bookFile, args.chapter)
+      previewfile = os.path.join(previewdir, args.chapter + '.html')
+    else:
+      doc = sibin.core.parse_xml(bookFile,resolve_entities=False)
+      doc.xinclude()
+      element = doc.getroot()
+      contentFiles = set([bookFile]) | self.parse_xincludes(bookFile)
+      previewfile = os.path.join(previewdir, 'index.html')
+    # Expand entities using the library entities file, so that they render in the preview
+    element = self.expand_entities(element, contentFiles)
+    # Load the link data of the other books that this content links to
+    targetdocs = set(element.xpath("descendant-or-self::*[local-name()='olink']/@targetdoc")) - set([bookId])
+    for otherBookFile in self.context.bookFiles:
+      if otherBookFile != bookFile and self.get_root_id(otherBookFile) in targetdocs:
+        self.load_book_link_data(otherBookFile)
+    imageFileMap = {}
+    for xmlfile in contentFiles:
+      for imageFile in sorted(self.get_file_images(xmlfile)):
+        imageFileMap[os.path.basename(imageFile)] = imageFile
+    self.context.imageFileMap = imageFileMap
+    transformer = self.context.transformer
+    transformed = transformer.dcbk2publican(element, bookFile, bookId)
+    renderer = sibin.preview.PreviewRenderer(self.context, args.stylesheet)
+    renderer.resolve_external_xrefs(transformed, bookId, 'index.html')
+    html = renderer.render(transformed, bookTitle)
+    imagesdir = os.path.join(previewdir, 'images')
+    if not os.path.exists(imagesdir):
+      os.makedirs(imagesdir)
+    with open(previewfile, 'w') as f:
+      f.write(html)
+    for imageFile in sorted(transformer.usedImages):
+      shutil.copyfile(imageFile, os.path.join(imagesdir, os.path.basename(imageFile)))
+    print 'Preview: ' + previewfile + ' (' + ('%.2f' % (time.time() - startTime)) + 's)'
+
+  def find_chapter(self,bookFile,chapterId):
+    '''
+    Return the pair (element, contentFiles) for the element of bookFile with the xml:id, chapterId,
+    where contentFiles is the set of files the element was parsed from. If the element is the root
+    of a top-level xi:include, only that xi:include is parsed.
+    '''
+    doc = sibin.core.parse_xml(bookFile,resolve_entities=False)
+    root = doc.getroot()
+    for xinclude in root.iterchildren('{http://www.w3.org/2001/XInclude}include'):
+      href = xinclude.get('href') or xinclude.get('{http://www.w3.org/2001/XInclude}href')
+      if (not href) or (xinclude.get('parse', 'xml') != 'xml') or (xinclude.get('xpointer') is not None):
+        continue
+      fragmentFile = os.path.normpath(os.path.join(os.path.dirname(bookFile),href))
+      if self.get_root_id(fragmentFile) == chapterId:
+        return (self.resolve_fragment(bookFile, xinclude), set([fragmentFile]) | self.parse_xincludes(fragmentFile))
+    # Otherwise, search the whole book
+    doc.xinclude()
+    for element in doc.getroot().xpath("//*[@id=$val or @xml:id=$val]", val=chapterId):
+      return (element, set([bookFile]) | self.parse_xincludes(bookFile))
+    print 'Error: No element with ID ' + chapterId + ' in ' + bookFile
+    sys.exit()
+
+  def validate(self,args):
+    import sibin.validation
+    schemaFile = args.schema or self.context.schemaFile or sibin.validation.find_default_schema()
+    if not schemaFile:
+      print 'Error: No schema found. Specify one with --schema or with the <schema file="..."/> element in sibin.cfg'
+      sys.exit(1)
+    try:
+      sibin.validation.load_schema(schemaFile)
+    except Exception as e:
+      print 'Error: Cannot load the schema ' + schemaFile + ': ' + str(e)
+      sys.exit(1)
+    if args.book:
+      self.select_book(args.book)
+    results = self.context.validationResults
+    schemaFiles = sibin.validation.schema_files(schemaFile)
+    bookDigests = {}
+    errors = {}
+    booksToValidate = []
+    for bookFile in self.get_selected_books():
+      # The digest covers the schema (with the files it includes) and every file that the book is parsed from
+      try:
+        sourceFiles = set([bookFile, self.context.bookEntitiesFile]) | schemaFiles | self.parse_xincludes(bookFile)
+      except Exception:
+        # Broken xi:includes or malformed XML are reported by the validation itself (and never cached)
+        booksToValidate.append(bookFile)
+        continue
+      for xmlfile in list(sourceFiles):
+        if xmlfile.endswith('.xml'):
+          sourceFiles |= self.get_file_entities(xmlfile)
+      bookDigests[bookFile] = sibin.cache.digest_files([filename for filename in sourceFiles if os.path.exists(filename)], os.path.abspath(schemaFile))
+      cachedErrors = results.lookup(bookFile, bookDigests[bookFile])
+      if cachedErrors is None:
+        booksToValidate.append(bookFile)
+      else:
+        errors[bookFile] = cachedErrors
+    print 'Validating ' + str(len(booksToValidate)) + ' books against ' + schemaFile + ' (' + str(len(errors)) + ' unchanged since the last validation)'
+    newErrors = sibin.validation.validate_books(schemaFile, booksToValidate, args.jobs)
+    for bookFile in booksToValidate:
+      if bookFile in bookDigests:
+        results.store(bookFile, bookDigests[bookFile], newErrors[bookFile])
+    errors.update(newErrors)
+    results.save()
+    invalidBooks = [bookFile for bookFile in self.get_selected_books() if errors[bookFile]]
+    for bookFile in invalidBooks:
+      print 'INVALID: ' + bookFile
+      for error in errors[bookFile]:
+        print '    ' + error
+    print 'Books validated: ' + str(len(errors)) + ', invalid: ' + str(len(invalidBooks))
+    if invalidBooks:
+      sys.exit(1)
+
+  def stats(self,args):
+    import sibin.stats
+    if args.book:
+      self.select_book(args.book)
+    bookStatsList = []
+    for bookFile in self.get_selected_books():
+      bookStatsList.append(sibin.stats.BookStats(bookFile).collect())
+    sibin.stats.predict_costs(self.context.buildHistory, bookStatsList)
+    rows = [bookStats.to_dict() for bookStats in bookStatsList]
+    if args.output:
+      with open(args.output, 'w') as f:
+        f.write(sibin.stats.to_json(rows) + '\n')
+    if args.json:
+      print sibin.stats.to_json(rows)
+    else:
+      print sibin.stats.to_table(rows)
+
+  def links(self,args):
+    '''
+    Check every olink in the library against the link index, without transforming any books
+    '''
+    import sibin.index
+    import sibin.links
+    self.set_current_profile(args.profile)
+    if args.index:
+      self.context.linkData.import_index(sibin.index.load_index(args.index))
+    else:
+      for bookFile in self.context.bookFiles:
+        self.load_book_link_data(bookFile)
+    conditionSet = self.context.getconditionset()
+    scanners = []
+    for bookFile in self.context.bookFiles:
+      scanners.append(sibin.links.OlinkScanner(bookFile, conditionSet).scan())
+    problems = sibin.links.check_olinks(self.context.linkData, scanners)
+    if args.output:
+      with open(args.output, 'w') as f:
+        f.write(sibin.links.to_json(scanners, problems) + '\n')
+    if args.json:
+      print sibin.links.to_json(scanners, problems)
+    else:
+      print sibin.links.to_text(scanners, problems)
+    if problems:
+      sys.exit(1)
+
+  def clean(self,args):
+    print 'Cleaning sibin files'
+    # Clean the generated files from all of the profiles
+    for genbasedir in self.context.profiles:
+      self.context.diskCollector.discard(genbasedir)
+    self.context.diskCollector.purge()
+    for restoreFile in glob.glob(self.restoreFile + '*'):
+      os.unlink(restoreFile)
+
+  def gc(self,args):
+    import sibin.disk
+    print 'Collecting garbage'
+    budget = None
+    if args.budget:
+      budget = sibin.disk.parse_size(args.budget)
+    self.context.diskCollector.collect(budget, args.dry_run)
+    # Also forget the dependencies of books that are no longer in the library
+    index = self.context.dependencyIndex
+    index.load()
+    orphanBooks = index.books - set(self.context.bookFiles)
+    if orphanBooks and not args.dry_run:
+      for bookFile in sorted(orphanBooks):
+        index.remove_book(bookFile)
+      index.save()
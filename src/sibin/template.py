@@ -0,0 +1,136 @@
+import sibin.core
+import os
+import os.path
+import re
+from lxml import etree
+
+# Marks the position of a book-specific field in a pre-rendered template file
+MARKER = '@@sibin:%s@@'
+MARKER_PATTERN = re.compile(r'@@sibin:(\w+)@@')
+
+DOCBOOK_NS = { 'db' : 'http://docbook.org/ns/docbook'}
+
+def xml_header(tagname,entityfile):
+  # If necessary, strip off the preceding namespace (DocBook 5)
+  if tagname.startswith('{'):
+    tagname = tagname[tagname.find('}')+1:]
+  content = "<?xml version='1.0' encoding='UTF-8'?>\n"
+  content += '<!DOCTYPE ' + tagname + ' [\n'
+  content += '<!ENTITY % BOOK_ENTITIES SYSTEM "' + entityfile + '">\n'
+  content += '%BOOK_ENTITIES;\n'
+  content += ']>\n'
+  return content
+
+def doc_to_xml_string(element,entityfile):
+  content = xml_header(element.tag, entityfile)
+  content += etree.tostring(element)
+  content += '\n'
+  return content
+
+def escape(value,isAttribute=False):
+  '''
+  Escape value exactly as lxml serializes element text (or attribute values) in ASCII,
+  with non-ASCII characters written as character references (which lxml writes in
+  decimal in text, but in hexadecimal in attribute values)
+  '''
+  if isinstance(value, str):
+    value = value.decode('utf-8')
+  value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+  if isAttribute:
+    value = value.replace('"', '&quot;').replace('\n', '&#10;').replace('\t', '&#9;')
+    return ''.join([c if ord(c) < 128 else '&#x%X;' % ord(c) for c in value]).encode('ascii')
+  return value.encode('ascii', 'xmlcharrefreplace')
+
+
+class Template:
+  '''
+  A pre-rendered template file, split into literal text and named fields
+  '''
+
+  def __init__(self,content):
+    # Alternates between literal text (even indexes) and field names (odd indexes)
+    self.parts = MARKER_PATTERN.split(content)
+
+  def render(self,fields):
+    '''
+    Return the rendered file, substituting the (already escaped) values in fields
+    '''
+    parts = list(self.parts)
+    for i in range(1, len(parts), 2):
+      parts[i] = fields[parts[i]]
+    return ''.join(parts)
+
+
+class TemplateDir:
+  '''
+  The files of a template directory, loaded once. Book_Info.xml and Revision_History.xml are
+  parsed and modified once, with the library-wide fields (product name, product version, and
+  revision number) filled in and markers in place of the book-specific fields, so that the
+  per-book files can be rendered without parsing any XML.
+  '''
+
+  def __init__(self,context,templatedir):
+    self.context = context
+    self.templatedir = templatedir
+    self.files = {}
+    for filename in ['publican.cfg', 'Author_Group.xml', 'Preface.xml']:
+      self.files[filename] = context.sourceTree.read(os.path.join(templatedir, filename))
+    self.images = sorted(context.sourceTree.listdir(os.path.join(templatedir, 'images')))
+    self.bookInfo = self.load_book_info()
+    self.revHistory = self.load_revhistory()
+
+  def load_book_info(self):
+    root = sibin.core.parse_xml(os.path.join(self.templatedir, 'Book_Info.xml')).getroot()
+    for title in root.xpath('/db:info/db:title', namespaces = DOCBOOK_NS):
+      title.text = MARKER % 'title'
+    for subtitle in root.xpath('/db:info/db:subtitle', namespaces = DOCBOOK_NS):
+      subtitle.text = MARKER % 'subtitle'
+    for productname in root.xpath('/db:info/db:productname', namespaces = DOCBOOK_NS):
+      productname.text = self.context.productname
+    for productnumber in root.xpath('/db:info/db:productnumber', namespaces = DOCBOOK_NS):
+      productnumber.text = self.context.productversion
+    for abstract in root.xpath('/db:info/db:abstract/db:para', namespaces = DOCBOOK_NS):
+      abstract.text = MARKER % 'abstract'
+    return Template(doc_to_xml_string(root, MARKER % 'entityfile'))
+
+  def load_revhistory(self):
+    root = sibin.core.parse_xml(os.path.join(self.templatedir, 'Revision_History.xml')).getroot()
+    root.set('{http://www.w3.org/XML/1998/namespace}id', MARKER % 'id')
+    for revision in root.xpath('/db:appendix/db:para/db:revhistory/db:revision', namespaces = DOCBOOK_NS):
+      revnumber = revision.find('{http://docbook.org/ns/docbook}revnumber')
+      revnumber.text = self.context.productversion + '-' + self.context.buildversion
+      # Modify just the first revision element
+      break
+    return Template(doc_to_xml_string(root, MARKER % 'entityfile'))
+
+  def render_book_info(self,book,bookfileroot):
+    return self.bookInfo.render({
+      'entityfile' : bookfileroot + '.ent',
+      'title' : escape(book.title),
+      'subtitle' : escape(book.subtitle),
+      'abstract' : escape(book.abstract)
+    })
+
+  def render_revhistory(self,bookfileroot):
+    return self.revHistory.render({
+      'entityfile' : bookfileroot + '.ent',
+      'id' : escape(bookfileroot + '-RevHistory', True)
+    })
+
+
+class TemplateCache:
+  '''
+  Holds the loaded template directories, so that each template directory
+  is loaded only once per run (and once per profile)
+  '''
+
+  def __init__(self,context):
+    if not isinstance(context,sibin.core.SibinContext):
+      raise Exception('TemplateCache must be initialized with a SibinContext argument')
+    self.context = context
+    self.templateDirs = {}
+
+  def get(self,templatedir):
+    if templatedir not in self.templateDirs:
+      self.templateDirs[templatedir] = TemplateDir(self.context, templatedir)
+    return self.templateDirs[templatedir]
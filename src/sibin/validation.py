@@ -0,0 +1,123 @@
+import sibin.core
+import multiprocessing
+import os.path
+import re
+from lxml import etree
+
+# Well-known locations of the DocBook 5 RELAX NG schema, used if no schema is configured
+DEFAULT_SCHEMAS = [
+  '/usr/share/xml/docbook/schema/rng/5.0/docbook.rng',
+  '/usr/share/xml/docbook5/schema/rng/5.0/docbook.rng',
+  '/usr/share/sgml/docbook/xml-dtd-4.5/docbookx.dtd'
+]
+
+# The schema loaded by this process, and the file it was loaded from (see load_schema())
+schema = None
+schemaFileLoaded = None
+
+# The elements (and attributes) that reference other schema files, in RELAX NG and W3C XML Schema
+SCHEMA_REFERENCES = [
+  ('{http://relaxng.org/ns/structure/1.0}include', 'href'),
+  ('{http://relaxng.org/ns/structure/1.0}externalRef', 'href'),
+  ('{http://www.w3.org/2001/XMLSchema}include', 'schemaLocation'),
+  ('{http://www.w3.org/2001/XMLSchema}import', 'schemaLocation'),
+  ('{http://www.w3.org/2001/XMLSchema}redefine', 'schemaLocation')
+]
+
+# An external parameter entity declaration in a DTD
+DTD_REFERENCE = re.compile(r'''<!ENTITY\s+%\s*[^\s]+\s+(SYSTEM|PUBLIC\s+("[^"]*"|'[^']*'))\s*("([^"]*)"|'([^']*)')''')
+
+def find_default_schema():
+  for schemaFile in DEFAULT_SCHEMAS:
+    if os.path.exists(schemaFile):
+      return schemaFile
+  return ''
+
+def load_schema(schemaFile):
+  '''
+  Compile the schema in schemaFile (RELAX NG, DTD, or W3C XML Schema, depending on the
+  file extension), once per process
+  '''
+  global schema, schemaFileLoaded
+  if schemaFileLoaded == schemaFile:
+    return
+  ext = os.path.splitext(schemaFile)[1].lower()
+  if ext == '.rng':
+    schema = etree.RelaxNG(etree.parse(schemaFile))
+  elif ext == '.dtd':
+    schema = etree.DTD(schemaFile)
+  elif ext == '.xsd':
+    schema = etree.XMLSchema(etree.parse(schemaFile))
+  else:
+    raise Exception('Unknown schema type (expected .rng, .dtd, or .xsd): ' + schemaFile)
+  schemaFileLoaded = schemaFile
+
+def schema_files(schemaFile):
+  '''
+  Return the set of files that the schema in schemaFile consists of: schemaFile itself and all
+  the local files it includes (recursively). Files that cannot be read or parsed are ignored
+  (an unreadable schema is reported when it is loaded).
+  '''
+  files = set()
+  pending = [os.path.normpath(schemaFile)]
+  while pending:
+    filename = pending.pop()
+    if filename in files or not os.path.isfile(filename):
+      continue
+    files.add(filename)
+    hrefs = []
+    if filename.lower().endswith('.dtd') or filename.lower().endswith('.ent') or filename.lower().endswith('.mod'):
+      with open(filename, 'r') as f:
+        for match in DTD_REFERENCE.finditer(f.read()):
+          hrefs.append(match.group(4) if match.group(4) is not None else match.group(5))
+    else:
+      try:
+        root = etree.parse(filename).getroot()
+      except etree.XMLSyntaxError:
+        continue
+      for (tag, attribute) in SCHEMA_REFERENCES:
+        for el in root.iter(tag):
+          if el.get(attribute):
+            hrefs.append(el.get(attribute))
+    for href in hrefs:
+      if '://' not in href:
+        pending.append(os.path.normpath(os.path.join(os.path.dirname(filename), href)))
+  return files
+
+def validate_book(bookFile):
+  '''
+  Validate bookFile (with its xi:includes resolved) against the schema loaded by this process,
+  returning the pair (bookFile, errors), where errors is a list of error messages
+  '''
+  try:
+    doc = sibin.core.parse_xml(bookFile)
+    doc.xinclude()
+  except (etree.XMLSyntaxError, etree.XIncludeError) as e:
+    errors = format_errors(e.error_log.filter_from_errors(), bookFile)
+    return (bookFile, errors or [bookFile + ': ' + str(e)])
+  if schema.validate(doc):
+    return (bookFile, [])
+  return (bookFile, format_errors(schema.error_log, bookFile))
+
+def format_errors(errorLog,bookFile):
+  errors = []
+  for error in errorLog:
+    errors.append((error.filename or bookFile) + ':' + str(error.line) + ': ' + error.message)
+  return errors
+
+def validate_books(schemaFile,bookFiles,processes=None):
+  '''
+  Validate the specified books in a pool of worker processes, each of which compiles
+  the schema just once, returning a dictionary that maps each book to its list of errors.
+  The schema is first loaded in this process, so that a schema that does not compile raises
+  an exception here (rather than in the initializer of every worker the pool starts).
+  '''
+  load_schema(schemaFile)
+  if len(bookFiles) < 2 or processes == 1:
+    return dict([validate_book(bookFile) for bookFile in bookFiles])
+  pool = multiprocessing.Pool(min(len(bookFiles), processes or multiprocessing.cpu_count()), load_schema, (schemaFile,))
+  try:
+    return dict(pool.map(validate_book, bookFiles))
+  finally:
+    pool.close()
+    pool.join()
@@ -4,6 +4,7 @@ Created on Dec 20, 2013
 @author: fbolton
 '''
 import sibin.core
+import sibin.metrics
 import copy
 import os.path
 import subprocess
@@ -20,19 +21,60 @@ class XMLTransformer:
       raise Exception('XMLTransformer must be initialized with a SibinContext argument')
     self.context = context
     self.SECTION_TAGS = ['section', 'simplesect', 'sect1', 'sect2', 'sect3', 'sect4', 'sect5']
+    # Cache of image widths, indexed by image file
+    self.imageWidths = {}
 
   def getImageWidth(self,imagefile):
-    # Call the ImageMagick 'identify' utility to get the image metadata
-    metadata = subprocess.check_output(['identify', imagefile]).split()
-    (imagewidth, imagedepth) = metadata[2].split('x')
-    return imagewidth
+    if imagefile not in self.imageWidths:
+      # Call the ImageMagick 'identify' utility to get the image metadata
+      sibin.metrics.collector.count('sibin_subprocess_total', tool='identify')
+      sourceTree = self.context.sourceTree
+      if sourceTree.is_local(imagefile):
+        metadata = subprocess.check_output(['identify', imagefile]).split()
+      else:
+        # Pipe the image from the git object store (identify takes the format from the prefix)
+        imageformat = os.path.splitext(imagefile)[1][1:].lower()
+        process = subprocess.Popen(['identify', imageformat + ':-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        (output, errors) = process.communicate(sourceTree.read(imagefile))
+        if process.returncode:
+          raise subprocess.CalledProcessError(process.returncode, 'identify ' + imagefile)
+        metadata = output.split()
+      (imagewidth, imagedepth) = metadata[2].split('x')
+      self.imageWidths[imagefile] = imagewidth
+    return self.imageWidths[imagefile]
 
   def dcbk2publican(self,element,xmlfile,bookid):
     self.bookid = bookid
+    # The file being transformed (reported as the location of any warnings)
+    self.xmlfile = xmlfile
+    # Records the digest of every cross-book olink target resolved by this transformation
+    self.resolvedOlinks = {}
+    # Records the image files referenced by this transformation
+    self.usedImages = set()
+    # Conditions to filter on (publican does not filter, if the profile has no conditions)
+    self.conditionSet = set()
+    if self.context.filterConditions:
+      self.conditionSet = self.context.getconditionset()
     result = copy.deepcopy(element)
     self._dcbk2publican_element( result, xmlfile, with_tail=False )
     return result
 
+  def isExcluded(self,el):
+    '''
+    Return True, if the condition attribute of el does not match any of the current profile conditions
+    '''
+    return sibin.core.is_excluded(el.get('condition'), self.conditionSet)
+
+  def removePreservingTail(self,el):
+    parent = el.getparent()
+    if el.tail:
+      previous = el.getprevious()
+      if previous is not None:
+        previous.tail = (previous.tail or '') + el.tail
+      else:
+        parent.text = (parent.text or '') + el.tail
+    parent.remove(el)
+
   def _dcbk2publican_element(self,el,xmlfile,with_tail=True):
     # Remove namespace from tag
     i = el.tag.find('}')
@@ -61,6 +103,8 @@ class XMLTransformer:
     elif tagname == 'imagedata':
       fileref = el.get('fileref') or el.get('{http://docbook.org/ns/docbook}fileref')
       if fileref and (not fileref.startswith('http:')):
+        if os.path.basename(fileref) in self.context.imageFileMap:
+          self.usedImages.add(self.context.imageFileMap[os.path.basename(fileref)])
         el.set('fileref', 'images/' + os.path.basename(fileref))
         # Fix image scaling
         contentwidth = el.get('contentwidth') or el.get('{http://docbook.org/ns/docbook}contentwidth')
@@ -78,8 +122,10 @@ class XMLTransformer:
     elif tagname == 'programlisting':
       self._dcbk2publican_verbatim(el)
     # Iterate over all child nodes
-    for child in el:
-      if isinstance(child, etree._Comment):
+    for child in list(el):
+      if isinstance(child, etree._Element) and self.isExcluded(child):
+        self.removePreservingTail(child)
+      elif isinstance(child, etree._Comment):
         self._dcbk2publican_comment(child)
       elif isinstance(child, etree._Entity):
         self._dcbk2publican_entity(child)
@@ -116,8 +162,9 @@ class XMLTransformer:
     if targetdoc and targetptr and (targetdoc != self.bookid):
       # Link between books
       # Maps to a 'link' element
+      self.resolvedOlinks[targetdoc + ' ' + targetptr] = self.context.linkData.target_digest(targetdoc,targetptr)
       link = el.makeelement('link')
-      link.set('{http://www.w3.org/1999/xlink}href', self.context.linkData.olink2url(targetdoc,targetptr))
+      link.set('{http://www.w3.org/1999/xlink}href', self.context.linkData.olink2url(targetdoc,targetptr,self.xmlfile))
       if el.text:
         link.text = el.text
       else:
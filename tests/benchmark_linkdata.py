@@ -0,0 +1,72 @@
+'''
+Memory benchmark for sibin.core.LinkData.
+
+Fills the link data with a synthetic library and reports the growth of the maximum resident
+set size, together with a SHA1 over the results of olink2url() and getolinktext() for a sample
+of lookups (and a SHA1 over the exported link index, where export_index() exists). The SHA1s
+must not change when only the representation of the link data changes.
+
+Usage: python2.7 tests/benchmark_linkdata.py [--entries N] [--books N] [--src DIR]
+
+To compare with another revision, check it out (for example, with 'git worktree add') and
+pass its src directory with --src.
+'''
+import argparse
+import hashlib
+import json
+import os
+import resource
+import sys
+
+parser = argparse.ArgumentParser(description='Measure the memory used by the sibin link data')
+parser.add_argument('--entries', type=int, default=1000000, help='Number of link targets (default: 1000000)')
+parser.add_argument('--books', type=int, default=20, help='Number of books (default: 20)')
+parser.add_argument('--src', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'), help='The src directory of the sibin revision to measure')
+args = parser.parse_args()
+sys.path.insert(0, os.path.abspath(args.src))
+
+import sibin.core
+
+TAGS = ['chapter', 'section', 'section', 'section', 'figure', 'example', 'table', 'appendix']
+
+context = sibin.core.SibinContext()
+context.hostnames['default'] = 'https://access.example.com/documentation'
+context.productname = 'Foo Product'
+context.productversion = '1.3'
+
+books = []
+for bookIndex in range(args.books):
+  book = sibin.core.Book('Book' + str(bookIndex) + '/Book' + str(bookIndex) + '.xml')
+  book.id = 'Book' + str(bookIndex)
+  book.title = 'Book ' + str(bookIndex) + ' of the Foo Product Library'
+  books.append(book)
+
+def entry(i):
+  '''
+  Return the (book, tag, xmlId, title, pageId) of the i'th link target. Every 50th xml:id
+  is also defined in the next book, as happens with shared topics.
+  '''
+  book = books[i % args.books]
+  xmlId = 'Topic-' + str(i - 1 if i % 50 == 1 else i)
+  return (book, TAGS[i % len(TAGS)], xmlId, 'The title of topic ' + str(i), 'Page-' + str(i // 10))
+
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+linkData = sibin.core.LinkData(context)
+for i in xrange(args.entries):
+  (book, tag, xmlId, title, pageId) = entry(i)
+  linkData.addLinkData(book, tag, xmlId, title, pageId)
+growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+sha = hashlib.sha1()
+lookups = 0
+for i in xrange(0, args.entries, 7):
+  (book, tag, xmlId, title, pageId) = entry(i)
+  for targetptr in [xmlId, 'Missing-' + str(i)]:
+    sha.update(linkData.olink2url(book.id, targetptr) + '\0' + linkData.getolinktext(book.id, targetptr) + '\0')
+    lookups += 1
+
+print 'Entries: ' + str(args.entries) + ' over ' + str(args.books) + ' books'
+print 'Max RSS growth: ' + '%.1f' % (growth / 1024.0) + ' MB'
+print 'Lookups: ' + str(lookups) + ', SHA1: ' + sha.hexdigest()
+if hasattr(linkData, 'export_index'):
+  print 'Link index SHA1: ' + hashlib.sha1(json.dumps(linkData.export_index(), sort_keys=True)).hexdigest()
@@ -0,0 +1,36 @@
+#!/bin/bash
+# Check that 'sibin gen' is reproducible: generate the sample library in two fresh copies,
+# with different Python hash seeds, and compare the SHA1s of the two generated trees.
+# Requires the same prerequisites as sibin itself (python2.7, lxml, and ImageMagick).
+# Usage: tests/reproducible.sh
+set -e
+TOPDIR=$(cd $(dirname $0)/.. && pwd)
+WORKDIR=$(mktemp -d)
+trap "rm -rf $WORKDIR" EXIT
+
+tree_sha1() {
+  # The SHA1 of the names and contents of all the files in the generated profile directories
+  (cd $1 && find default -type f | LC_ALL=C sort | xargs sha1sum | sha1sum | cut -c1-40)
+}
+
+for seed in 1 2; do
+  LIBDIR=$WORKDIR/sample$seed
+  cp -r $TOPDIR/resources/sample $LIBDIR
+  cp -r $TOPDIR/resources/template $LIBDIR/template
+  # The template's boilerplate images (sibin requires a template/images directory)
+  mkdir -p $LIBDIR/template/images
+  cp $TOPDIR/resources/sample/BookA/images/title_logo.svg $LIBDIR/template/images/
+  (cd $LIBDIR && git init -q && git add -A && git -c user.name=sibin -c user.email=sibin@localhost commit -qm sample)
+  (cd $LIBDIR && PYTHONHASHSEED=$seed $TOPDIR/bin/sibin gen > $WORKDIR/gen$seed.log)
+done
+
+SHA1=$(tree_sha1 $WORKDIR/sample1)
+SHA2=$(tree_sha1 $WORKDIR/sample2)
+echo "sample1: $SHA1"
+echo "sample2: $SHA2"
+if [ "$SHA1" != "$SHA2" ]; then
+  echo 'FAIL: the generated trees differ'
+  diff -r $WORKDIR/sample1/default $WORKDIR/sample2/default || true
+  exit 1
+fi
+echo 'OK: the generated trees are identical'
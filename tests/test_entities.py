@@ -0,0 +1,88 @@
+'''
+Tests for the expansion of entities in localized books.
+Usage: python2.7 -m unittest discover -s tests
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import sibin.core
+import sibin.tasks
+
+ENTITIES = '''<!ENTITY prodver "1.3">
+<!ENTITY PRODUCT "Foo Product">
+<!ENTITY markup "<emphasis>Foo</emphasis> Product">
+'''
+
+BOOK = '''<?xml version='1.0' encoding='UTF-8'?>
+<!DOCTYPE book [
+<!ENTITY % BOOK_ENTITIES SYSTEM "Library.ent">
+%BOOK_ENTITIES;
+]>
+<book xmlns="http://docbook.org/ns/docbook" xmlns:xi="http://www.w3.org/2001/XInclude">
+<title>&PRODUCT;</title>
+<xi:include href="Chapter.xml"/>
+</book>
+'''
+
+CHAPTER = '''<?xml version='1.0' encoding='UTF-8'?>
+<!DOCTYPE chapter [
+<!ENTITY % BOOK_ENTITIES SYSTEM "Library.ent">
+%BOOK_ENTITIES;
+]>
+<chapter xmlns="http://docbook.org/ns/docbook"{0}>
+<para>&markup; version &prodver;</para>
+</chapter>
+'''
+
+class ExpandEntitiesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.context = sibin.core.SibinContext()
+    self.context.bookEntitiesFile = self.write('Library.ent', ENTITIES)
+    self.tasks = sibin.tasks.BasicTasks(self.context)
+    self.bookFile = self.write('Book.xml', BOOK)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def write(self,filename,content):
+    filename = os.path.join(self.tmpdir, filename)
+    with open(filename, 'w') as f:
+      f.write(content)
+    return filename
+
+  def expand(self,chapterAttributes):
+    chapterFile = self.write('Chapter.xml', CHAPTER.format(chapterAttributes))
+    doc = sibin.core.parse_xml(self.bookFile,resolve_entities=False)
+    doc.xinclude()
+    return self.tasks.expand_entities(doc.getroot(), set([self.bookFile, chapterFile]))
+
+  def test_text_entities(self):
+    root = self.expand('')
+    ns = '{http://docbook.org/ns/docbook}'
+    self.assertEqual(root.findtext(ns + 'title'), 'Foo Product')
+    para = root.find(ns + 'chapter/' + ns + 'para')
+    self.assertEqual(''.join(para.itertext()), 'Foo Product version 1.3')
+    self.assertIn('<emphasis>Foo</emphasis> Product version 1.3</para>', etree.tostring(para))
+
+  def test_attribute_entities(self):
+    root = self.expand(' role="&prodver;" xreflabel="v &PRODUCT; &amp; co"')
+    chapter = root.find('{http://docbook.org/ns/docbook}chapter')
+    self.assertEqual(chapter.get('role'), '1.3')
+    self.assertEqual(chapter.get('xreflabel'), 'v Foo Product & co')
+    self.assertEqual(''.join(chapter.itertext()).strip(), 'Foo Product version 1.3')
+
+  def test_in_attributes(self):
+    expander = sibin.core.EntityExpander(self.context.bookEntitiesFile)
+    self.assertFalse(expander.in_attributes([self.write('a.xml', '<para role="a &amp; b &#169;">&PRODUCT;</para>')]))
+    self.assertTrue(expander.in_attributes([self.write('b.xml', "<para role='&prodver;'/>")]))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+'''
+Tests for the validation of books against a schema.
+Usage: python2.7 -m unittest discover -s tests
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import sibin.validation
+
+SCHEMA = '''<grammar xmlns="http://relaxng.org/ns/structure/1.0">
+  <include href="para.rng"/>
+  <start><element name="book"><oneOrMore><ref name="para"/></oneOrMore></element></start>
+</grammar>
+'''
+
+PARA = '''<grammar xmlns="http://relaxng.org/ns/structure/1.0">
+  <define name="para"><element name="para"><text/></element></define>
+</grammar>
+'''
+
+class ValidationTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.schemaFile = self.write('schema.rng', SCHEMA)
+    self.write('para.rng', PARA)
+    self.bookFiles = [self.write('BookA.xml', '<book><para>A</para></book>'), self.write('BookB.xml', '<book><title>B</title></book>')]
+    sibin.validation.schemaFileLoaded = None
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def write(self,filename,content):
+    filename = os.path.join(self.tmpdir, filename)
+    with open(filename, 'w') as f:
+      f.write(content)
+    return filename
+
+  def test_validate_books(self):
+    errors = sibin.validation.validate_books(self.schemaFile, self.bookFiles, 2)
+    self.assertEqual(errors[self.bookFiles[0]], [])
+    self.assertEqual(len(errors[self.bookFiles[1]]), 1)
+
+  def test_malformed_schema(self):
+    # Must raise in this process, instead of killing every worker of the pool in its initializer
+    schemaFile = self.write('malformed.rng', '<grammar xmlns="http://relaxng.org/ns/structure/1.0"><start/></grammar>')
+    self.assertRaises(Exception, sibin.validation.validate_books, schemaFile, self.bookFiles, 2)
+
+  def test_unknown_schema_type(self):
+    schemaFile = self.write('schema.txt', SCHEMA)
+    self.assertRaises(Exception, sibin.validation.validate_books, schemaFile, self.bookFiles, 2)
+
+  def test_schema_files(self):
+    self.assertEqual(sibin.validation.schema_files(self.schemaFile), set([self.schemaFile, os.path.join(self.tmpdir, 'para.rng')]))
+
+if __name__ == '__main__':
+  unittest.main()